@@ -1,10 +1,14 @@
 #!/usr/bin/python3
 import os
 import json
+import time
 import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from core.importfiles import UserEnvironment
 from core.attached_asset import attachedAsset
 from obj3d.object3d import object3d
+from core.debug import normalsBenchmark
 
 #
 # we need a dummy class for global containing the environment 
@@ -19,10 +23,146 @@ def logLine(level, line):
     if level & 8:
         print (line)
 
-def compressFile(glob, eqtype, path, source):
-    filename = os.path.join(path, source)
-    asset =  attachedAsset(glob, eqtype, glob.env.numverts)
-    asset.mhcloToMHBin(filename)
+def createEnvironment(basename, numverts):
+    uenv = UserEnvironment()
+    uenv.GetPlatform()
+    #
+    # now add a few additional environment variables
+    #
+    uenv.logLine = logLine                          # the function we supply directly
+    uenv.verbose = 0                                # do not print comments from makehuman2
+    uenv.basename = basename                        # the meshname
+    uenv.numverts = numverts                        # use to determine delete bool array
+    uenv.config = {}                                # no configuration, defaults are used
+    return uenv
+
+def assetSources(path):
+    """
+    files a binary depends on: the asset itself and the obj file mentioned inside
+    """
+    sources = [path]
+    if path.endswith(".obj"):
+        return sources
+    try:
+        with open(path, "r", encoding="utf-8", errors='ignore') as f:
+            for line in f:
+                words = line.split()
+                if len(words) > 1 and words[0] == "obj_file":
+                    sources.append(os.path.join(os.path.dirname(path), words[1]))
+                    break
+    except IOError:
+        pass
+    return sources
+
+def binaryName(path):
+    return os.path.splitext(path)[0] + ".mhbin"
+
+def findMeshes(space, basename, pattern=None):
+    """
+    find base mesh and assets in all asset folders
+
+    :param pattern: only assets with a name containing this pattern (base mesh, when "base" is part of it)
+    :return: list of (folder, path)
+    """
+    meshes = []
+    base =  os.path.join(space, "base", basename, "base.obj")
+    if os.path.isfile (base):
+        if pattern is None or "base" in pattern:
+            meshes.append(("base", base))
+
+    for folder in ["clothes", "eyebrows", "eyelashes", "eyes", "hair", "proxy", "teeth", "tongue"]:
+        absfolder = os.path.join(space, folder, basename)
+        if os.path.isdir(absfolder):
+            for root, dirs, files in os.walk(absfolder, topdown=True):
+                for name in sorted(files):
+                    if name.endswith(".mhclo") or name.endswith(".proxy"):
+                        if pattern is None or pattern in name:
+                            meshes.append((folder, os.path.join(root, name)))
+    return meshes
+
+def needsCompile(uenv, path):
+    """
+    binary is missing or one of the sources is newer
+    """
+    mhbin = binaryName(path)
+    for source in assetSources(path):
+        if os.path.isfile(source) and uenv.isSourceFileNewer(mhbin, source):
+            return True
+    return not os.path.isfile(mhbin)
+
+# environment of a worker process, created with the first job
+#
+workerglob = None
+
+def compileMesh(job):
+    """
+    compile one mesh (base mesh or asset) to mhbin, used by process pool
+
+    :param job: (folder, path, basename, numverts)
+    :return: (path, okay, error, seconds)
+    """
+    global workerglob
+    (folder, path, basename, numverts) = job
+    if workerglob is None or workerglob.env.basename != basename:
+        workerglob = globalObjects(createEnvironment(basename, numverts))
+
+    start = time.time()
+    try:
+        if folder == "base":
+            basemesh = object3d(workerglob, None, "base")
+            (res, err) = basemesh.load(path, True)
+            if res > 0:
+                (okay, err) = basemesh.exportBinary()
+                res = res if okay else 0
+        else:
+            asset =  attachedAsset(workerglob, folder, numverts)
+            (res, err) = asset.mhcloToMHBin(path)
+    except Exception as error:
+        (res, err) = (0, str(error))
+    return (path, res > 0, err, round(time.time() - start, 3))
+
+def compileMeshes(jobs, processes=None):
+    """
+    compile meshes in a process pool if there is more than one, results are printed when they arrive
+    (in the order they are finished)
+
+    :return: list of (path, okay, error, seconds) in the order of the jobs
+    """
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = min(processes, len(jobs))
+    if processes < 2:
+        results = enumerate(map(compileMesh, jobs))
+        pool = None
+    else:
+        ctx = multiprocessing.get_context("spawn")
+        pool = ProcessPoolExecutor(max_workers=processes, mp_context=ctx)
+        futures = {pool.submit(compileMesh, job): i for i, job in enumerate(jobs)}
+        results = ((futures[future], future.result()) for future in as_completed(futures))
+
+    done = [None] * len(jobs)
+    try:
+        for i, (path, okay, err, secs) in results:
+            if okay:
+                print ("compiled: " + path + " (" + str(secs) + " sec)")
+            else:
+                print ("failed:   " + path + ": " + str(err))
+            done[i] = (path, okay, err, secs)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return done
+
+def saveManifest(filename, space, manifest):
+    """
+    machine readable report, paths are relative to space
+    """
+    files = {}
+    for (path, status, err, secs) in manifest["files"]:
+        files[os.path.relpath(path, space)] = {"status": status, "mhbin": os.path.relpath(binaryName(path), space), "seconds": secs, "error": err}
+    manifest["files"] = files
+    with open(filename, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=4, sort_keys=True)
 
 if __name__ == '__main__':
     # get predefined environment parameters (standardmesh)
@@ -33,15 +173,7 @@ if __name__ == '__main__':
             release = json.load(f)
 
 
-    uenv = UserEnvironment()
-    uenv.GetPlatform()
-    #
-    # now add a few additional environment variables
-    #
-    uenv.logLine = logLine                          # the function we supply directly
-    uenv.verbose = 0                                # do not print comments from makehuman2
-    uenv.basename = release["standardmesh"]         # the meshname
-    uenv.numverts = release["standardnumverts"]     # use to determine delete bool array
+    uenv = createEnvironment(release["standardmesh"], release["standardnumverts"])
 
     conffile = uenv.GetUserConfigFilenames()[0]
     userspace = None
@@ -57,6 +189,10 @@ if __name__ == '__main__':
         parser.add_argument("-u", action="store_true", help="compile user space instead of system space")
 
     parser.add_argument("-n", action="store_true", help="compile non interactive")
+    parser.add_argument("-b", action="store_true", help="benchmark normal calculation on base mesh (and 4 times subdivided size), nothing is written")
+    parser.add_argument("-f", action="store_true", help="compile all meshes, also when binary is newer than the sources")
+    parser.add_argument("-j", type=int, default=None, help="number of parallel processes (default: number of cpus)")
+    parser.add_argument("-m", type=str, default=None, help="name of the manifest file (default: compiled_meshes_<space>.json in user data folder or current directory)")
     parser.add_argument("filename", nargs="?", type=str, help="compile only assets which are similar to this filename")
 
     args = parser.parse_args()
@@ -88,6 +224,16 @@ if __name__ == '__main__':
                 space = systemspace
                 okay = True
 
+    if args.b:
+        base =  os.path.join(space, "base", uenv.basename, "base.obj")
+        basemesh = object3d(globalObjects(uenv), None, "base")
+        (res, err) = basemesh.load(base, True)
+        if res == 0:
+            print (err)
+            exit(10)
+        normalsBenchmark(basemesh)
+        exit(0)
+
     print ("Compile objects in: " + space + "\n")
     if args.n is False:
         okay = False
@@ -98,36 +244,41 @@ if __name__ == '__main__':
             if line == "c":
                 okay = True
 
-    glob = globalObjects(uenv)
+    # find meshes, binaries newer than all sources are skipped
+    #
+    start = time.time()
+    meshes = findMeshes(space, uenv.basename, args.filename)
+    jobs = []
+    manifest = {"basename": uenv.basename, "files": []}
+    for (folder, path) in meshes:
+        if args.f or needsCompile(uenv, path):
+            jobs.append((folder, path, uenv.basename, uenv.numverts))
+        else:
+            manifest["files"].append((path, "up-to-date", None, 0.0))
+
+    print ("Found " + str(len(meshes)) + " mesh(es), " + str(len(jobs)) + " to compile.")
+    failed = []
+    for (path, okay, err, secs) in compileMeshes(jobs, args.j):
+        manifest["files"].append((path, "compiled" if okay else "failed", err, secs))
+        if not okay:
+            failed.append((path, err))
 
-    # first compile base if added to user space or system space
+    # summary
     #
-    num = 0
-    base =  os.path.join(space, "base", uenv.basename, "base.obj")
-    if os.path.isfile (base):
-        if args.filename is None or "base" in args.filename:
-            print ("Found: " + base)
-            basemesh = object3d(glob, None, "base")
-            (res, err) = basemesh.load(base, True)
-            if res == 0:
-                print (err)
-                exit(10)
-            basemesh.exportBinary()
-            num += 1
+    manifest["compiled"] = len(jobs) - len(failed)
+    manifest["failed"] = len(failed)
+    manifest["up-to-date"] = len(meshes) - len(jobs)
+    manifest["seconds"] = round(time.time() - start, 3)
+    manifestfile = args.m
+    if manifestfile is None:
+        manifestfile = "compiled_meshes_" + ("system" if space == systemspace else "user") + ".json"
+        if userspace is not None and os.path.isdir(userspace):
+            manifestfile = os.path.join(userspace, manifestfile)
+    saveManifest(manifestfile, space, manifest)
 
-    for folder in ["clothes", "eyebrows", "eyelashes", "eyes", "hair", "proxy", "teeth", "tongue"]:
-        absfolder = os.path.join(space, folder, uenv.basename)
-        if os.path.isdir(absfolder):
-            for root, dirs, files in os.walk(absfolder, topdown=True):
-                for name in files:
-                    if name.endswith(".mhclo") or name.endswith(".proxy"):
-                        if args.filename:
-                            if args.filename in name:
-                                compressFile (glob, folder, root, name)
-                                num += 1
-                        else:
-                            compressFile (glob, folder, root, name)
-                            num += 1
-
-    print (str(num) + " mesh(es) compiled.")
-    exit(0)
+    print ("\n" + str(manifest["compiled"]) + " mesh(es) compiled, " + str(manifest["up-to-date"]) + " up-to-date, " +
+            str(manifest["failed"]) + " failed in " + str(manifest["seconds"]) + " sec.")
+    for (path, err) in failed:
+        print ("Failed: " + path + ": " + str(err))
+    print ("Manifest: " + manifestfile)
+    exit(10 if len(failed) > 0 else 0)
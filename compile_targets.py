@@ -31,6 +31,11 @@ if __name__ == '__main__':
         parser.add_argument("-u", action="store_true", help="compile user space instead of system space")
 
     parser.add_argument("-n", action="store_true", help="compile non interactive")
+    parser.add_argument("-b", action="store_true", help="benchmark bulk against line parser on the target folders, nothing is written")
+    parser.add_argument("-j", type=int, default=None, help="number of parallel processes (default: number of cpus)")
+    parser.add_argument("-m", action="store_true", help="create memory mappable store (mappedtargets.*.npy) instead of compressedtargets.npz")
+    parser.add_argument("-q", type=str, choices=["int16", "float16"], help="create quantized store (quantizedtargets.*.npy) with int16 or float16 deltas")
+    parser.add_argument("-V", action="store_true", help="verify quantized store against the ASCII targets (maximum vertex error), nothing is written")
 
     args = parser.parse_args()
 
@@ -75,9 +80,29 @@ if __name__ == '__main__':
                 space = [systemspace]
                 okay = True
 
+    if args.b:
+        at = TargetASCII()
+        for elem in space:
+            for (name, files, size, secs, speed) in at.benchmark(elem):
+                print (elem + ": " + name + " parser, " + str(files) + " files, " + str(size) + " MB in " + str(secs) + " sec = " + str(speed) + " MB/s")
+        exit (0)
+
+    store = "quantized" if args.q else ("mapped" if args.m else "compressed")
+    destname = TargetASCII.storenames[store]
+
+    if args.V:
+        at = TargetASCII()
+        for elem in space:
+            dest = os.path.join(elem, TargetASCII.storenames["quantized"])
+            result = at.verifyQuantized(elem, dest)
+            bad = [r[0] for r in result if r[2] is False]
+            if len(result) > 0:
+                print (elem + ": maximum vertex error " + str(result[0][1]) + " (" + result[0][0] + "), " + str(len(bad)) + " targets missing or with different indices")
+        exit (0)
+
     for elem in space:
         print ("Compile targets in: " + elem)
-        dest = os.path.join(elem, "compressedtargets.npz")
+        dest = os.path.join(elem, destname)
         print ("Destination file is: " + dest)
     if args.n is False:
         okay = False
@@ -90,6 +115,6 @@ if __name__ == '__main__':
 
     for elem in space:
         at = TargetASCII()
-        dest = os.path.join(elem, "compressedtargets.npz")
-        at.compressAllTargets(elem, dest, 1)
+        dest = os.path.join(elem, destname)
+        at.compressAllTargets(elem, dest, 1, store, args.j, args.q)
 
@@ -5,12 +5,14 @@
     Classes:
     * referenceVerts
     * attachedAsset
+    * AssetFitter
 """
 
 import os
+import hashlib
 import numpy as np
 from core.debug import dumper
-from obj3d.fops_binary import exportObj3dBinary, importObjValues
+from obj3d.fops_binary import exportObj3dBinary, importObjValues, loadBinary
 from obj3d.object3d  import object3d
 from obj3d.bone import boneWeights
 
@@ -97,6 +99,7 @@ class attachedAsset:
         self.ref_vIdxs = None       # (Vidx1,Vidx2,Vidx3) list with references to human vertex indices, indexed by reference vert
         self.weights = None         # (w1,w2,w3) list, with weights per human vertex (mapped by ref_vIdxs), indexed by reference vert
         self.offsets = None         # (x,y,z) list of vertex offsets, indexed by reference vert
+        self.fitting = None         # (rows, weights, offsets) precalculated fitting matrix, see createFittingMatrix
         self.deleteVerts = None     # will contain vertices to delete
         self.material = None        # path material, fully qualified
         self.standard_material = None # path material, fully qualified
@@ -230,6 +233,7 @@ class attachedAsset:
         self.weights = np.asarray([v._weights for v in refVerts], dtype=np.float32)
         self.ref_vIdxs = np.asarray([v._verts for v in refVerts], dtype=np.uint32)
         self.offsets = np.asarray([v._offset for v in refVerts], dtype=np.float32)
+        self.createFittingMatrix()
         if self.type == "proxy":
             self.z_depth = 1
 
@@ -246,6 +250,7 @@ class attachedAsset:
         if self.scale is None:
             self.env.logLine(16, "No scale matrix")
             self.scaleMat = None
+            self.createFittingMatrix()
             return
         self.scaleMat = np.identity(3, dtype=np.float32)
 
@@ -256,13 +261,47 @@ class attachedAsset:
             self.scaleMat[n][n] = abs(pos1[n] - pos2[n]) / div
         if self.env.verbose & 16:
             print (self.scaleMat)
+        self.createFittingMatrix()
+
+    def createFittingMatrix(self):
+        """
+        the fitting matrix maps the base mesh to the asset: each row (asset vertex) has 3 entries,
+        the reference vertices of the base mesh with their weights (sparse matrix in ELL layout).
+        The offsets are already scaled, so fitting is one gather and one product.
+        Must be recalculated when scale matrix changes.
+        """
+        if self.ref_vIdxs is None:
+            self.fitting = None
+            return
+        rows = self.ref_vIdxs.astype(np.intp)
+        weights = np.ascontiguousarray(self.weights, dtype=np.float32)
+        offsets = np.array(self.offsets, dtype=np.float32)
+        if self.scaleMat is not None:
+            offsets *= np.diagonal(self.scaleMat)
+        self.fitting = (rows, weights, offsets)
+
+    def fittingMatrix(self):
+        if self.fitting is None:
+            self.createFittingMatrix()
+        return self.fitting
+
+    def fitToBase(self, base, out):
+        """
+        barycentric approximation of all asset vertices
+
+        :param base: coordinates of the base mesh, shape (n, 3)
+        :param out: result buffer, shape (number of reference verts, 3)
+        """
+        (rows, weights, offsets) = self.fittingMatrix()
+        np.einsum("ik,ikj->ij", weights, base[rows], out=out)
+        out += offsets
 
     def getScaleData(self, words):
         return ((int(words[1]), int(words[2]), float(words[3])))
 
     def importBinary(self, path):
         self.env.logLine(8, "Read binary asset " + path)
-        npzfile = np.load(path)
+        npzfile = loadBinary(path)
         for elem in ['asset', 'files', 'ref_vIdxs', 'weights']:
             if elem not in npzfile:
                 error =  "Malformed file, missing component " + elem
@@ -315,6 +354,8 @@ class attachedAsset:
         if "deleteVerts" in npzfile:
             self.deleteVerts = npzfile["deleteVerts"]
 
+        self.createFittingMatrix()
+
         self.obj_file = path
         if self.material is not None:
             self.standard_material = self.material
@@ -347,11 +388,48 @@ class attachedAsset:
                     self.bWeights = None
                     return False, self.env.last_error
         else:
-            # calculate weights from pose skeleton
+            # calculate weights from pose skeleton, use cached weights if possible
             #
-            self.bWeights.approxWeights(self, self.glob.baseClass.pose_skeleton.bWeights)
+            pose_skeleton = self.glob.baseClass.pose_skeleton
+            cachename = self.weightCacheName()
+            key = self.weightCacheKey(pose_skeleton)
+            if cachename is not None and key is not None and os.path.isfile(cachename):
+                if self.bWeights.loadBinary(cachename, key):
+                    self.env.logLine(8, "Weights from cache " + cachename)
+                    return True, None
+
+            self.bWeights.approxWeights(self, pose_skeleton.bWeights)
+            if cachename is not None and key is not None:
+                self.bWeights.saveBinary(cachename, key)
         return True, None
 
+    def weightCacheName(self):
+        """
+        cache file for calculated weights in user dbcache folder, one file per asset
+        """
+        folder = self.env.stdUserPath("dbcache", "weights")
+        if folder is None or self.filename is None:
+            return None
+        if not os.path.isdir(folder):
+            try:
+                os.makedirs(folder)
+            except OSError:
+                return None
+        name = hashlib.sha1(os.path.normpath(os.path.abspath(self.filename)).encode("utf-8")).hexdigest()
+        return os.path.join(folder, name + ".npz")
+
+    def weightCacheKey(self, pose_skeleton):
+        """
+        weights depend on asset file, skeleton file and weights of the skeleton, key uses names and modification time
+        """
+        files = [self.filename, pose_skeleton.filename, pose_skeleton.bWeights.filename]
+        if None in files:
+            return None
+        try:
+            return "|".join(os.path.abspath(f) + ":" + str(os.path.getmtime(f)) for f in files)
+        except OSError:
+            return None
+
     def load(self, filename, use_ascii=False):
         """
         load mhclo or mhbin
@@ -479,3 +557,71 @@ class attachedAsset:
     def mhcloToMHBin(self, path):
         return(self.load(path, True))
 
+
+
+class AssetFitter:
+    """
+    block-stacked fitting matrix of several attached assets. All assets are fitted
+    with one gather and one product into a shared coordinate buffer, afterwards
+    the slices are copied into the coordinate buffers of the assets.
+    Fitter must be recreated when assets or their fitting matrices change, use matches() to check.
+    """
+    def __init__(self, assets):
+        self.assets = list(assets)
+        self.key = self.assetKey(self.assets)
+        self.slices = []
+
+        rows = []
+        weights = []
+        offsets = []
+        start = 0
+        for asset in self.assets:
+            (r, w, o) = asset.fittingMatrix()
+            rows.append(r)
+            weights.append(w)
+            offsets.append(o)
+            self.slices.append((start, start + len(r)))
+            start += len(r)
+
+        if start > 0:
+            self.rows = np.concatenate(rows)
+            self.weights = np.concatenate(weights)
+            self.offsets = np.concatenate(offsets)
+        else:
+            self.rows = np.zeros((0, 3), dtype=np.intp)
+            self.weights = np.zeros((0, 3), dtype=np.float32)
+            self.offsets = np.zeros((0, 3), dtype=np.float32)
+        self.coords = np.zeros((start, 3), dtype=np.float32)
+
+    def __str__(self):
+        return ("AssetFitter: " + str(len(self.assets)) + " assets, " + str(len(self.rows)) + " vertices")
+
+    @staticmethod
+    def assetKey(assets):
+        return [(asset, asset.fitting) for asset in assets]
+
+    def matches(self, assets):
+        """
+        check if fitter is still valid for this list of assets
+        """
+        key = self.assetKey(assets)
+        if len(key) != len(self.key):
+            return False
+        return all(a is b and f is g for ((a, f), (b, g)) in zip(key, self.key))
+
+    def fit(self, base):
+        """
+        fit all assets to base mesh
+
+        :param base: object3d of the base mesh
+        """
+        if len(self.rows) == 0:
+            return
+        b = np.reshape(base.gl_coord, (-1, 3))
+        np.einsum("ik,ikj->ij", self.weights, b[self.rows], out=self.coords)
+        self.coords += self.offsets
+
+        for asset, (start, end) in zip(self.assets, self.slices):
+            obj = asset.obj
+            obj.gl_coord[:(end - start) * 3] = np.ravel(self.coords[start:end])
+            obj.overflowCorrection(obj.gl_coord)
@@ -10,10 +10,10 @@
 
 import os
 from core.target import Targets
-from core.attached_asset import attachedAsset
+from core.attached_asset import attachedAsset, AssetFitter
 from obj3d.object3d import object3d
 from obj3d.skeleton import skeleton
-from obj3d.animation import BVH, MHPose, PosePrims, MHPoseFaceConverter
+from obj3d.animation import BVH, MHPose, PosePrims, MHPoseFaceConverter, FrameCache
 from core.debug import memInfo, dumper
 from core.target import Modelling
 from gui.common import WorkerThread, ErrorBox
@@ -60,6 +60,7 @@ class baseClass():
         self.baseMesh = None
         self.baseInfo = None
         self.attachedAssets = []
+        self.assetfitter = None         # block-stacked fitting of all attached assets
         self.env.logLine(2, "New baseClass: " + name)
         self.env.basename = name
         self.name = name                # will hold the character name
@@ -84,6 +85,7 @@ class baseClass():
         self.in_posemode = False
         self.pose_skelpath = None
         self.bvh = None             # indicates that object is posed
+        self.framecache = None      # baked frames of the animation
         self.posemodifier = None    # indicates that posemodifiers are used
         self.expression = None      # indicates that expressions are used
         self.faceunits  = None      # indicates that face-units are initalized
@@ -592,6 +594,50 @@ class baseClass():
             self.showPoseModifiers()
         self.glob.openGLWindow.Tweak()
 
+    def getFrameCache(self):
+        if self.framecache is None:
+            self.framecache = FrameCache(self.glob)
+        return self.framecache
+
+    def framesToBake(self):
+        """
+        start of playback, in bake mode the frame cache is checked once
+
+        :return: number of frames to precalculate (0 without bake mode)
+        """
+        if self.bvh is None or not self.env.config.get("anim_bake", False):
+            return 0
+        cache = self.getFrameCache()
+        cache.check(self, self.bvh.currentFrame)
+        return cache.missing()
+
+    def bakeAnimation(self, progress=None, cancel=None):
+        """
+        precalculate missing frames of the animation (if bake mode is switched on)
+        """
+        if self.bvh is None or not self.env.config.get("anim_bake", False):
+            return
+        self.getFrameCache().bake(self, progress, cancel)
+
+    def stopAnimation(self):
+        """
+        end of playback
+        """
+        if self.framecache is not None:
+            self.framecache.uncheck()
+
+    def showFrame(self, frame):
+        """
+        pose a frame of the animation, in bake mode use the cache and store missing frames
+        """
+        if not self.env.config.get("anim_bake", False):
+            self.pose_skeleton.pose(self.bvh.joints, frame)
+            return
+        cache = self.getFrameCache()
+        if not cache.show(self, frame):
+            self.pose_skeleton.pose(self.bvh.joints, frame)
+            cache.store(self, frame)
+
     def showExpression(self):
         self.pose_skeleton.posebyBlends(self.expression.blends, self.faceunits.bonemask )
 
@@ -800,7 +846,19 @@ class baseClass():
         for asset in self.attachedAssets:
             asset.obj.calcNormals()
 
+    def getAssetFitter(self):
+        """
+        returns fitter for all attached assets, recreated when assets changed
+        """
+        if self.assetfitter is None or not self.assetfitter.matches(self.attachedAssets):
+            self.assetfitter = AssetFitter(self.attachedAssets)
+            self.env.logLine(8, str(self.assetfitter))
+        return self.assetfitter
+
     def updateAttachedAssets(self):
+        if self.env.config.get("asset_fitting", "stacked") == "stacked":
+            self.getAssetFitter().fit(self.baseMesh)
+            return
         for asset in self.attachedAssets:
             asset.obj.approxToBasemesh(asset, self.baseMesh)
 
@@ -836,6 +894,7 @@ class baseClass():
             mo = Modelling(self.glob, "dummy", None)
             mo.macroCalculationLoad()
         self.updateAttachedAssets()
+        self.updateNormals()
 
 
     def finishApply(self):
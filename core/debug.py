@@ -5,6 +5,8 @@
     Functions:
     * memInfo
     * dumper
+    * splitTriangles
+    * normalsBenchmark
 
     Classes:
     * measureTime
@@ -12,6 +14,8 @@
 
 import psutil
 import time
+import copy
+import numpy as np
 
 class measureTime():
     def __init__(self, what):
@@ -39,3 +43,45 @@ def dumper(mclass):
                 text += (" %s = %r\n" % (attr, m))
     return(text)
 
+
+def splitTriangles(obj):
+    """
+    creates a copy of an object with each triangle split in 4 (midpoints of edges), no overflow,
+    only used to get a mesh of subdivided size for benchmarks
+    """
+    fverts = np.asarray(obj.fverts, dtype=np.int64)
+    coord = np.reshape(obj.gl_coord, (-1, 3))
+    n = len(coord)
+    edges = np.sort(np.stack((fverts[:,[0,1,2]], fverts[:,[1,2,0]]), axis=2).reshape(-1, 2), axis=1)
+    uniq, inverse = np.unique(edges, axis=0, return_inverse=True)
+    mid = (n + inverse.reshape(-1, 3))
+    a, b, c = fverts[:,0], fverts[:,1], fverts[:,2]
+    ab, bc, ca = mid[:,0], mid[:,1], mid[:,2]
+    faces = np.concatenate((np.stack((a, ab, ca), axis=1), np.stack((ab, b, bc), axis=1),
+        np.stack((ca, bc, c), axis=1), np.stack((ab, bc, ca), axis=1)))
+
+    subdiv = copy.copy(obj)
+    subdiv.fverts = faces.astype(np.uint32)
+    subdiv.gl_coord = np.concatenate((coord, (coord[uniq[:,0]] + coord[uniq[:,1]]) / 2)).astype(np.float32).ravel()
+    subdiv.n_verts = len(subdiv.gl_coord) // 3
+    subdiv.overflow = np.zeros((0, 2), dtype=np.uint32)
+    subdiv.gl_norm = []
+    subdiv.vface = None
+    subdiv.dragsessions = {}
+    return (subdiv)
+
+def normalsBenchmark(obj, loops=10):
+    """
+    measure calcNormals for all weightings on an object and on a 4 times larger (split) copy
+    :return: list of [verts, faces, weighting, milliseconds per call]
+    """
+    result = []
+    for mesh in (obj, splitTriangles(obj)):
+        for weighting in ("area", "angle", "uniform"):
+            start = time.perf_counter()
+            for i in range(0, loops):
+                mesh.calcNormals(weighting)
+            ms = (time.perf_counter() - start) * 1000 / loops
+            result.append([mesh.n_verts, len(mesh.fverts), weighting, round(ms, 3)])
+            print ("   normals %8d verts %8d faces %-8s: %8.3f ms" % (mesh.n_verts, len(mesh.fverts), weighting, ms))
+    return (result)
@@ -388,7 +388,17 @@ class programInfo():
             "theme": "makehuman.qss",
             "units": "metric",
             "apihost": "127.0.0.1",
-            "apiport": 12345
+            "apiport": 12345,
+            "target_store": "mapped",
+            "target_cache_mb": 64,
+            "target_quantize": "int16",
+            "normal_weighting": "area",
+            "asset_fitting": "stacked",
+            "skin_influences": 8,
+            "anim_bake": False,
+            "anim_bake_mb": 256,
+            "anim_bake_float16": False,
+            "anim_pipeline": False
         }
 
         # system paths
@@ -603,11 +613,7 @@ class programInfo():
         should return true when: destination is not there
         destination is older
         """
-        if not os.path.isfile(destination):
-            return (True)
-        sourcedate = int(os.stat(source).st_mtime)
-        destdate   = int(os.stat(destination).st_mtime)
-        return (sourcedate > destdate)
+        return (UserEnvironment.isSourceFileNewer(destination, source))
 
     def getFileList(self, dirname, pattern):
         """
@@ -6,17 +6,24 @@
     * UserEnvironment
     * AssetPack
     * TargetASCII
+    * MappedTargets
+    * QuantizedTargets
 """
 
-from io import BytesIO
+from io import BytesIO, StringIO
 from urllib.request import Request, urlopen
 from urllib.error import URLError
 from zipfile import ZipFile
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
 import numpy as np
+import hashlib
+import json
 import os
 import re
 import sys
+import time
 import shutil
 import platform
 import tempfile
@@ -73,6 +80,18 @@ class UserEnvironment():
                     return (None, folder)
 
         return (os.path.join(folder, 'makehuman2.conf'), os.path.join(folder, 'makehuman2_session.conf'))
+
+    @staticmethod
+    def isSourceFileNewer(destination, source):
+        """
+        should return true when: destination is not there
+        destination is older
+        """
+        if not os.path.isfile(destination):
+            return (True)
+        sourcedate = int(os.stat(source).st_mtime)
+        destdate   = int(os.stat(destination).st_mtime)
+        return (sourcedate > destdate)
         
 
 class AssetPack():
@@ -298,10 +317,56 @@ class TargetASCII():
     the class should also support stand-alone compressor
     """
 
+    # file names of binary stores (mapped and quantized are prefixes)
+    #
+    storenames = {"compressed": "compressedtargets.npz", "mapped": "mappedtargets", "quantized": "quantizedtargets"}
+
     def __init__(self):
         pass
 
+    def stripComments(self, text):
+        """
+        remove lines starting with '#' (leading whitespace allowed), '#' is only searched,
+        so files with a comment header only are handled fast
+        """
+        if '#' not in text:
+            return (text)
+        parts = []
+        pos = 0
+        i = text.find('#')
+        while i >= 0:
+            start = text.rfind('\n', 0, i) + 1
+            if text[start:i].strip() == '':
+                end = text.find('\n', i)
+                parts.append(text[pos:start])
+                pos = len(text) if end < 0 else end
+                i = text.find('#', pos)
+            else:
+                i = text.find('#', i+1)
+        parts.append(text[pos:])
+        return (''.join(parts))
+
     def load(self, filename):
+        """
+        bulk parser, reads the complete file and decodes it with numpy. Each line must contain
+        exactly an unsigned index and 3 floats, otherwise the line parser is used
+        (so malformed lines are treated identically)
+        """
+        dtype = [('index','u4'),('vector','(3,)f4')]
+        try:
+            fd = open(filename, 'r', encoding='utf-8')
+        except:
+            return (False, None)
+        with fd:
+            text = self.stripComments(fd.read())
+        if text.strip() == '':
+            return (True, np.asarray([], dtype=dtype))
+        try:
+            return (True, np.loadtxt(StringIO(text), dtype=dtype, comments=None, ndmin=1))
+        except ValueError:
+            return (self.loadLines(filename))
+
+    def loadLines(self, filename):
         data = []
         dtype = [('index','u4'),('vector','(3,)f4')]
         try:
@@ -321,10 +386,213 @@ class TargetASCII():
                 data.append((vertIndex, translationVector))
             return(True, np.asarray(data, dtype=dtype))
 
+    def benchmark(self, path):
+        """
+        compare throughput of bulk and line parser on all targets of a folder
+        :return: list of [parser, files, MBytes, seconds, MBytes/s]
+        """
+        files = self.scanDir(path)
+        size = sum([os.path.getsize(f) for f in files]) / 1048576
+        result = []
+        for name, func in (("bulk", self.load), ("lines", self.loadLines)):
+            start = time.perf_counter()
+            for filename in files:
+                func(filename)
+            secs = time.perf_counter() - start
+            result.append([name, len(files), round(size, 2), round(secs, 3), round(size / secs, 2) if secs > 0 else 0])
+        return (result)
+
+    def toStructured(self, raw):
+        """
+        convert target data (npz-member or dictionary of a mapped store) to a structured array
+        """
+        if isinstance(raw, np.ndarray):
+            return (np.array(raw))
+        arr = np.empty(len(raw['index']), dtype=[('index','u4'),('vector','(3,)f4')])
+        arr['index'] = raw['index']
+        arr['vector'] = raw['vector']
+        return (arr)
+
     def saveCompressed(self, filename, content):
-        f = open(filename, "wb")
+        tmpfile = filename + ".tmp"
+        f = open(tmpfile, "wb")
         np.savez_compressed(f, **content)
         f.close()
+        os.replace(tmpfile, filename)
+
+    @staticmethod
+    def storeGeneration(filename):
+        """
+        generation of a store written by saveGeneration, None for a store without generation
+        (files named <filename><ext>), -1 if there is no valid pointer file
+        """
+        pointer = filename + ".json"
+        if not os.path.isfile(pointer):
+            return (None)
+        try:
+            with open(pointer, "r", encoding="utf-8") as f:
+                return (int(json.load(f)["generation"]))
+        except (OSError, ValueError, KeyError, TypeError):
+            return (-1)
+
+    @staticmethod
+    def storeFileName(filename, generation, ext):
+        if generation is None:
+            return (filename + ext)
+        return (filename + "." + str(generation) + ext)
+
+    def saveGeneration(self, filename, arrays):
+        """
+        save the arrays of a store as a new generation <filename>.<generation><ext>, then replace the pointer
+        file <filename>.json. A reader sees either the complete old or the complete new set and files opened
+        memory mapped are never replaced (not possible on Windows). Older generations are deleted, if possible.
+
+        :param arrays: list of (ext, array)
+        """
+        old = self.storeGeneration(filename)
+        generation = 1 if old is None or old < 0 else old + 1
+        for ext, arr in arrays:
+            tmpfile = self.storeFileName(filename, generation, ext) + ".tmp"
+            with open(tmpfile, "wb") as f:
+                np.save(f, arr)
+            os.replace(tmpfile, self.storeFileName(filename, generation, ext))
+
+        tmpfile = filename + ".json.tmp"
+        with open(tmpfile, "w", encoding="utf-8") as f:
+            json.dump({"generation": generation}, f)
+        os.replace(tmpfile, filename + ".json")
+
+        # remove old generations and files without generation, on Windows files still mapped will stay
+        #
+        folder = os.path.dirname(filename) or "."
+        prefix = os.path.basename(filename) + "."
+        exts = [ext for ext, arr in arrays]
+        for name in os.listdir(folder):
+            for ext in exts:
+                if name == prefix[:-1] + ext:
+                    old = True
+                elif name.startswith(prefix) and name.endswith(ext):
+                    middle = name[len(prefix):-len(ext)]
+                    old = middle.isdigit() and int(middle) != generation
+                else:
+                    old = False
+                if old:
+                    try:
+                        os.remove(os.path.join(folder, name))
+                    except OSError:
+                        pass
+
+    def saveMapped(self, filename, content):
+        """
+        save all targets uncompressed as one flat index array, one flat delta array and
+        a table with name, start of the deltas, start of the indices and number of entries per target.
+        Identical targets use the same entries, targets with the same vertex set the same indices.
+        The files are named <filename>.<generation>.index.npy, <filename>.<generation>.vector.npy and
+        <filename>.<generation>.table.npy, <filename>.json points to the current generation
+        """
+        names = sorted(content.keys())
+        maxlen = max([len(name) for name in names])
+        table = np.zeros(len(names), dtype=[('name', 'U' + str(maxlen)), ('start', 'u8'), ('count', 'u8'), ('istart', 'u8')])
+        table['name'] = names
+
+        # content hash of indices and of indices + deltas, identical arrays are only stored once
+        #
+        indexblocks = {}
+        vectorblocks = {}
+        indices = []
+        vectors = []
+        isize = 0
+        vsize = 0
+        for i, name in enumerate(names):
+            ind = np.ascontiguousarray(content[name]['index'], dtype=np.uint32)
+            vec = np.ascontiguousarray(content[name]['vector'], dtype=np.float32)
+            ikey = hashlib.sha1(ind.data).digest()
+            vkey = hashlib.sha1(ikey + vec.data).digest()
+            table['count'][i] = len(ind)
+            if ikey not in indexblocks:
+                indexblocks[ikey] = isize
+                indices.append(ind)
+                isize += len(ind)
+            table['istart'][i] = indexblocks[ikey]
+            if vkey not in vectorblocks:
+                vectorblocks[vkey] = vsize
+                vectors.append(vec)
+                vsize += len(vec)
+            table['start'][i] = vectorblocks[vkey]
+
+        index = np.concatenate(indices) if len(indices) > 0 else np.zeros(0, dtype=np.uint32)
+        vector = np.concatenate(vectors) if len(vectors) > 0 else np.zeros((0, 3), dtype=np.float32)
+        self.saveGeneration(filename, [(".index.npy", index), (".vector.npy", vector), (".table.npy", table)])
+
+    def saveQuantized(self, filename, content, quantize="int16"):
+        """
+        save all targets in a compact form, vectors as int16 or float16 with a scale per target (maximum
+        absolute value), sorted indices delta-encoded as uint16 (uint32 if a gap does not fit).
+        The files are named <filename>.<generation>.qindex.npy, <filename>.<generation>.qvector.npy and
+        <filename>.<generation>.qtable.npy, <filename>.json points to the current generation
+        """
+        names = sorted(content.keys())
+        counts = np.array([len(content[name]) for name in names], dtype=np.uint64)
+        starts = np.zeros(len(names), dtype=np.uint64)
+        if len(names) > 1:
+            np.cumsum(counts[:-1], out=starts[1:])
+        size = int(counts.sum())
+        maxlen = max([len(name) for name in names])
+
+        table = np.zeros(len(names), dtype=[('name', 'U' + str(maxlen)), ('start', 'u8'), ('count', 'u8'), ('scale', 'f4')])
+        table['name'] = names
+        table['start'] = starts
+        table['count'] = counts
+
+        index = np.empty(size, dtype=np.int64)
+        vector = np.empty((size, 3), dtype=np.int16 if quantize == "int16" else np.float16)
+        maxval = 32767.0 if quantize == "int16" else 1.0
+        for i, name in enumerate(names):
+            s = int(starts[i])
+            e = s + int(counts[i])
+            if e == s:
+                continue
+            idx = np.asarray(content[name]['index'], dtype=np.int64)
+            vec = np.asarray(content[name]['vector'], dtype=np.float32)
+            order = np.argsort(idx, kind='stable')
+            idx = idx[order]
+            vec = vec[order]
+            index[s] = idx[0]
+            index[s+1:e] = np.diff(idx)
+
+            scale = float(np.abs(vec).max()) / maxval
+            if scale == 0.0:
+                scale = 1.0
+            table['scale'][i] = scale
+            if quantize == "int16":
+                vector[s:e] = np.rint(vec / np.float32(scale))
+            else:
+                vector[s:e] = vec / np.float32(scale)
+
+        index = index.astype(np.uint16 if size == 0 or index.max() < 65536 else np.uint32)
+
+        self.saveGeneration(filename, [(".qindex.npy", index), (".qvector.npy", vector), (".qtable.npy", table)])
+
+    def verifyQuantized(self, sourcefolder, filename):
+        """
+        compare a quantized store against the float32 originals (ASCII targets)
+        :return: list of [name, maximum vertex error, indices identical], worst first
+        """
+        qt = QuantizedTargets(filename)
+        result = []
+        for name, arr in self.loadAllTargets(sourcefolder).items():
+            if name not in qt:
+                result.append([name, None, False])
+                continue
+            q = qt[name]
+            order = np.argsort(arr['index'], kind='stable')
+            same = np.array_equal(q['index'], arr['index'][order])
+            err = 0.0
+            if same and len(order) > 0:
+                err = float(np.sqrt(((q['vector'] - arr['vector'][order]) ** 2).sum(axis=1)).max())
+            result.append([name, err, same])
+        result.sort(key=lambda x: -1.0 if x[1] is None else x[1], reverse=True)
+        return (result)
 
     def scanDir(self, path):
         result = []
@@ -349,13 +617,233 @@ class TargetASCII():
                     content[name[:-7]] = arr
         return (content)
 
-    def compressAllTargets(self, sourcefolder, destfile, verbose=0):
-        content = self.loadAllTargets(sourcefolder, verbose)
-        if len(content) > 0:
+    def fileSignature(self, filename):
+        """
+        modification time, size and sha1 of a file
+        """
+        st = os.stat(filename)
+        with open(filename, "rb") as f:
+            sha1 = hashlib.sha1(f.read()).hexdigest()
+        return ({"mtime": st.st_mtime, "size": st.st_size, "sha1": sha1})
+
+    def loadManifest(self, filename):
+        if os.path.isfile(filename):
+            try:
+                with open(filename, "r", encoding="utf-8") as f:
+                    return (json.load(f))
+            except (OSError, json.JSONDecodeError):
+                pass
+        return ({})
+
+    def saveManifest(self, filename, manifest):
+        with open(filename, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=4, sort_keys=True)
+
+    def openStore(self, destfile, store="compressed", quantize=None):
+        """
+        open existing binary store, returns None if not existent
+        :param quantize: if set, a quantized store is only opened when using the same encoding
+        """
+        try:
+            if store == "mapped":
+                if MappedTargets.exists(destfile):
+                    return (MappedTargets(destfile))
+            elif store == "quantized":
+                if QuantizedTargets.exists(destfile):
+                    qt = QuantizedTargets(destfile)
+                    if quantize is None or qt.encoding() == quantize:
+                        return (qt)
+            elif os.path.isfile(destfile):
+                return (np.load(destfile))
+        except (OSError, ValueError):
+            pass
+        return (None)
+
+    def parseTargets(self, filenames, processes=None):
+        """
+        parse ASCII targets, in a process pool if there is more than one file
+        :return: list of (res, array) in the order of the filenames
+        """
+        if processes is None:
+            processes = os.cpu_count() or 1
+        processes = min(processes, len(filenames))
+        if processes < 2:
+            return ([self.load(filename) for filename in filenames])
+
+        ctx = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=processes, mp_context=ctx) as pool:
+            return (list(pool.map(loadTargetFile, filenames, chunksize=16)))
+
+    def compressAllTargets(self, sourcefolder, destfile, verbose=0, store="compressed", processes=None, quantize="int16"):
+        """
+        compile all targets of a folder into a binary store. A manifest (mtime, size, sha1 per source)
+        is kept beside the store, targets of unchanged sources are taken from the existing store,
+        only changed or new targets are parsed (in a process pool).
+
+        :param store: compressed (npz), mapped (memory mappable) or quantized, the latter are using destfile as a prefix
+        :param processes: number of processes, None = number of cpus
+        :param quantize: int16 or float16 for quantized store
+        :return: dictionary with number of parsed, reused and removed targets
+        """
+        manifestfile = os.path.splitext(destfile)[0] + ".manifest.json" if store == "compressed" else destfile + ".manifest.json"
+        oldmanifest = self.loadManifest(manifestfile)
+        kind = store
+        store = self.openStore(destfile, kind, quantize) if len(oldmanifest) > 0 else None
+
+        manifest = {}
+        content = {}
+        toparse = []
+        l = len(sourcefolder)
+        for filename in self.scanDir(sourcefolder):
+            if not filename.startswith(sourcefolder):
+                continue
+            name = filename[l+1:-7]
+            st = os.stat(filename)
+            old = oldmanifest.get(name)
+            if store is not None and old is not None and name in store.files:
+                if old["mtime"] == st.st_mtime and old["size"] == st.st_size:
+                    manifest[name] = old
+                    content[name] = self.toStructured(store[name])
+                    continue
+                sig = self.fileSignature(filename)
+                if sig["sha1"] == old["sha1"]:
+                    manifest[name] = sig
+                    content[name] = self.toStructured(store[name])
+                    continue
+            toparse.append((name, filename))
+
+        stats = {"parsed": len(toparse), "reused": len(content),
+                "removed": len([name for name in oldmanifest if name not in manifest and name not in dict(toparse)])}
+
+        for (name, filename), (res, arr) in zip(toparse, self.parseTargets([f for (n, f) in toparse], processes)):
             if verbose > 0:
-                print ("save compressed: " + destfile)
-            self.saveCompressed(destfile, content)
+                print ("loaded: " + filename)
+            if res is True:
+                content[name] = arr
+                manifest[name] = self.fileSignature(filename)
+
+        changed = store is None or stats["parsed"] > 0 or stats["removed"] > 0
+        store = None
+        if len(content) > 0:
+            if changed:
+                if kind == "mapped":
+                    if verbose > 0:
+                        print ("save mapped: " + destfile)
+                    self.saveMapped(destfile, content)
+                elif kind == "quantized":
+                    if verbose > 0:
+                        print ("save quantized (" + quantize + "): " + destfile)
+                    self.saveQuantized(destfile, content, quantize)
+                else:
+                    if verbose > 0:
+                        print ("save compressed: " + destfile)
+                    self.saveCompressed(destfile, content)
+            elif verbose > 0:
+                print ("No changes for: " + destfile)
+            if changed or manifest != oldmanifest:
+                self.saveManifest(manifestfile, manifest)
         else:
             if verbose > 0:
                 print ("No content for: " + destfile)
+        if verbose > 0:
+            print ("Targets parsed: " + str(stats["parsed"]) + ", reused: " + str(stats["reused"]) + ", removed: " + str(stats["removed"]))
+        return (stats)
+
+
+def loadTargetFile(filename):
+    """
+    parse a single ASCII target, used by process pool
+    """
+    return (TargetASCII().load(filename))
+
+
+class MappedTargets():
+    """
+    uncompressed target store, the arrays are opened memory mapped, so each target
+    is a zero-copy slice, pages are only read when a target is really used.
+    Supports the part of the npz-interface used for targets (files and [name])
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        gen = TargetASCII.storeGeneration(filename)
+        self.table = np.load(TargetASCII.storeFileName(filename, gen, ".table.npy"))
+        self.index = np.load(TargetASCII.storeFileName(filename, gen, ".index.npy"), mmap_mode='r')
+        self.vector = np.load(TargetASCII.storeFileName(filename, gen, ".vector.npy"), mmap_mode='r')
+        # stores without shared indices have no istart
+        #
+        istarts = self.table['istart'] if 'istart' in self.table.dtype.names else self.table['start']
+        self.offsets = {}
+        for elem, istart in zip(self.table, istarts):
+            start = int(elem['start'])
+            count = int(elem['count'])
+            self.offsets[str(elem['name'])] = (start, start + count, int(istart), int(istart) + count)
+        self.files = list(self.offsets.keys())
+
+        # table and arrays must belong together
+        #
+        vsize = int((self.table['start'] + self.table['count']).max()) if len(self.table) > 0 else 0
+        isize = int((istarts + self.table['count']).max()) if len(self.table) > 0 else 0
+        if vsize != len(self.vector) or isize != len(self.index):
+            raise ValueError("Mapped target store " + filename + " is inconsistent")
+
+    def __str__(self):
+        return ("MappedTargets: " + self.filename + ", " + str(len(self.files)) + " targets")
+
+    @staticmethod
+    def exists(filename):
+        gen = TargetASCII.storeGeneration(filename)
+        for ext in (".table.npy", ".index.npy", ".vector.npy"):
+            if not os.path.isfile(TargetASCII.storeFileName(filename, gen, ext)):
+                return False
+        return True
+
+    def __contains__(self, name):
+        return name in self.offsets
+
+    def __getitem__(self, name):
+        (s, e, si, ei) = self.offsets[name]
+        return {'index': self.index[si:ei], 'vector': self.vector[s:e]}
+
+
+class QuantizedTargets():
+    """
+    compact target store (int16 or float16 vectors with a scale per target, delta encoded indices).
+    The arrays are opened memory mapped, a target is decoded to float32 when it is loaded.
+    Supports the part of the npz-interface used for targets (files and [name])
+    """
 
+    def __init__(self, filename):
+        self.filename = filename
+        gen = TargetASCII.storeGeneration(filename)
+        self.table = np.load(TargetASCII.storeFileName(filename, gen, ".qtable.npy"))
+        self.index = np.load(TargetASCII.storeFileName(filename, gen, ".qindex.npy"), mmap_mode='r')
+        self.vector = np.load(TargetASCII.storeFileName(filename, gen, ".qvector.npy"), mmap_mode='r')
+        self.offsets = {}
+        for i, elem in enumerate(self.table):
+            start = int(elem['start'])
+            self.offsets[str(elem['name'])] = (start, start + int(elem['count']), i)
+        self.files = list(self.offsets.keys())
+
+    def __str__(self):
+        return ("QuantizedTargets: " + self.filename + ", " + str(len(self.files)) + " targets, " + self.encoding())
+
+    @staticmethod
+    def exists(filename):
+        gen = TargetASCII.storeGeneration(filename)
+        for ext in (".qtable.npy", ".qindex.npy", ".qvector.npy"):
+            if not os.path.isfile(TargetASCII.storeFileName(filename, gen, ext)):
+                return False
+        return True
+
+    def encoding(self):
+        return ("int16" if self.vector.dtype == np.int16 else "float16")
+
+    def __contains__(self, name):
+        return name in self.offsets
+
+    def __getitem__(self, name):
+        (s, e, i) = self.offsets[name]
+        index = np.cumsum(self.index[s:e], dtype=np.uint32)
+        vector = self.vector[s:e].astype(np.float32) * self.table['scale'][i]
+        return {'index': index, 'vector': vector}
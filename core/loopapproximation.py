@@ -3,8 +3,16 @@
     Author: black-punkduck
 
     Classes:
+    * SubdivisionStencil
+    * MeshArrays
     * LoopApproximation
 
+    Functions:
+    * createSubdividedObject
+    * subdivisionJob
+    * subdivisionStencil
+    * createStencils
+
 realization of loop subdivision algorithm, invented by Charles Loop
 
 loop algorithm only works with triangles
@@ -23,12 +31,202 @@ Algorithm (one iteration)
 4. Compute even vertices
 5. Rebuild mesh / Connect vertices to create new faces
 
+Steps 3 and 4 only depend on the topology, so they are calculated once as weights (stencil)
+of the coarse vertices for each fine vertex. Evaluating the stencil for new coordinates
+(morph, pose) is a sparse matrix-vector product.
 """
 
 import math
 import numpy as np
+from concurrent.futures import wait, FIRST_COMPLETED
 from core.debug import measureTime
 from obj3d.object3d import object3d
+from obj3d.adjacency import MeshAdjacency
+
+class SubdivisionStencil:
+    """
+    sparse matrix from coarse to fine vertices (CSR: offsets per fine vertex, coarse vertices, weights),
+    together with the index buffer, uv coordinates and overflow table of the fine mesh.
+    Stencils of two subdivisions can be composed to one.
+    """
+    def __init__(self, numcoarse, rows, cols, weights, indices, uvs, overflow, numregular):
+        self.numcoarse = numcoarse      # number of coarse vertices (including overflow)
+        self.numregular = numregular    # number of fine vertices without overflow
+        self.numfine = len(uvs)         # number of fine vertices (including overflow)
+        self.indices = indices          # index buffer of fine mesh
+        self.uvs = uvs                  # uv coordinates of fine mesh [numfine, 2]
+        self.overflow = overflow        # overflow table of fine mesh [source, dest]
+
+        order = np.argsort(rows, kind='stable')
+        self.cols = np.asarray(cols, dtype=np.intp)[order]
+        self.weights = np.asarray(weights, dtype=np.float32)[order]
+        counts = np.bincount(rows, minlength=self.numfine)
+        self.offsets = np.zeros(self.numfine + 1, dtype=np.intp)
+        np.cumsum(counts, out=self.offsets[1:])
+
+    def __str__(self):
+        return ("SubdivisionStencil: " + str(self.numcoarse) + " -> " + str(self.numfine) + " vertices, " +
+                str(len(self.cols)) + " weights")
+
+    def rows(self):
+        return (np.repeat(np.arange(self.numfine), np.diff(self.offsets)))
+
+    def evaluate(self, coarse, out=None):
+        """
+        calculate fine coordinates from coarse coordinates
+
+        :param coarse: flat coordinate buffer of the coarse mesh (gl_coord)
+        :param out: optional flat result buffer (gl_coord of the fine mesh)
+        :return: flat fine coordinates
+        """
+        if out is None:
+            out = np.zeros(self.numfine * 3, dtype=np.float32)
+        c = np.reshape(coarse, (-1, 3))
+        weighted = c[self.cols] * self.weights[:,None]
+        np.add.reduceat(weighted, self.offsets[:-1], axis=0, out=np.reshape(out[:self.numfine*3], (self.numfine, 3)))
+        return (out)
+
+    def compose(self, inner):
+        """
+        stencil for two subdivisions: coarse mesh -> inner stencil -> this stencil
+
+        :param inner: stencil creating the coarse mesh of this stencil
+        :return: new stencil with the fine mesh (indices, uvs, overflow) of this stencil
+        """
+        counts = np.diff(inner.offsets)[self.cols]
+        starts = inner.offsets[self.cols]
+        index = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        rows = np.repeat(self.rows(), counts)
+        cols = inner.cols[index]
+        weights = np.repeat(self.weights.astype(np.float64), counts) * inner.weights[index]
+
+        # sum up weights of identical coarse vertices per row
+        #
+        (keys, inverse) = np.unique(rows * inner.numcoarse + cols, return_inverse=True)
+        weights = np.bincount(inverse, weights=weights)
+        return (SubdivisionStencil(inner.numcoarse, keys // inner.numcoarse, keys % inner.numcoarse, weights,
+                self.indices, self.uvs, self.overflow, self.numregular))
+
+    def createArrays(self, name, coarse):
+        """
+        fine mesh as flat arrays (without normals)
+
+        :param name: name of the mesh
+        :param coarse: flat coordinate buffer of the coarse mesh
+        """
+        return (MeshArrays(name, self.evaluate(coarse), self.indices.copy(), self.uvs.flatten(), self.overflow, self.numregular))
+
+    def createObject(self, glob, obj, coarse):
+        """
+        create the fine mesh
+
+        :param obj: coarse object3d (material, names etc. are copied)
+        :param coarse: flat coordinate buffer of the coarse mesh
+        """
+        return (createSubdividedObject(glob, obj, self.createArrays(obj.name, coarse)))
+
+
+class MeshArrays:
+    """
+    flat arrays of a triangle mesh, enough to subdivide it (and to send it to another process)
+    """
+    def __init__(self, name, coord, indices, uvs, overflow, numregular):
+        self.name = name
+        self.gl_coord = coord
+        self.gl_icoord = indices
+        self.gl_uvcoord = uvs
+        self.overflow = overflow
+        self.n_origverts = numregular
+
+    def __str__(self):
+        return ("MeshArrays: " + self.name + ", " + str(len(self.gl_coord) // 3) + " vertices, " + str(len(self.gl_icoord) // 3) + " faces")
+
+    def getOpenGLIndex(self):
+        return (self.gl_icoord)
+
+
+def createSubdividedObject(glob, obj, arrays):
+    """
+    create an object3d from the subdivided arrays, calculates normals
+
+    :param obj: coarse object3d (material, names etc. are copied)
+    :param arrays: MeshArrays of the subdivided mesh
+    """
+    subdiv = object3d(glob, None, obj.type)
+    subdiv.visible = obj.visible
+    subdiv.is_base = obj.is_base
+    subdiv.material = obj.material
+    subdiv.z_depth = obj.z_depth
+    subdiv.name = obj.name
+    subdiv.filename = "subdiv of " + obj.name
+
+    subdiv.gl_coord = arrays.gl_coord
+    subdiv.n_verts = len(arrays.gl_coord) // 3
+    subdiv.coord = np.reshape(subdiv.gl_coord, (subdiv.n_verts, 3))
+    subdiv.n_origverts = subdiv.n_verts
+    subdiv.gl_icoord= arrays.gl_icoord
+    subdiv.gl_uvcoord=arrays.gl_uvcoord
+    subdiv.fverts=np.reshape(subdiv.gl_icoord, (-1,3))
+    subdiv.n_fverts = len(subdiv.gl_icoord)//3
+    subdiv.overflow = arrays.overflow
+    subdiv.calcNormals()
+    subdiv.min_index = None
+    return (subdiv)
+
+def subdivisionJob(obj, level=1):
+    """
+    job for subdivisionStencil, arrays of the visible part of an object
+
+    :param obj: object3d
+    """
+    return (MeshArrays(obj.name, obj.gl_coord, obj.getOpenGLIndex(), obj.gl_uvcoord, obj.overflow, obj.n_origverts), level)
+
+def subdivisionStencil(job):
+    """
+    stencil of one mesh, runs in a worker process
+
+    :param job: (MeshArrays, level)
+    :return: SubdivisionStencil
+    """
+    (arrays, level) = job
+    return (LoopApproximation(None, arrays).createStencil(level))
+
+def createStencils(jobs, pool=None, progress=None, cancel=None):
+    """
+    stencils of independent meshes, in a pool (process pool executor) if given
+
+    :param jobs: list of jobs created by subdivisionJob
+    :param progress: function called with number of finished meshes and name of the last one
+    :param cancel: function returning True to stop
+    :return: list of SubdivisionStencil in the order of the jobs, None if canceled
+    """
+    results = [None] * len(jobs)
+    if pool is None:
+        for i, job in enumerate(jobs):
+            if cancel is not None and cancel():
+                return (None)
+            results[i] = subdivisionStencil(job)
+            if progress is not None:
+                progress(i + 1, job[0].name)
+        return (results)
+
+    futures = {pool.submit(subdivisionStencil, job): i for i, job in enumerate(jobs)}
+    pending = set(futures)
+    done = 0
+    while pending:
+        (finished, pending) = wait(pending, timeout=0.1, return_when=FIRST_COMPLETED)
+        if cancel is not None and cancel():
+            for future in pending:
+                future.cancel()
+            return (None)
+        for future in finished:
+            i = futures[future]
+            results[i] = future.result()
+            done += 1
+            if progress is not None:
+                progress(done, jobs[i][0].name)
+    return (results)
+
 
 class LoopApproximation:
     def __init__(self, glob, obj):
@@ -38,18 +236,14 @@ class LoopApproximation:
         self.maxmesh = self.obj.n_origverts
         self.glob = glob
         self.org_uvs = None
-        self.org_coords = None
-        self.adjacent_even = {}
-        self.adjacent_odd = {}
-        self.facesAttached = {}
-        self.edgesAttached = {}
+        self.adjacency = None           # edges, faces per edge and border neighbours (MeshAdjacency)
+        self.adjacent_even = None       # neighbours of even vertices (CSR: offsets, vertices)
+        self.adjacent_odd = None        # opposite vertex per edge of a face, -1 for boundary
         self.border = None
-        self.evenVertsNew = None        # array filled with -1 at start, later contains position of newly created vertex
-        self.ncoords = None             # new coordinates
-        self.nuvs = None                # new uv coordinates
-        self.indices = None             # new indices for drawarray
-        self.overflow = {}
-        self.seam = {}
+        self.seam = None                # bool per vertex, True if vertex is source of an overflow (uv seam)
+        self.stencil = None             # stencil from coarse to fine mesh
+        self.source = None              # index buffer used to create the stencil
+        self.level = None               # number of subdivisions of the stencil
 
     def createBetas(self, maxn):
         """
@@ -61,189 +255,113 @@ class LoopApproximation:
             m *= m
             self.beta.append(1.0 / float(k) * (0.625 - m))
 
-    def calcNeighboursEven(self, faceverts):
+    def calcNeighboursEven(self):
         """
-        create neighbours of even vertices
-        for each face which is attached to a vertex check all other faces if that vertex is also
-        contained, if so add these vertices, make them unique and do not add the same vertex again
+        create neighbours of even vertices: all other vertices of the faces attached to a vertex,
+        unique and in order of appearance
         """
+        self.adjacent_even = self.adjacency.evenNeighbours()
+        counts = np.diff(self.adjacent_even[0])
+        return(int(counts.max()) if len(counts) > 0 else 0)
 
-        maxn = 0
-        for vert, faces in self.facesAttached.items():
-            adjacentverts = []
-            for face in faces:
-                for nvert in faceverts[face]:
-                    if nvert != vert and nvert not in adjacentverts:
-                        adjacentverts.append(nvert)
-            if len(adjacentverts) > maxn:
-                maxn = len(adjacentverts)
-            self.adjacent_even[vert] = adjacentverts
-        return(maxn)
-
-    def calcNeighboursOdd(self, faceverts):
+    def calcNeighboursOdd(self):
         """
-        for each face (triangle) check the edges and test to which other face both vertices of
-        the edge also contained. If a common edge is found and it is not the same, figure out
-        the missing vertex of the neighbour triangle, set -1 for missing vertex (boundary)
+        for each edge of a face (triangle) get the missing vertex of the neighbour triangle
+        sharing that edge, -1 for missing vertex (boundary)
         """
+        self.adjacent_odd = self.adjacency.oppositeVerts()
 
-        iplus = [1, 2, 0]
-        for fIndex, face in enumerate(faceverts):
-            self.adjacent_odd[fIndex] = [-1, -1, -1]
-            for i in range(0,3):
-                j = iplus[i]            # index + 1
-                if face[i] > face[j]:
-                    v1, v2 = face[j], face[i]
-                else:
-                    v1, v2 = face[i], face[j]
-
-                nface = self.edgesAttached[v1][v2][0]
-                if nface == fIndex:
-                    if self.edgesAttached[v1][v2][1] < 0:
-                        continue
-                    nface = self.edgesAttached[v1][v2][1]
-
-                for nv in faceverts[nface]:
-                    if nv != v1 and nv != v2:
-                        self.adjacent_odd[fIndex][i] = nv
-                        break
+    def createFineVertices(self, faceverts, uvverts):
+        """
+        number the fine vertices like the former loop over faces did: per face the odd vertices of the 3 edges,
+        then the 3 even vertices, a vertex is created when its edge or vertex appears first
 
-    def createSubTriangles(self, faceverts, uvvertsarr):
+        :return: fine vertex per event [faces, 6], face and slot (0-2 odd, 3-5 even) of the first event per fine vertex
+        """
+        nedges = len(self.adjacency.edges)
+        keys = np.concatenate((self.adjacency.faceEdges, faceverts + nedges), axis=1).ravel()
+        (ukeys, first, inverse) = np.unique(keys, return_index=True, return_inverse=True)
+        order = np.argsort(first)
+        rank = np.empty(len(ukeys), dtype=np.intp)
+        rank[order] = np.arange(len(ukeys))
+        first = first[order]
+        return (rank[inverse].reshape(-1, 6), first // 6, first % 6)
+
+    def createOddWeights(self, faceverts, rows, faces, corners):
+        """
+        odd vertices: interior 3/8 for the edge, 1/8 for the opposite vertices, boundary 1/2 for the edge
+        """
+        a = faceverts[faces, corners]
+        b = faceverts[faces, (corners + 1) % 3]
+        c = faceverts[faces, (corners + 2) % 3]
+        d = self.adjacent_odd[faces, corners]
+        inner = d != -1
+        ri = rows[inner]
+        rb = rows[~inner]
+        rows = np.concatenate((ri, ri, ri, ri, rb, rb))
+        cols = np.concatenate((a[inner], b[inner], c[inner], d[inner], a[~inner], b[~inner]))
+        weights = np.concatenate((np.full(len(ri) * 2, 0.375), np.full(len(ri) * 2, 0.125), np.full(len(rb) * 2, 0.5)))
+        return (rows, cols, weights)
+
+    def createEvenWeights(self, rows, verts):
+        """
+        even vertices: border 3/4 and 1/8 for both border neighbours, otherwise (1 - k * beta) and beta for the k neighbours
         """
-        calculate 4 sub triangles (atm only vertices)
-        (coords array like in object3d.py)
+        border = self.border[verts, 1] != 0xffffffff
+        rb = rows[border]
+        vb = verts[border]
+
+        ri = rows[~border]
+        vi = verts[~border]
+        (offsets, neighbours) = self.adjacent_even
+        counts = offsets[vi+1] - offsets[vi]
+        beta = np.asarray(self.beta, dtype=np.float64)[counts]
+        index = np.repeat(offsets[vi] - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+
+        rows = np.concatenate((rb, rb, rb, ri, np.repeat(ri, counts)))
+        cols = np.concatenate((vb, self.border[vb, 0], self.border[vb, 1], vi, neighbours[index]))
+        weights = np.concatenate((np.full(len(rb), 0.75), np.full(len(rb) * 2, 0.125), 1 - counts * beta, np.repeat(beta, counts)))
+        return (rows, cols, weights)
+
+    def createOverflow(self, faceverts, uvverts, fine, uvs):
         """
+        uv seams need additional vertices: an edge between two seam vertices gets one per pair of uv vertices,
+        an even vertex one per uv vertex of the overflow. They are numbered in order of appearance.
 
-        uvs = self.org_uvs
-        coords = self.org_coords
-        maxmesh = self.maxmesh
-        evenIndex = [0, 0, 0]
-        oddIndex = [0, 0, 0]
-        ncount = 0
-        icount = 0
-        ovcount = 0
-        iplus = [1, 2, 0]
-        jplus = [2, 0, 1]
-
-        for fIndex in range(0, len(faceverts)):
-            verts = faceverts[fIndex]
-            uvverts = uvvertsarr[fIndex]
-
-            # The odd vertices are the new ones
-            #
-            a_odd = self.adjacent_odd[fIndex]
-            for i in range(0,3):
-                j = iplus[i]    # index +1
-                k = jplus[i]    # index +2
-                v1, v2, = verts[i], verts[j]
-                a, b = coords[v1], coords[v2]
-
-                # UVS
-                w1, w2 = uvverts[i], uvverts[j]
-                un = 0.5 * (uvs[w1]+ uvs[w2]) # new value
-
-                if v1 > v2:
-                    v1, v2 = v2, v1
-
-                if self.edgesAttached[v1][v2][2] is None:
-                    if a_odd[i] != -1:
-                        # not a boundary, so calculate interior vertex
-                        #
-                        c = coords[verts[k]]
-                        d = coords[a_odd[i]]
-                        v = 0.375 *( a + b)+  0.125 *(c + d)
-                    else:
-                        # calculate on boundary
-                        #
-                        v = 0.5 * (a + b)
-                    self.edgesAttached[v1][v2][2] = ncount
-                    oddIndex[i] = ncount
-
-                    # coordinate + uv
-                    #
-                    self.ncoords[ncount] = v
-                    self.nuvs[ncount] =  un
-                    ncount += 1
-
-                else:
-                    oddIndex[i] = self.edgesAttached[v1][v2][2]
-
-                # calculate UVs for seams
-                #
-                if v1 in self.seam and v2 in self.seam:
-                    if w1 > w2:
-                        w1, w2 = w2, w1
-
-                    uvn = (w1,w2)
-                    if uvn not in self.overflow:
-                        ni = 0x80000000 + ovcount
-                        ovcount += 1
-                        self.overflow[uvn] = [ oddIndex[i], ni, un ]
-                        oddIndex[i] = ni
-                    else:
-                        oddIndex[i] = self.overflow[uvn][1]
-
-            # the even ones should replace the orignal vertices
-            # edge-vertex: two edges are border
-            #
-
-            for i in range(0,3):
-                vi = verts[i]
-                v1 = coords[vi]
-                uvn = uvverts[i]
-                un = uvs[uvn]
-                if self.evenVertsNew[vi] == -1:
-
-                    if self.border[vi][1] != 0xffffffff:
-                        # in case of border get the border neighbours
-                        #
-                        vn = 0.125 *(coords[self.border[vi][0]] + coords[self.border[vi][1]]) + 0.75 * v1
-                    else:
-                        adj = self.adjacent_even[vi]
-                        k = len(adj)
-                        beta = self.beta[k]
-                        sumk = coords[adj[0]].copy()
-
-                        for elem in adj[1:]:
-                            sumk+=coords[elem]
-                        vn = v1 *(1-k*beta) + sumk *beta
-    
-                    self.ncoords[ncount] = vn
-                    self.evenVertsNew[verts[i]] = ncount
-                    evenIndex[i] = ncount
-                    # UVS
-                    self.nuvs[ncount] =  un
-                    ncount += 1
-                else:
-                    evenIndex[i] = self.evenVertsNew[vi]
-
-                if uvn >= maxmesh:
-
-                    # happens when a second UV value is needed because of a seam
-                    #
-                    if uvn not in self.overflow:
-                        ni = 0x80000000 + ovcount
-                        ovcount += 1
-                        self.overflow[uvn] = [ evenIndex[i], ni, un ]
-                        evenIndex[i] = ni
-                    else:
-                        evenIndex[i] = self.overflow[uvn][1]
-
-
-            # now create opengl index for these 4 new triangles
-            #
-            self.indices[icount:icount+12] = [
-                evenIndex[0], oddIndex[0], oddIndex[2],
-                oddIndex[0], evenIndex[1], oddIndex[1],
-                oddIndex[1], evenIndex[2], oddIndex[2],
-                oddIndex[0], oddIndex[1], oddIndex[2]
-            ]
-            icount += 12
-
-        return ncount, icount
+        :return: index per event (fine vertex or overflow number), source fine vertex and uv per overflow entry
+        """
+        numuvs = len(uvs)
+        w1 = uvverts
+        w2 = np.roll(uvverts, -1, axis=1)
+        seamedge = self.seam[faceverts] & self.seam[np.roll(faceverts, -1, axis=1)]
+        oddkeys = np.where(seamedge, np.minimum(w1, w2) * numuvs + np.maximum(w1, w2), -1)
+        evenkeys = np.where(uvverts >= self.maxmesh, numuvs * numuvs + uvverts, -1)
+        keys = np.concatenate((oddkeys, evenkeys), axis=1).ravel()
+        events = np.flatnonzero(keys >= 0)
+
+        (ukeys, first, inverse) = np.unique(keys[events], return_index=True, return_inverse=True)
+        order = np.argsort(first)
+        rank = np.empty(len(ukeys), dtype=np.intp)
+        rank[order] = np.arange(len(ukeys))
+        first = events[first[order]]
+
+        # uv of the overflow: middle of the edge or uv of the vertex
+        #
+        faces = first // 6
+        slots = first % 6
+        corners = slots % 3
+        odd = slots < 3
+        uv1 = uvs[uvverts[faces, corners]]
+        uv2 = uvs[uvverts[faces, (corners + 1) % 3]]
+        ovuvs = np.where(odd[:,None], 0.5 * (uv1 + uv2), uv1)
+
+        index = fine.ravel().copy()
+        sources = index[first]
+        index[events] = len(np.unique(fine)) + rank[inverse]
+        return (index.reshape(-1, 6), sources, ovuvs)
 
     def deDupFaceVerts(self):
-        # 
+        #
         # create a reduced mesh, when hidden
         # regenerate the overflow in a second mesh
         #
@@ -253,113 +371,129 @@ class LoopApproximation:
 
         indices = self.obj.getOpenGLIndex()
         ilen= len(indices) // 3
-        fverts = indices.copy().reshape((ilen, 3))
-        uvverts = fverts.copy()
-
-        for elem in fverts:
-            for i,v in enumerate(elem):
-                if v >= mx:
-                    elem[i] = ov[v-mx][0]
+        uvverts = indices.reshape((ilen, 3)).astype(np.intp)
+        fverts = uvverts.copy()
+        mask = fverts >= mx
+        fverts[mask] = ov[fverts[mask]-mx, 0]
         return fverts, uvverts
 
     def markSeam(self):
-        for s,d in self.obj.overflow:
-            self.seam[s] = True
-
-    def doCalculation(self):
-
-        # prepare algorithm, reshape coords to vectors and get a new index to mark the calculated indices
-        # for hidden vertices, partly coords and uv-coords are not used
-
-        print ("Subdividing " + self.obj.name)
-        m = measureTime("subdivision")
-
-        clen = len(self.obj.gl_coord) // 3
-        self.org_coords = np.reshape(self.obj.gl_coord , (clen,3))  # coordinates are including overflow
+        self.seam = np.zeros(self.maxmesh, dtype=bool)
+        if len(self.obj.overflow) > 0:
+            self.seam[self.obj.overflow[:,0]] = True
 
+    def buildStencil(self):
+        """
+        one subdivision of the object as stencil, only topology and uvs are used
+        """
+        m = measureTime("stencil")
         faceverts, uvverts = self.deDupFaceVerts()
         self.markSeam()
 
         ulen = len(self.obj.gl_uvcoord) // 2
         self.org_uvs = np.reshape(self.obj.gl_uvcoord , (ulen,2))
 
-        # helper for even vertices, which contains positions in new array
-        #
-        self.evenVertsNew = np.full(clen, -1,  dtype=np.int32)
-
-        # new coordinates (maximum is double size)
-        # new index array (4 triangles instead of one, so 4 times obj.n_fverts
-        #
-        self.ncoords = np.zeros((clen*4, 3), dtype=np.float32)
-        self.nuvs    = np.zeros((ulen*4, 2), dtype=np.float32)
-        self.indices = np.zeros(self.obj.n_fverts * 4, dtype=np.uint32)
-
-        # get attached faces, edges and border-neighbours for each vertex
+        # get edges, attached faces and border-neighbours for each vertex
         #
-        self.facesAttached, self.edgesAttached, self.border = self.obj.calculateAttachedGeom(faceverts)
+        self.adjacency = MeshAdjacency(faceverts, self.maxmesh)
+        self.border = self.adjacency.border
         m.passed("attached geometry calculated")
 
         # calculate even and odd neighbours
         #
-        maxn = self.calcNeighboursEven(faceverts)
-        self.calcNeighboursOdd(faceverts)
+        maxn = self.calcNeighboursEven()
+        self.calcNeighboursOdd()
         m.passed("even and odd face vertices calculated")
 
         # number of max. connected vertices will form betas
         #
         self.createBetas(maxn)
 
-        # foreach triangle now 4 triangles are created
+        # fine vertices and their weights, odd vertices (slots 0-2) and even vertices (3-5)
         #
-        ncount, icount = self.createSubTriangles(faceverts, uvverts)
-        m.passed("sub triangles calculated")
-
-        # reduce to size including UV buffer
+        (fine, faces, slots) = self.createFineVertices(faceverts, uvverts)
+        ncount = len(faces)
+        rows = np.arange(ncount)
+        odd = slots < 3
+        (r1, c1, w1) = self.createOddWeights(faceverts, rows[odd], faces[odd], slots[odd])
+        (r2, c2, w2) = self.createEvenWeights(rows[~odd], faceverts[faces[~odd], slots[~odd] - 3])
+
+        # uvs of fine vertices
         #
-        numextra = len(self.overflow)
-
-        self.ncoords = np.resize(self.ncoords, (ncount + numextra, 3))
-        self.nuvs = np.resize(self.nuvs, (ncount + numextra, 2))
-        self.indices = np.resize(self.indices, (icount))
+        uvs = self.org_uvs
+        fcorners = slots % 3
+        uv1 = uvs[uvverts[faces, fcorners]]
+        uv2 = uvs[uvverts[faces, (fcorners + 1) % 3]]
+        nuvs = np.where(odd[:,None], 0.5 * (uv1 + uv2), uv1)
 
-        # create overflow-table, add missing UVs  and duplicate coordinates
+        # overflow for seams, copies of their sources
         #
+        (index, sources, ovuvs) = self.createOverflow(faceverts, uvverts, fine, uvs)
+        numextra = len(sources)
         overflowtable = np.empty((numextra, 2), dtype=np.uint32)
-        nind = ncount 
+        overflowtable[:,0] = sources
+        overflowtable[:,1] = np.arange(ncount, ncount + numextra)
+
+        rows = np.concatenate((r1, r2))
+        cols = np.concatenate((c1, c2))
+        weights = np.concatenate((w1, w2))
+        order = np.argsort(rows, kind='stable')
+        starts = np.searchsorted(rows[order], sources)
+        counts = np.searchsorted(rows[order], sources, side='right') - starts
+        copy = order[np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())]
+        rows = np.concatenate((rows, np.repeat(overflowtable[:,1].astype(np.intp), counts)))
+        cols = np.concatenate((cols, cols[copy]))
+        weights = np.concatenate((weights, weights[copy]))
+
+        # now create opengl index for these 4 new triangles
+        # index per face: odd vertices 0-2, even vertices 3-5
+        #
+        tri = np.array([3, 0, 2,  0, 4, 1,  1, 5, 2,  0, 1, 2])
+        indices = index[:,tri].ravel().astype(np.uint32)
 
-        for oind, ind, uv in self.overflow.values():
-            overflowtable[ind - 0x80000000] = [ oind , nind]
-            self.nuvs[nind] = uv
-            self.ncoords[nind] = self.ncoords[oind]
-            nind += 1
+        m.passed("stencil calculated")
+        return (SubdivisionStencil(len(self.obj.gl_coord) // 3, rows, cols, weights, indices,
+                np.concatenate((nuvs, ovuvs)).astype(np.float32), overflowtable, ncount))
 
-        # correct indices marked by first bit
-        #
-        for i, n in enumerate(self.indices):
-            if n >=  0x80000000:
-                self.indices[i] = ncount + n - 0x80000000
-        #
-        # create the new object, TODO better "new" function needed
-
-        subdiv = object3d(self.glob, None, self.obj.type)
-        subdiv.visible = self.obj.visible
-        subdiv.is_base = self.obj.is_base
-        subdiv.material = self.obj.material
-        subdiv.z_depth = self.obj.z_depth
-        subdiv.name = self.obj.name
-        subdiv.filename = "subdiv of " + self.obj.name
-
-        subdiv.coord = self.ncoords
-        subdiv.n_verts = len(self.ncoords)
-        subdiv.n_origverts = subdiv.n_verts 
-        subdiv.gl_coord = self.ncoords.flatten()
-        subdiv.gl_icoord= self.indices
-        subdiv.gl_uvcoord=self.nuvs.flatten()
-        subdiv.fverts=np.reshape(self.indices, (icount//3,3))
-        subdiv.n_fverts = icount//3
-        subdiv.overflow = overflowtable
-        subdiv.calcNormals()
-        subdiv.min_index = None
+    def createStencil(self, level=1):
+        """
+        stencil for one or two subdivisions, the second one is composed
+        """
+        stencil = self.buildStencil()
+        if level > 1:
+            mid = stencil.createArrays(self.obj.name, self.obj.gl_coord)
+            stencil = LoopApproximation(self.glob, mid).createStencil(level - 1).compose(stencil)
+        return (stencil)
+
+    def setStencil(self, stencil, level=1):
+        """
+        use a stencil calculated elsewhere (e.g. in a worker process) for the current index buffer
+        """
+        self.stencil = stencil
+        self.source = self.obj.getOpenGLIndex()
+        self.level = level
+
+    def hasStencil(self, level=1):
+        """
+        True if the stencil is still valid for the index buffer of the object
+        """
+        return (self.stencil is not None and self.source is self.obj.getOpenGLIndex() and self.level == level)
+
+    def doCalculation(self, level=1):
+        """
+        create the subdivided object, the stencil is reused as long as the index buffer of the object and the level are not changed
+        """
+        print ("Subdividing " + self.obj.name)
+        m = measureTime("subdivision")
+        if not self.hasStencil(level):
+            self.setStencil(self.createStencil(level), level)
+        subdiv = self.stencil.createObject(self.glob, self.obj, self.obj.gl_coord)
         m.passed("normals calculated, done")
         return(subdiv)
 
+    def update(self, subdiv):
+        """
+        recalculate coordinates and normals of a subdivided object after the coarse coordinates are changed
+        """
+        self.stencil.evaluate(self.obj.gl_coord, subdiv.gl_coord)
+        subdiv.calcNormals()
@@ -5,6 +5,8 @@
     Functions:
     * eulerMatrixXYZ                  Euler rotation, fixed order
     * eulerMatrix                     Euler rotation, order must be given as e.g. yzx
+    * eulerMatricesXYZ                Euler rotation for arrays of angles, fixed order, returns 3x3 matrices
+    * eulerMatrices                   Euler rotation for arrays of angles, order must be given as e.g. yzx
     * eulerMatrixToRadians            Calculation radians angles from Euler matrix, order as index
     * eulerMatrixXYZToDegrees         Calculation x,y,z degrees angles from Euler matrix
     * eulerMatrixYZXToDegrees         Calculation y,z,x degrees angles from Euler matrix
@@ -44,6 +46,47 @@ def eulerMatrixXYZ(ri, rj, rk, i, j, k):
     M[k, k] = cj*ci
     return(M)
 
+def eulerMatricesXYZ(ri, rj, rk, i, j, k):
+    """
+    same as eulerMatrixXYZ for arrays of angles
+
+    :param ri, rj, rk: arrays of values in radians
+    :param i, j, k: indices
+    :return: rotation matrices, shape (n, 3, 3)
+    """
+    ri, rj, rk = np.asarray(ri, dtype=np.float64), np.asarray(rj, dtype=np.float64), np.asarray(rk, dtype=np.float64)
+    M = np.zeros((len(ri), 3, 3))
+    si, sj, sk = np.sin(ri), np.sin(rj), np.sin(rk)
+    ci, cj, ck = np.cos(ri), np.cos(rj), np.cos(rk)
+    cc, cs = ci*ck, ci*sk
+    sc, ss = si*ck, si*sk
+
+    M[:, i, i] = cj*ck
+    M[:, i, j] = sj*sc-cs
+    M[:, i, k] = sj*cc+ss
+    M[:, j, i] = cj*sk
+    M[:, j, j] = sj*ss+cc
+    M[:, j, k] = sj*cs-sc
+    M[:, k, i] = -sj
+    M[:, k, j] = cj*si
+    M[:, k, k] = cj*ci
+    return(M)
+
+def eulerMatrices(x, y, z, s="xyz"):
+    x, y, z = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64), np.asarray(z, dtype=np.float64)
+    if s == "xyz":
+        return eulerMatricesXYZ(x, y, z, 0, 1, 2)
+    elif s == "xzy":
+        return eulerMatricesXYZ(-x, -y, -z, 0, 2, 1)
+    elif s == "yzx":
+        return eulerMatricesXYZ(x, y, z, 1, 2, 0)
+    elif s == "yxz":
+        return eulerMatricesXYZ(-x, -y, -z, 1, 0, 2)
+    elif s == "zxy":
+        return eulerMatricesXYZ(x, y, z, 2, 0, 1)
+    # zyx
+    return eulerMatricesXYZ(-x, -y, -z, 2, 1, 0)
+
 def eulerMatrixToRadians(m, i, j, k):
     cy = math.sqrt(m[i, i] *m[i, i] + m[j, i]*m[j, i])
     if cy > _EPS:
@@ -0,0 +1,113 @@
+"""
+    License information: data/licenses/makehuman_license.txt
+    Author: black-punkduck
+
+    Classes:
+    * MorphEngine
+"""
+
+import numpy as np
+
+class MorphEngine:
+    """
+    all morph targets of a collection form one sparse delta matrix, one column per target.
+    A row is a vertex, the values are the delta vectors. Applying a complete character is then
+    one sparse matrix-vector product against a weight vector.
+    The columns are not copied, they stay views to the target data (which might be memory mapped),
+    only the columns with a weight are gathered. The gathered entries are kept as long as the
+    same columns are used and no target is loaded or evicted (generation of the residency).
+    """
+    def __init__(self, env, residency=None):
+        self.env = env
+        self.residency = residency  # TargetResidency, its generation invalidates the gathered entries
+        self.targets = []           # column -> Morphtarget
+        self.columns = {}           # Morphtarget -> column
+        self.gathered = None        # (columns with weight, generation, active columns, counts, verts, data)
+
+    def __str__(self):
+        return ("MorphEngine: " + str(len(self.targets)) + " targets, " + str(self.numEntries()) + " entries")
+
+    def numEntries(self):
+        """
+        entries of all resident columns (does not load targets)
+        """
+        return sum(max(t.numVerts(), 0) for t in self.targets)
+
+    def columnSize(self, target):
+        return len(target.verts) if target.verts is not None else 0
+
+    def addTarget(self, target):
+        """
+        add a target as a new column, targets are only added once
+        """
+        if target is None or target in self.columns:
+            return
+        self.columns[target] = len(self.targets)
+        self.targets.append(target)
+        self.gathered = None
+
+    def column(self, target):
+        return self.columns.get(target)
+
+    def newWeights(self):
+        return np.zeros(len(self.targets), dtype=np.float32)
+
+    def addWeight(self, weights, target, factor):
+        """
+        add a factor for a target to a weight vector, unknown targets are ignored
+        """
+        col = self.columns.get(target)
+        if col is not None:
+            weights[col] += factor
+
+    def generation(self):
+        return self.residency.generation if self.residency is not None else None
+
+    def gather(self, nonzero):
+        """
+        gather the entries of all columns with a weight (loads the targets), reuse the last result
+        if the columns are the same and no target was loaded or evicted since
+
+        :param nonzero: columns with a weight
+        :return: active columns (with entries), entries per column, vertices, delta vectors
+        """
+        g = self.gathered
+        if g is not None and g[1] is not None and g[1] == self.generation() and np.array_equal(g[0], nonzero):
+            return g[2:]
+
+        active = np.array([i for i in nonzero if self.columnSize(self.targets[i]) > 0], dtype=np.intp)
+        if len(active) == 0:
+            verts = np.zeros(0, dtype=np.intp)
+            data = np.zeros((0, 3), dtype=np.float32)
+            counts = np.zeros(0, dtype=np.intp)
+        else:
+            counts = np.array([self.columnSize(self.targets[i]) for i in active], dtype=np.intp)
+            verts = np.concatenate([self.targets[i].verts for i in active])
+            data = np.concatenate([np.reshape(self.targets[i].data, (-1, 3)) for i in active])
+
+        # generation is read after loading, so the targets loaded here do not invalidate the result
+        #
+        self.gathered = (nonzero, self.generation(), active, counts, verts, data)
+        return self.gathered[2:]
+
+    def apply(self, coords, weights):
+        """
+        coords += D * weights
+
+        :param coords: flat coordinate buffer like gl_coord (changed in place)
+        :param weights: weight vector, one entry per column
+        """
+        (active, counts, verts, data) = self.gather(np.flatnonzero(weights))
+        if len(active) == 0:
+            return
+
+        # expand weights to entries
+        #
+        w = np.repeat(weights[active], counts)
+
+        # one scatter-add per coordinate, rows with more than one target are summed up
+        #
+        c = np.reshape(coords, (-1, 3))
+        n = len(c)
+        for k in range(0,3):
+            c[:,k] += np.bincount(verts, weights=data[:,k] * w, minlength=n)[:n]
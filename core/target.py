@@ -6,6 +6,8 @@
     * MacroTree
     * Modelling
     * Morphtarget
+    * TargetResidency
+    * TargetDedup
     * Targets
 """
 
@@ -13,11 +15,16 @@ from gui.common import WorkerThread
 from gui.slider import ScaleComboItem
 from core.targetcat import TargetCategories
 from core.importfiles import TargetASCII
+from core.morphengine import MorphEngine
 
 import os
 import sys
 import json
+import weakref
+import hashlib
+import threading
 import numpy as np
+from collections import OrderedDict
 
 class MacroTree:
     def __init__(self):
@@ -72,20 +79,21 @@ class Modelling(ScaleComboItem):
         elif self.macro:
             t = [self.name, str(self.macro), -1, str(self.macro), -1, self.pattern, self.value]
         else:
-            li = len(self.incr.verts) if self.incr else 0
-            ld = len(self.decr.verts) if self.decr else 0
+            li = self.incr.numVerts() if self.incr else 0
+            ld = self.decr.numVerts() if self.decr else 0
             t = [self.name, str(self.incr), li, str(self.decr), ld, self.pattern, self.value]
         return (t)
 
     def setFromDict(self, t, targetpath, bintargets):
         if "tip" in t:
             self.tip = t["tip"]
+        residency = self.glob.Targets.residency
         if "decr" in t:
-            self.decr = Morphtarget(self.glob.env, t["decr"])
-            self.decr.loadTargetData(targetpath, bintargets)
+            self.decr = Morphtarget(self.glob.env, t["decr"], residency)
+            self.decr.setSource(targetpath, bintargets)
         if "incr" in t:
-            self.incr = Morphtarget(self.glob.env, t["incr"])
-            self.incr.loadTargetData(targetpath, bintargets)
+            self.incr = Morphtarget(self.glob.env, t["incr"], residency)
+            self.incr.setSource(targetpath, bintargets)
         if "rsym" in t:
             self.sym = t["rsym"]
             self.isRSide = False
@@ -245,58 +253,62 @@ class Modelling(ScaleComboItem):
             if factor > 0.01:
                 targetlist.append ({"name": macroname[1:], "factor": factor})
 
-    def macroCalculation(self, m_influence):
+    def macroTargets(self, l):
+        """
+        calculate the weighted targets of one macro definition
+        :param l: index of macrodef
+        :return: dictionary of target names and factors
+        """
         macros = self.glob.targetMacros
         macrodef = macros["macrodef"]
         components = macros["components"]
         targetlist = []
-        for l in m_influence:
-            #print ("   " + macrodef[l]["name"])
-            comps = macrodef[l]["comp"]
-            weightarray = []
-            for elem in comps:
-                if elem in components:
-                    pattern = components[elem]["pattern"]
-                    values  = components[elem]["values"]
-                    # print ("\t\tPattern:" +  str(pattern) + " " + str(values))
-
-                    if "steps" not in components[elem]:
-
-                        # extra for sum of sliders (human phenotype)
-                        #
-                        sum = components[elem]["sum"]
-                        m = MacroTree()
-                        for i,v in enumerate(values):
-                            p = pattern +  sum[i]
-                            if p not in self.glob.targetRepo:
-                                continue
-                            current = self.glob.targetRepo[p]
-                            b = current.barycentric[i]["value"]
-                            if b > 0.001:
-                                # print ("\t\tCurrent value " + v + " " + str(b))
-                                m.insert(v, b)
-                        weightarray.append(m)
-                    else:
-                        steps = components[elem]["steps"]
-                        if pattern not in self.glob.targetRepo:
+        #print ("   " + macrodef[l]["name"])
+        comps = macrodef[l]["comp"]
+        weightarray = []
+        for elem in comps:
+            if elem in components:
+                pattern = components[elem]["pattern"]
+                values  = components[elem]["values"]
+                # print ("\t\tPattern:" +  str(pattern) + " " + str(values))
+
+                if "steps" not in components[elem]:
+
+                    # extra for sum of sliders (human phenotype)
+                    #
+                    sum = components[elem]["sum"]
+                    m = MacroTree()
+                    for i,v in enumerate(values):
+                        p = pattern +  sum[i]
+                        if p not in self.glob.targetRepo:
                             continue
-                        current = self.glob.targetRepo[pattern].value / 100
-                        # print ("\t\tCurrent " + str(current) + " Divisions: " + str(len(steps)))
-
-                        for i in range(0,len(steps)-1):
-                            if current > steps[i+1]:
-                                continue
-                            else:
-                                c = (current - steps[i]) / (steps[i+1] - steps[i])
-                                m = MacroTree()
-                                if c < 0.999:
-                                    m.insert(values[i], 1-c)
-                                if c > 0.001:
-                                    m.insert(values[i+1], c)
-                                weightarray.append(m)
-                                break
-
-            self.generateAllMacroWeights(targetlist, "", 1.0, weightarray)
+                        current = self.glob.targetRepo[p]
+                        b = current.barycentric[i]["value"]
+                        if b > 0.001:
+                            # print ("\t\tCurrent value " + v + " " + str(b))
+                            m.insert(v, b)
+                    weightarray.append(m)
+                else:
+                    steps = components[elem]["steps"]
+                    if pattern not in self.glob.targetRepo:
+                        continue
+                    current = self.glob.targetRepo[pattern].value / 100
+                    # print ("\t\tCurrent " + str(current) + " Divisions: " + str(len(steps)))
+
+                    for i in range(0,len(steps)-1):
+                        if current > steps[i+1]:
+                            continue
+                        else:
+                            c = (current - steps[i]) / (steps[i+1] - steps[i])
+                            m = MacroTree()
+                            if c < 0.999:
+                                m.insert(values[i], 1-c)
+                            if c > 0.001:
+                                m.insert(values[i+1], c)
+                            weightarray.append(m)
+                            break
+
+        self.generateAllMacroWeights(targetlist, "", 1.0, weightarray)
 
         # The last step is the optimization: Some weightfiles are not existing.
         # So they would be a factor of 0. Sometimes targets are identical.
@@ -319,13 +331,34 @@ class Modelling(ScaleComboItem):
                         #print(" New: " + name)
                 else:
                     pass
+        return (sortedtargets)
+
+    def macroCalculation(self, m_influence):
+        """
+        recalculate the macros mentioned in m_influence. The weighted targets and the summed deltas
+        of each macro are cached, so only macros with changed weights are applied again
+        """
+        targets = self.glob.Targets
+        engine = targets.getMorphEngine()
+        cache = targets.macrocache
+        for l in m_influence:
+            sortedtargets = self.macroTargets(l)
+
+            weights = engine.newWeights()
+            for elem in sortedtargets:
+                if elem in self.glob.macroRepo:
+                    print ("  + " + str(round(sortedtargets[elem],2)) + " " + elem)
+                    engine.addWeight(weights, self.glob.macroRepo[elem], sortedtargets[elem])
+            self.obj.baseMesh.changeMacroContribution(cache, l, engine, weights)
 
-        # add them to screen first
+        # targets used by all macros are kept resident
         #
-        for elem in sortedtargets:
-            if elem in self.glob.macroRepo:
-                print ("  + " + str(round(sortedtargets[elem],2)) + " " + elem)
-                self.obj.baseMesh.addTargetToMacroBuffer(sortedtargets[elem], self.glob.macroRepo[elem])
+        used = set()
+        for (weights, delta) in cache.values():
+            for col in np.flatnonzero(weights):
+                used.add(engine.targets[col])
+        targets.macrotargets = used
+
         self.obj.baseMesh.addMacroBuffer()
 
     def macroCalculationLoad(self):
@@ -335,19 +368,20 @@ class Modelling(ScaleComboItem):
         #
         m_influence = list(range(0,len(m)))
         self.obj.baseMesh.prepareMacroBuffer()
+        self.glob.Targets.macrocache = {}
         self.macroCalculation(m_influence)
 
     def changeMacroTarget(self, bckproc, args):
         """
         change macros will run as a background process
+        only macros influenced by this slider are calculated again
         """
         self._last_value = self.value
 
         print (self.m_influence)
-        m = self.glob.targetMacros['macrodef']
-        m_influence = list(range(0,len(m)))
-        self.macroCalculation(m_influence)
+        self.macroCalculation(self.m_influence)
         self.obj.updateAttachedAssets()
+        self.obj.updateNormals()
 
     def setBaryCentricDiffuse(self):
         if hasattr(self, "barycentric_diffuse"):
@@ -434,28 +468,94 @@ class Modelling(ScaleComboItem):
 
 class Morphtarget:
     """
-    handle a single target
+    handle a single target, the data is loaded on first use when a source is set
     """
-    def __init__(self, env, name):
+    def __init__(self, env, name, residency=None):
         self.name = name
         self.raw  = None
-        self.verts= []
-        self.data = []
+        self._verts= []
+        self._data = []
         self.env  = env
+        self.residency = residency
+        self.path = None
+        self.bintargets = None
+        self.resident = False
 
     def __str__(self):
         return (self.name)
 
+    @property
+    def verts(self):
+        self.ensureResident(True)
+        return self._verts
+
+    @verts.setter
+    def verts(self, value):
+        self._verts = value
+
+    @property
+    def data(self):
+        self.ensureResident(False)
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self._data = value
+
+    def setSource(self, path, bintargets=None):
+        """
+        remember where the target can be found, data is loaded on first use
+        """
+        self.path = path
+        self.bintargets = bintargets
+
+    def ensureResident(self, count):
+        """
+        load data of a target with a source, if not yet resident
+        :param count: count the access for the statistics
+        """
+        if self.resident:
+            if count and self.residency is not None:
+                self.residency.touch(self)
+            return
+        if self.path is None:
+            return
+        self.loadTargetData(self.path, self.bintargets)
+
+    def numVerts(self):
+        """
+        number of vertices without loading the target, -1 if not resident
+        """
+        if not self.resident:
+            return -1
+        return len(self._verts) if self._verts is not None else 0
+
+    def nBytes(self):
+        if self._verts is None or len(self._verts) == 0:
+            return 0
+        return self._verts.nbytes + self._data.nbytes
+
+    def arrays(self):
+        """
+        arrays holding the data (might be shared with other targets)
+        """
+        if self._verts is None or len(self._verts) == 0:
+            return []
+        return [self._verts, self._data]
+
     def loadTargetData(self, path, bintargets=None):
         """
         get Target data either from pre-loaded npz file or from single targets
         """
+        self.resident = True
         if bintargets is not None:
             if self.name in bintargets.files:
                 self.env.logLine(8, "Use Data for " + self.name + " from binary file")
                 self.raw = bintargets[self.name]
                 self.verts = self.raw['index']
                 self.data = self.raw['vector']
+                if self.residency is not None:
+                    self.residency.loaded(self)
                 return
 
         filename = os.path.join(path, self.name) + ".target"
@@ -468,17 +568,193 @@ class Morphtarget:
             return
         self.verts = self.raw['index']
         self.data = self.raw['vector']
+        if self.residency is not None:
+            self.residency.loaded(self)
+
+    def unload(self):
+        """
+        drop data, but keep the source, so it can be loaded again
+        """
+        self._verts = []
+        self._data = []
+        self.raw = None
+        self.resident = False
 
     def releaseNumpy(self):
-        if self.raw is not None:
-            self.verts = None
-            self.raw = None
-            self.data = []
+        if self.residency is not None:
+            self.residency.remove(self)
+        self._verts = None
+        self.raw = None
+        self._data = []
+        self.resident = False
+        self.path = None
 
     def __del__(self):
         self.env.logLine(4, " -- __del__ Morphtarget: " + self.name)
 
 
+class TargetDedup:
+    """
+    identical targets (content hash of verts and data) share their arrays, targets with
+    the same vertex set share the index array. Memory mapped data is not hashed, the mapped store
+    is deduplicated when it is written (identical entries use the same part of the file).
+    Shared arrays are read-only, so a change in place cannot modify other targets.
+    """
+    def __init__(self):
+        self.verts = weakref.WeakValueDictionary()      # hash of verts + data -> verts
+        self.data = weakref.WeakValueDictionary()       # hash of verts + data -> data
+        self.index = weakref.WeakValueDictionary()      # hash of verts -> verts
+
+    @staticmethod
+    def arrayKey(arr):
+        """
+        memory used by an array (address and size), views of the same memory (e.g. mapped slices) get the same key
+        """
+        return ((arr.__array_interface__['data'][0], arr.nbytes))
+
+    def share(self, target):
+        verts = target._verts
+        data = target._data
+        if not isinstance(verts, np.ndarray) or len(verts) == 0 or isinstance(verts, np.memmap):
+            return
+        vkey = hashlib.sha1(np.ascontiguousarray(verts).data).digest()
+        key = hashlib.sha1(vkey + np.ascontiguousarray(data).data).digest()
+
+        sverts = self.verts.get(key)
+        sdata = self.data.get(key)
+        if sverts is not None and sdata is not None and np.array_equal(sverts, verts) and np.array_equal(sdata, data):
+            target._verts = sverts
+            target._data = sdata
+            target.raw = None
+            return
+
+        # the deltas get an own array, otherwise the structured raw data would be kept
+        #
+        sverts = self.index.get(vkey)
+        if sverts is not None and np.array_equal(sverts, verts):
+            target._verts = sverts
+            target._data = data = np.ascontiguousarray(data)
+            target.raw = None
+        else:
+            self.index[vkey] = verts
+        target._verts.flags.writeable = False
+        data.flags.writeable = False
+        self.verts[key] = target._verts
+        self.data[key] = data
+
+    def statistics(self, targets):
+        """
+        count shared arrays and bytes saved of the targets mentioned
+        """
+        nominal = 0
+        unique = {}
+        shared = 0
+        for target in targets:
+            for arr in (target._verts, target._data):
+                if isinstance(arr, np.ndarray) and arr.nbytes > 0:
+                    nominal += arr.nbytes
+                    key = self.arrayKey(arr)
+                    if key in unique:
+                        shared += 1
+                    unique[key] = arr.nbytes
+        return ([
+            ["Shared arrays", shared],
+            ["Saved by sharing (MB)", round((nominal - sum(unique.values())) / 1048576, 2)]])
+
+
+class TargetResidency:
+    """
+    keeps track of loaded targets (least recently used first) and evicts unused targets
+    when the memory budget "target_cache_mb" is exceeded (0 = no limit).
+    Arrays shared by several targets are counted once.
+    """
+    def __init__(self, env, inuse=None):
+        self.env = env
+        self.inuse = inuse          # function returning a set of targets, which must stay resident
+        self.budget = int(env.config.get("target_cache_mb", 0)) * 1048576
+        self.lru = OrderedDict()    # target -> keys of its arrays
+        self.arrays = {}            # key of array -> [size in bytes, number of targets using it]
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.generation = 0         # changed when a target is loaded or dropped (see MorphEngine)
+        self.dedup = TargetDedup()
+        self.lock = threading.RLock()
+
+    def __str__(self):
+        return ("TargetResidency: " + str(len(self.lru)) + " targets, " + str(self.size) + " bytes")
+
+    def touch(self, target):
+        with self.lock:
+            self.hits += 1
+            if target in self.lru:
+                self.lru.move_to_end(target)
+
+    def addArrays(self, target):
+        keys = []
+        for arr in target.arrays():
+            key = self.dedup.arrayKey(arr)
+            if key in self.arrays:
+                self.arrays[key][1] += 1
+            else:
+                self.arrays[key] = [arr.nbytes, 1]
+                self.size += arr.nbytes
+            keys.append(key)
+        return (tuple(keys))
+
+    def releaseArrays(self, keys):
+        for key in keys:
+            entry = self.arrays[key]
+            entry[1] -= 1
+            if entry[1] == 0:
+                self.size -= entry[0]
+                del self.arrays[key]
+
+    def loaded(self, target):
+        with self.lock:
+            self.misses += 1
+            self.generation += 1
+            if target in self.lru:
+                self.releaseArrays(self.lru.pop(target))
+            self.dedup.share(target)
+            self.lru[target] = self.addArrays(target)
+            self.evict(target)
+
+    def remove(self, target):
+        with self.lock:
+            self.generation += 1
+            if target in self.lru:
+                self.releaseArrays(self.lru.pop(target))
+
+    def evict(self, keep=None):
+        """
+        evict least recently used targets until budget fits, targets in use are kept
+        """
+        if self.budget == 0 or self.size <= self.budget:
+            return
+        used = self.inuse() if self.inuse is not None else set()
+        for target in list(self.lru.keys()):
+            if self.size <= self.budget:
+                break
+            if target is keep or target in used:
+                continue
+            self.releaseArrays(self.lru.pop(target))
+            target.unload()
+            self.generation += 1
+            self.evictions += 1
+            self.env.logLine(8, "Evict target " + target.name)
+
+    def statistics(self):
+        return ([
+            ["Resident targets", len(self.lru)],
+            ["Memory (MB)", round(self.size / 1048576, 2)],
+            ["Budget (MB)", round(self.budget / 1048576, 2) if self.budget > 0 else "unlimited"],
+            ["Hits", self.hits],
+            ["Misses", self.misses],
+            ["Evictions", self.evictions]] + self.dedup.statistics(self.lru.keys()))
+
+
 class Targets:
     def __init__(self, glob):
         self.glob =glob
@@ -486,6 +762,10 @@ class Targets:
         self.modelling_targets = []
         glob.Targets = self
         self.collection = None
+        self.morphengine = None
+        self.residency = TargetResidency(self.env, self.usedTargets)
+        self.macrotargets = set()
+        self.macrocache = {}
         self.macrodef = None
         self.target_sysindex = -1
         self.categories = None
@@ -631,14 +911,24 @@ class Targets:
        
         # load binary targets according to sysindex
         #
+        # the configured store is preferred, the others are the fallback
+        #
         ind = self.target_sysindex
+        ta = TargetASCII()
+        preferred = self.env.config.get("target_store", "compressed")
+        kinds = [preferred] + [k for k in ("mapped", "quantized", "compressed") if k != preferred]
 
         for i in (ind, 1):
             x = self.target_env[i]
-            bintargets = os.path.join(x["targetpath"], "compressedtargets.npz")
-            if os.path.exists(bintargets):
-                self.env.logLine(8, "Load binary targets: " + bintargets)
-                x["targets"] = np.load(bintargets)
+            for kind in kinds:
+                if kind not in ta.storenames:
+                    continue
+                bintargets = os.path.join(x["targetpath"], ta.storenames[kind])
+                store = ta.openStore(bintargets, kind)
+                if store is not None:
+                    self.env.logLine(8, "Load binary targets (" + kind + "): " + bintargets)
+                    x["targets"] = store
+                    break
 
         # load macrotargets, use folder, where the macro-defition was found
         #
@@ -646,8 +936,8 @@ class Targets:
             for link in self.macrodef["targetlink"]:
                 name = self.macrodef["targetlink"][link]
                 if name is not None and name not in self.glob.macroRepo:
-                    mt = Morphtarget(self.env, name)
-                    mt.loadTargetData(self.target_env[ind]["targetpath"], self.target_env[ind]["targets"])
+                    mt = Morphtarget(self.env, name, self.residency)
+                    mt.setSource(self.target_env[ind]["targetpath"], self.target_env[ind]["targets"])
                     self.glob.macroRepo[name] = mt
 
         # load targets mentioned in modelling.json
@@ -655,10 +945,52 @@ class Targets:
         for name, t in targetjson.items():
             self.createTarget(name, t)
 
+    def getMorphEngine(self):
+        """
+        stack all targets of the collection (modelling and macro targets) into one morph engine,
+        the engine is created on first use
+        """
+        if self.morphengine is None:
+            engine = MorphEngine(self.env, self.residency)
+            for m in self.modelling_targets:
+                engine.addTarget(m.decr)
+                engine.addTarget(m.incr)
+            for mt in self.glob.macroRepo.values():
+                engine.addTarget(mt)
+            self.morphengine = engine
+        return self.morphengine
+
+    def usedTargets(self):
+        """
+        targets which are currently in use (non-zero values and macro targets of last calculation)
+        """
+        used = set(self.macrotargets)
+        for target in self.modelling_targets:
+            if target.value != 0.0 and target.macro is None:
+                used.add(target.decr if target.value < 0.0 else target.incr)
+        return used
+
+    def nonMacroWeights(self):
+        """
+        weight vector for the morph engine containing all non-macro targets
+        (negative values use the decr-target, positive values the incr-target)
+        """
+        engine = self.getMorphEngine()
+        weights = engine.newWeights()
+        for target in self.modelling_targets:
+            if target.value != 0.0 and target.macro is None:
+                factor = target.value / 100
+                if factor < 0.0:
+                    engine.addWeight(weights, target.decr, -factor)
+                else:
+                    engine.addWeight(weights, target.incr, factor)
+        return weights
+
     def saveBinaryTargets(self, bckproc, *args):
         """
         save targets as compressed binary (running as background command)
-        also works for contargets
+        also works for contargets. Depending on configuration "target_store" the targets
+        are saved as compressed npz, as memory mappable or as quantized store ("target_quantize")
         :parm bck_proc: unused pointer to background process
         :param args: [0][0] 1 = system, 2 = user (3 is both)
         """
@@ -668,22 +1000,27 @@ class Targets:
     
         sys_user = args[0][0]
         ta = TargetASCII()
+        store = self.env.config.get("target_store", "compressed")
+        if store not in ta.storenames:
+            store = "compressed"
+        quantize = self.env.config.get("target_quantize", "int16")
+        destname = ta.storenames[store]
         if sys_user & 1:
             sourcefolder = self.env.stdSysPath("target")
-            destfile = self.env.stdSysPath("target", "compressedtargets.npz")
+            destfile = self.env.stdSysPath("target", destname)
             self.env.logLine (8, "Compress system targets in " + sourcefolder + " to "+  destfile)
-            ta.compressAllTargets(sourcefolder, destfile)
+            ta.compressAllTargets(sourcefolder, destfile, store=store, quantize=quantize)
 
         if sys_user & 2:
             sourcefolder = self.env.stdUserPath("target")
-            destfile = self.env.stdUserPath("target", "compressedtargets.npz")
+            destfile = self.env.stdUserPath("target", destname)
             self.env.logLine (8, "Compress user targets in " + sourcefolder + " to "+  destfile)
-            ta.compressAllTargets(sourcefolder, destfile)
+            ta.compressAllTargets(sourcefolder, destfile, store=store, quantize=quantize)
             if self.target_sysindex == 2:
                 sourcefolder = self.env.stdUserPath("contarget")
-                destfile = self.env.stdUserPath("contarget", "compressedtargets.npz")
+                destfile = self.env.stdUserPath("contarget", destname)
                 self.env.logLine (8, "Compress user constant targets in " + sourcefolder + " to "+  destfile)
-                ta.compressAllTargets(sourcefolder, destfile)
+                ta.compressAllTargets(sourcefolder, destfile, store=store, quantize=quantize)
 
     def setSkinDiffuseColor(self):
         for target in self.modelling_targets:
@@ -749,6 +1086,8 @@ class Targets:
                 m.decr.releaseNumpy()
 
         self.modelling_targets = []
+        self.morphengine = None
+        self.macrocache = {}
 
     def __del__(self):
         if self.collection is not None:
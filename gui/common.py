@@ -203,8 +203,11 @@ class MHProgWindow():
     Progress Window to display progress, more or less a wrapper of
     QProgressDialog
     """
-    def __init__(self, title, maximum):
-        self.progress = QProgressDialog("started", None, 0, maximum, None)
+    def __init__(self, title, maximum, cancel=None):
+        """
+        :param cancel: text of a cancel button, no button if None
+        """
+        self.progress = QProgressDialog("started", cancel, 0, maximum, None)
         self.progress.setWindowTitle(title)
         self.progress.setMinimumWidth(600)
         self.progress.setMinimumDuration(500)
@@ -157,6 +157,13 @@ class MHMemWindow(QWidget):
         tab.addTab(table, "Macro-Targets")
         self.tables.append(table)
 
+        # target residency
+        #
+        table = MHQTableView(self, "residency")
+        table.addModel(self.refreshResidencyTable, ["Target Cache", "Value"])
+        tab.addTab(table, "Target Cache")
+        self.tables.append(table)
+
         # meshes
         #
         table = MHQTableView(self, "objects")
@@ -227,11 +234,20 @@ class MHMemWindow(QWidget):
         if macros is not None:
             for macro in macros:
                 m = self.glob.macroRepo[macro]
-                data.append([str(macro), len(m.verts)])
+                data.append([str(macro), m.numVerts()])
         if len(data) == 0:
             data = [["no macros loaded"]]
         return (data)
 
+    def refreshResidencyTable(self, dummy):
+        data = []
+        targets = self.glob.Targets
+        if targets is not None:
+            data = targets.residency.statistics()
+        if len(data) == 0:
+            data = [["no targets loaded"]]
+        return (data)
+
     def refreshObjectTable(self, dummy):
         data = []
         if self.glob.baseClass is not None:
@@ -10,7 +10,7 @@
 from PySide6.QtWidgets import QWidget, QVBoxLayout, QHBoxLayout, QLabel, QLineEdit, QGridLayout, QGroupBox, QCheckBox
 from PySide6.QtCore import Qt
 from PySide6.QtGui import QPixmap
-from gui.common import IconButton, WorkerThread, ErrorBox, MHFileRequest
+from gui.common import IconButton, WorkerThread, ErrorBox, MHFileRequest, MHProgWindow
 from gui.slider import SimpleSlider
 from obj3d.animation import PosePrims, MHPose
 import os
@@ -64,6 +64,8 @@ class AnimPlayer(QVBoxLayout):
         self.anim = self.bc.bvh
         self.posemod = self.bc.posemodifier
         self.looping = False
+        self.prog_window = None     # progressbar for baking
+        self.bakeCanceled = False
         self.values = self.glob.guiPresets["Animplayer"]
         super().__init__()
 
@@ -250,13 +252,53 @@ class AnimPlayer(QVBoxLayout):
         v = b.isChecked()
         if v:
             self.looping = True
-            self.view.setFPS(self.values.speedValue, self.resetAnimbutton)
-            self.view.startTimer(self.frameFeedback)
+            missing = self.bc.framesToBake()
+            if missing > 0 and self.glob.parallel is None:
+                self.bakeCanceled = False
+                self.prog_window = MHProgWindow("Bake animation", missing, cancel="Cancel")
+                self.prog_window.progress.canceled.connect(self.cancelBake)
+                self.prog_window.progress.forceShow()
+                self.glob.openGLBlock = True
+                self.glob.parallel = WorkerThread(self.bakeFrames)
+                self.glob.parallel.update_progress.connect(self.bakeProgress)
+                self.glob.parallel.finished.connect(self.finishBake)
+                self.glob.parallel.start()
+            else:
+                self.startLoop()
         else:
             self.looping = False
             self.view.stopTimer()
         b.setChecked(v)
 
+    def startLoop(self):
+        self.view.setFPS(self.values.speedValue, self.resetAnimbutton)
+        self.view.startTimer(self.frameFeedback)
+
+    def bakeFrames(self, bckproc, *args):
+        """
+        precalculate frames in background, the meshes are not displayed meanwhile
+        """
+        self.bc.bakeAnimation(progress=lambda n: bckproc.update_progress.emit(n), cancel=lambda: self.bakeCanceled)
+
+    def bakeProgress(self, n):
+        if self.prog_window is not None:
+            self.prog_window.setValueAndText(n, "Baked " + str(n) + " frames")
+
+    def cancelBake(self):
+        self.bakeCanceled = True
+
+    def finishBake(self):
+        """
+        start playback, frames not baked (cancel) are stored while playing
+        """
+        if self.prog_window is not None:
+            self.prog_window.progress.close()
+            self.prog_window = None
+        self.glob.parallel = None
+        self.glob.openGLBlock = False
+        if self.looping:
+            self.startLoop()
+
     def rotator(self):
         b = self.sender()
         v = b.isChecked()
@@ -10,13 +10,15 @@
 from PySide6.QtCore import Qt
 from PySide6.QtWidgets import QWidget, QVBoxLayout, QPushButton, QLineEdit, QGridLayout, QLabel, QMessageBox,  QCheckBox, QHBoxLayout
 
-from gui.common import IconButton, MHFileRequest, MHBusyWindow, WorkerThread, ImageBox
+from gui.common import IconButton, MHFileRequest, MHProgWindow, WorkerThread, ImageBox, ErrorBox
 from gui.slider import SimpleSlider
 
 from opengl.offscreen import OffScreenRender
-from core.loopapproximation import LoopApproximation
+from core.loopapproximation import LoopApproximation, subdivisionJob, createStencils
 
 import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
 class RendererValues():
     """
@@ -51,6 +53,9 @@ class Renderer(QVBoxLayout):
         self.values = self.glob.guiPresets["Renderer"]
 
         self.prog_window = None     # progressbar
+        self.pool = None            # process pool for subdivision, created when needed
+        self.canceled = False       # subdivision canceled by user
+        self.s_error = None         # error message of a failed subdivision
         #
         # close subwindows just in case because they cannot work on mesh copies
         #
@@ -66,8 +71,14 @@ class Renderer(QVBoxLayout):
         for elem in self.glob.baseClass.attachedAssets:
             self.n_objects.append(elem.obj)
 
-        # subdivided objects
+        # subdivided objects, the objects used (the asset or None for basemesh, coarse object),
+        # jobs (number of source, job) and their stencils, subdivision per coarse object (keeps the stencil)
+        #
         self.s_objects = []
+        self.s_sources = []
+        self.s_jobs = []
+        self.s_stencils = None
+        self.s_loops = {}
 
         glayout = QGridLayout()
         glayout.addWidget(QLabel("Width"), 0, 0)
@@ -150,6 +161,9 @@ class Renderer(QVBoxLayout):
 
     def leave(self):
         self.setUnsubdivided()
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
 
         if (self.bvh or self.posemod) and self.values.posed:
             self.setFrame(0)
@@ -180,8 +194,31 @@ class Renderer(QVBoxLayout):
         self.bc.showPose()
 
     def frameChanged(self, value):
-        self.setUnsubdivided()
-        self.setFrame(int(value))
+        if self.subdiv and self.glob.parallel is None:
+            self.poseSubdivided(int(value))
+        else:
+            self.setFrame(int(value))
+
+    def swapObjects(self, objects):
+        """
+        exchange the meshes of base mesh and assets used for subdivision (no change of the opengl buffers)
+        """
+        for (elem, obj), nobj in zip(self.s_sources, objects):
+            if elem is None:
+                self.bc.baseMesh = nobj
+            else:
+                elem.obj = nobj
+
+    def poseSubdivided(self, value):
+        """
+        pose the coarse meshes, subdivided meshes are recalculated with their stencils
+        """
+        self.swapObjects([obj for (elem, obj) in self.s_sources])
+        self.setFrame(value)
+        self.swapObjects(self.s_objects)
+        for (elem, obj), sobj in zip(self.s_sources, self.s_objects):
+            self.s_loops[obj].update(sobj)
+        self.view.Tweak()
 
     def changeTransparency(self, param):
         self.values.transparent = param
@@ -238,55 +275,116 @@ class Renderer(QVBoxLayout):
             self.values.imheight = i
 
     def changeAnim(self):
-        if self.subdiv:
-            self.unSubdivide()
         self.values.doCorrections = self.corrAnim.isChecked()
         if self.values.doCorrections:
             self.bvh.modCorrections()
         else:
             self.bvh.identFinal()
-        self.bc.showPose()
+        self.frameChanged(self.bvh.currentFrame)
 
 
+    def subdivisionPool(self):
+        """
+        the pool is kept as long as the renderer is used, so processes are only started once
+        """
+        processes = min(os.cpu_count() or 1, len(self.s_jobs))
+        if processes < 2:
+            return None
+        if self.pool is None:
+            ctx = multiprocessing.get_context("spawn")
+            self.pool = ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=ctx)
+        return self.pool
+
     def Subdivide(self, bckproc, *args):
         """
-        replaces meshes
+        subdivides all meshes (in parallel), objects are created in finishSubdivide
         """
-        self.s_objects = []
-        if self.bc.proxy is None:
-            self.prog_window.setLabelText("Subdiving basemesh")
-            sobj = LoopApproximation(self.glob, self.bc.baseMesh)
-            self.bc.baseMesh = sobj.doCalculation()
-            self.s_objects.append(self.bc.baseMesh)
+        pool = args[0][0]
+        try:
+            self.s_stencils = createStencils([job for (i, job) in self.s_jobs], pool,
+                    progress=lambda n, name: bckproc.update_progress.emit(n), cancel=lambda: self.canceled)
+        except Exception as error:
+            self.s_stencils = None
+            self.s_error = str(error) or type(error).__name__
 
-        for elem in self.glob.baseClass.attachedAssets:
-            self.prog_window.setLabelText("Subdiving " + elem.obj.name)
-            sobj = LoopApproximation(self.glob, elem.obj)
-            elem.obj = sobj.doCalculation()
-            self.s_objects.append(elem.obj)
+    def subdivideProgress(self, n):
+        if self.prog_window is not None:
+            self.prog_window.setValueAndText(n, "Subdivided " + str(n) + " of " + str(len(self.s_jobs)) + " objects")
 
+    def cancelSubdivide(self):
+        self.canceled = True
 
     def finishSubdivide(self):
+        """
+        replaces meshes by the subdivided ones, on cancel or error the original meshes are displayed again
+        """
         if self.prog_window is not None:
             self.prog_window.progress.close()
             self.prog_window = None
-            for obj in self.s_objects:
-                self.view.createObject(obj)
-            self.glob.openGLBlock = False
-            self.view.setYRotation(float(self.values.angle))
-            self.view.Tweak()
             self.glob.parallel = None
+            if self.s_stencils is None:
+                # jobs still running (cancel) or a broken pool would block the next subdivision, so start a new pool
+                #
+                if self.pool is not None:
+                    self.pool.shutdown(wait=False, cancel_futures=True)
+                    self.pool = None
+                self.subdiv = False
+                self.subdivbutton.setChecked(False)
+                self.unSubdivide()
+                if self.s_error is not None:
+                    self.env.logLine(1, "Subdivision failed: " + self.s_error)
+                    ErrorBox(self.parent.central_widget, "Subdivision failed: " + self.s_error)
+                return
+
+            for (i, job), stencil in zip(self.s_jobs, self.s_stencils):
+                obj = self.s_sources[i][1]
+                self.s_loops[obj].setStencil(stencil)
+            self.s_stencils = None
+            self.showSubdivided()
+
+    def showSubdivided(self):
+        """
+        create the subdivided meshes from the stencils and display them
+        """
+        self.s_objects = []
+        for (elem, obj) in self.s_sources:
+            sobj = self.s_loops[obj].doCalculation()
+            self.s_objects.append(sobj)
+            self.view.createObject(sobj)
+        self.swapObjects(self.s_objects)
+        self.glob.openGLBlock = False
+        self.view.setYRotation(float(self.values.angle))
+        self.view.Tweak()
 
     def parSubdivide(self):
+        """
+        stencils are only calculated (in parallel) for meshes with a changed index buffer
+        """
         if self.glob.parallel is None:
-            self.prog_window = MHBusyWindow("Subdivision", "start")
-            self.prog_window.progress.forceShow()
+            self.s_sources = []
+            if self.bc.proxy is None:
+                self.s_sources.append((None, self.bc.baseMesh))
+            for elem in self.glob.baseClass.attachedAssets:
+                self.s_sources.append((elem, elem.obj))
+            self.s_loops = {obj: self.s_loops.get(obj) or LoopApproximation(self.glob, obj) for (elem, obj) in self.s_sources}
+            self.s_jobs = [(i, subdivisionJob(obj)) for i, (elem, obj) in enumerate(self.s_sources) if not self.s_loops[obj].hasStencil()]
+            self.canceled = False
+            self.s_error = None
+
             self.glob.openGLBlock = True
             if self.bc.proxy is None:
                 self.view.noGLObjects()
             else:
                 self.view.noGLObjects(leavebase=True,  delproxymat=True)
-            self.glob.parallel = WorkerThread(self.Subdivide)
+            if len(self.s_jobs) == 0:
+                self.showSubdivided()
+                return
+
+            self.prog_window = MHProgWindow("Subdivision", len(self.s_jobs), cancel="Cancel")
+            self.prog_window.progress.canceled.connect(self.cancelSubdivide)
+            self.prog_window.progress.forceShow()
+            self.glob.parallel = WorkerThread(self.Subdivide, self.subdivisionPool())
+            self.glob.parallel.update_progress.connect(self.subdivideProgress)
             self.glob.parallel.start()
             self.glob.parallel.finished.connect(self.finishSubdivide)
 
@@ -0,0 +1,143 @@
+"""
+    License information: data/licenses/makehuman_license.txt
+    Author: black-punkduck
+
+    Classes:
+    * MeshAdjacency
+"""
+
+import numpy as np
+
+class MeshAdjacency:
+    """
+    adjacency of a triangle mesh calculated with arrays. Edges are packed to one key (smaller vertex * numverts + larger vertex),
+    sorting and np.unique on these keys replace the dictionaries per vertex.
+    The order of faces, neighbours and border neighbours is identical to the former dictionary version
+    (faces and vertices in order of appearance).
+
+    * edges:      unique edges [v1, v2] with v1 <= v2, sorted by key
+    * faceEdges:  edge number per corner of a face, corner i uses edge from vertex i to vertex i+1
+    * edgeFaces:  first and last face using an edge, -1 for the second one on a border
+    * vertFaces:  vertex to face incidence (CSR: vertFaceOffsets per vertex, face numbers)
+    * border:     two border neighbours per vertex, 0xffffffff if not available
+    """
+    def __init__(self, faces, numverts):
+        self.faces = np.asarray(faces, dtype=np.int64)
+        self.numverts = numverts
+        self.numfaces = len(self.faces)
+        self.createEdges()
+        self.createVertFaces()
+        self.createBorder()
+
+    def __str__(self):
+        return ("MeshAdjacency: " + str(self.numfaces) + " faces, " + str(len(self.edges)) + " edges, " +
+                str(int(np.count_nonzero(self.edgeFaces[:,1] < 0))) + " border edges")
+
+    def createEdges(self):
+        """
+        unique edges, edge per corner and faces per edge
+        """
+        v1 = self.faces
+        v2 = np.roll(self.faces, -1, axis=1)
+        keys = (np.minimum(v1, v2) * self.numverts + np.maximum(v1, v2)).ravel()
+        (keys, inverse, counts) = np.unique(keys, return_inverse=True, return_counts=True)
+        self.edges = np.stack((keys // self.numverts, keys % self.numverts), axis=1)
+        self.faceEdges = inverse.reshape(-1, 3)
+
+        # corners sorted by edge (stable, so in order of appearance), first and last corner per edge
+        #
+        order = np.argsort(inverse, kind='stable')
+        ends = np.cumsum(counts)
+        self.firstCorner = order[ends - counts]
+        self.edgeFaces = np.full((len(keys), 2), -1, dtype=np.int64)
+        self.edgeFaces[:,0] = self.firstCorner // 3
+        multi = counts > 1
+        self.edgeFaces[multi,1] = order[ends[multi] - 1] // 3
+
+    def createVertFaces(self):
+        """
+        faces per vertex in CSR form, faces in ascending order
+        """
+        corners = self.faces.ravel()
+        order = np.argsort(corners, kind='stable')
+        counts = np.bincount(corners, minlength=self.numverts)
+        self.vertFaceOffsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.vertFaceOffsets[1:])
+        self.vertFaces = order // 3
+
+    def createBorder(self):
+        """
+        border neighbours, edges used by one face only. The edges are handled in the order the former dictionary
+        was iterated (vertex v1 in order of appearance, then its edges in order of appearance), a vertex gets the
+        first neighbour in column 0 and the last one in column 1
+        """
+        self.border = np.full((self.numverts, 2), 0xffffffff, dtype=np.uint32)
+        border = np.flatnonzero(self.edgeFaces[:,1] < 0)
+        if len(border) == 0:
+            return
+
+        v1first = np.full(self.numverts, len(self.faces) * 3, dtype=np.int64)
+        np.minimum.at(v1first, self.edges[:,0], self.firstCorner)
+        border = border[np.lexsort((self.firstCorner[border], v1first[self.edges[border,0]]))]
+
+        # two events per edge, one per vertex
+        #
+        verts = self.edges[border].ravel()
+        neighbours = self.edges[border][:,::-1].ravel()
+        order = np.argsort(verts, kind='stable')
+        verts = verts[order]
+        neighbours = neighbours[order]
+        (uverts, starts, counts) = np.unique(verts, return_index=True, return_counts=True)
+        self.border[uverts,0] = neighbours[starts]
+        multi = counts > 1
+        self.border[uverts[multi],1] = neighbours[starts[multi] + counts[multi] - 1]
+
+    def evenNeighbours(self):
+        """
+        neighbours of each vertex in order of appearance (faces of the vertex in ascending order, corners of the face)
+
+        :return: offsets per vertex, neighbour vertices (CSR)
+        """
+        nf = self.numfaces
+        a = np.array([0, 0, 1, 1, 2, 2])
+        b = np.array([1, 2, 0, 2, 0, 1])
+        verts = self.faces[:,a].ravel()
+        neighbours = self.faces[:,b].ravel()
+        seq = (np.arange(nf)[:,None] * 3 + b).ravel()
+        use = verts != neighbours
+        verts = verts[use]
+        neighbours = neighbours[use]
+        seq = seq[use]
+
+        # keep first appearance of each pair, then sort by vertex and appearance
+        #
+        keys = verts * self.numverts + neighbours
+        order = np.lexsort((seq, keys))
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = keys[order[1:]] != keys[order[:-1]]
+        order = order[first]
+        order = order[np.lexsort((seq[order], verts[order]))]
+
+        counts = np.bincount(verts[order], minlength=self.numverts)
+        offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        return (offsets, neighbours[order])
+
+    def oppositeVerts(self):
+        """
+        for each edge of a face the vertex of the neighbour face which is not part of the edge, -1 on borders
+
+        :return: array [faces, 3]
+        """
+        f = np.arange(self.numfaces)[:,None]
+        (e0, e1) = (self.edgeFaces[self.faceEdges, 0], self.edgeFaces[self.faceEdges, 1])
+        nface = np.where(e0 != f, e0, e1)
+        valid = nface >= 0
+
+        v1 = self.faces
+        v2 = np.roll(self.faces, -1, axis=1)
+        cand = self.faces[np.where(valid, nface, 0)]
+        mask = (cand != v1[:,:,None]) & (cand != v2[:,:,None])
+        first = np.argmax(mask, axis=2)
+        opposite = np.take_along_axis(cand, first[:,:,None], axis=2)[:,:,0]
+        return (np.where(valid & mask.any(axis=2), opposite, -1))
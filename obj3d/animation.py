@@ -8,10 +8,19 @@
     * MHPose
     * MHPoseFaceConverter
     * PosePrims
+    * FrameCache
+    * PlaybackPipeline
 """
+import os
 import numpy as np
 import core.math as mquat
 import math
+import time
+import zlib
+import hashlib
+import queue
+import threading
+from obj3d.skinning import SkinningEngine
 
 class BVHJoint():
     def __init__(self, name):
@@ -215,36 +224,93 @@ class BVH():
         for joint in self.bvhJointOrder:
             joint.cloneToFinal()
 
-    def calcLocRotMat(self, frame, data):
+    def calcLocRotMat(self, data):
         """
-        calculation is done once after loading the file
+        calculation is done once after loading the file, vectorized over all frames per joint
         it is always order yzx since it only works for z_up (and order is already sorted)
 
-        :param frame: frame number
-        :param data:  array of bvh data
+        :param data:  array of bvh data, shape (frames, channels)
         """
+        data = np.where((data > -0.0001) & (data < 0.0001), 0.0, data)
         i = 0
         for joint in self.bvhJointOrder:
             if joint.nChannels > 0:
                 for j, m in enumerate(joint.channelorder):
                     if m>=0:
-                        r = data[i+m]
-                        if -0.0001 < r < 0.0001:
-                            r = 0.0
-                        joint.animdata[frame, j ] = r
+                        joint.animdata[:, j] = data[:, i+m]
                 i += joint.nChannels
-                x = self.pi_mult * joint.animdata[frame, 3]
+                x = self.pi_mult * joint.animdata[:, 3]
                 #
                 if self.z_up:
-                    y = -self.pi_mult * joint.animdata[frame, 4]
+                    y = -self.pi_mult * joint.animdata[:, 4]
                 else:
-                    y = self.pi_mult * joint.animdata[frame, 4]
-                z = self.pi_mult * joint.animdata[frame, 5]
+                    y = self.pi_mult * joint.animdata[:, 4]
+                z = self.pi_mult * joint.animdata[:, 5]
 
-                joint.matrixPoses[frame,:3,:3] = mquat.eulerMatrix(z, y, x, self.rotationorder)[:3,:3]
+                joint.matrixPoses[:,:3,:3] = mquat.eulerMatrices(z, y, x, self.rotationorder)
                 #
                 if joint.parent is None or self.dislocation:
-                    joint.matrixPoses[frame,:3,3] = [joint.animdata[frame, 0], joint.animdata[frame, 2], joint.animdata[frame, 1]]
+                    joint.matrixPoses[:,:3,3] = joint.animdata[:, [0, 2, 1]]
+
+    def numChannels(self):
+        return sum(joint.nChannels for joint in self.bvhJointOrder)
+
+    def cacheName(self, filename):
+        """
+        cache file in user dbcache folder, name is the hash of the path of the bvh file
+        """
+        folder = self.env.stdUserPath("dbcache", "bvh")
+        if folder is None:
+            return None
+        if not os.path.isdir(folder):
+            try:
+                os.makedirs(folder)
+            except OSError:
+                return None
+        name = hashlib.sha1(os.path.normpath(os.path.abspath(filename)).encode("utf-8")).hexdigest()
+        return os.path.join(folder, name + ".npz")
+
+    def loadCache(self, filename):
+        """
+        load animdata and matrixPoses from binary cache, cache is only valid for same modification time
+        """
+        cachename = self.cacheName(filename)
+        if cachename is None or not os.path.isfile(cachename):
+            return False
+        try:
+            with np.load(cachename) as npzfile:
+                if float(npzfile["mtime"]) != os.path.getmtime(filename) or int(npzfile["frames"]) != self.frameCount:
+                    return False
+                animdata = npzfile["animdata"]
+                matrixPoses = npzfile["matrixPoses"]
+        except (OSError, ValueError, KeyError) as err:
+            self.env.logLine(1, "Cannot read bvh cache " + cachename + ": " + str(err))
+            return False
+
+        if len(animdata) != len(self.bvhJointOrder):
+            return False
+        for n, joint in enumerate(self.bvhJointOrder):
+            joint.animdata = animdata[n]
+            joint.matrixPoses = matrixPoses[n]
+        self.env.logLine(8, "Loaded bvh cache " + cachename)
+        return True
+
+    def saveCache(self, filename):
+        """
+        save animdata and matrixPoses in binary form (if folder is writable)
+        """
+        cachename = self.cacheName(filename)
+        if cachename is None:
+            return
+        tmpname = cachename + ".tmp"
+        animdata = np.stack([joint.animdata for joint in self.bvhJointOrder])
+        matrixPoses = np.stack([joint.matrixPoses for joint in self.bvhJointOrder])
+        try:
+            with open(tmpname, "wb") as fp:
+                np.savez(fp, mtime=os.path.getmtime(filename), frames=self.frameCount, animdata=animdata, matrixPoses=matrixPoses)
+            os.replace(tmpname, cachename)
+        except OSError as err:
+            self.env.logLine(2, "Cannot write bvh cache " + cachename + ": " + str(err))
 
     def poseToAnimdata(self, matrixPose):
         """
@@ -353,11 +419,27 @@ class BVH():
 
             self.initFrames()
 
-            for i in range(self.frameCount):
-                words = fp.readline().split()
-                data = [float(word) for word in words]
-                self.calcLocRotMat(i, data)
-                if self.env.verbose & 32:
+            if not self.loadCache(filename):
+
+                # read motion block line by line into one array, each line is a frame,
+                # additional values of a line and text after the last frame are ignored
+                #
+                nChannels = self.numChannels()
+                try:
+                    data = np.loadtxt(fp, dtype=np.float64, max_rows=self.frameCount, usecols=range(nChannels), ndmin=2)
+                except ValueError as err:
+                    self.env.last_error = "BVH-File: " + str(err)
+                    return False
+
+                if len(data) < self.frameCount:
+                    self.env.last_error = "BVH-File: unexpected end of file."
+                    return False
+
+                self.calcLocRotMat(data)
+                self.saveCache(filename)
+
+            if self.env.verbose & 32:
+                for i in range(self.frameCount):
                     self.debugChanged(i)
 
         # make a copy of the pointers
@@ -552,3 +634,314 @@ class PosePrims():
         self.units = prims
         return (True, "Okay")
 
+
+class FrameCache():
+    """
+    baked animation, contains the skinned coordinates of all meshes (and the bone positions) per frame,
+    so playback of a frame is only a copy into the buffers.
+    Frames are precalculated by bake() or stored while playing. When the budget does not allow all frames,
+    a window of frames beginning with the start frame is used.
+    The cache is invalid when animation, pose corrections, assets or geometry change. This is checked
+    once when playback or baking starts (check), not per frame.
+    """
+    def __init__(self, glob):
+        self.glob = glob
+        self.env = glob.env
+        self.budget = int(self.env.config.get("anim_bake_mb", 256)) * 1048576
+        self.dtype = np.float16 if self.env.config.get("anim_bake_float16", False) else np.float32
+        self.frames = {}        # frame number -> (coordinates per mesh, bone arrays)
+        self.key = None
+        self.checked = False    # key was compared since start of playback
+        self.start = 0
+        self.count = 0
+
+    def __str__(self):
+        return ("FrameCache: " + str(len(self.frames)) + " of " + str(self.count) + " frames, " +
+                str(self.nBytes() // 1048576) + " MB")
+
+    def clear(self):
+        self.frames = {}
+        self.key = None
+        self.checked = False
+        self.count = 0
+
+    def meshes(self, bc):
+        return [bc.baseMesh] + [asset.obj for asset in bc.attachedAssets]
+
+    def currentKey(self, bc):
+        """
+        identity of animation, final poses and meshes, checksum of the rest coordinates
+        """
+        poses = [joint.finalPoses for joint in bc.bvh.bvhJointOrder]
+        meshes = self.meshes(bc)
+        geometry = [zlib.crc32(mesh.gl_coord_w) for mesh in meshes if mesh.gl_coord_w is not None]
+        return (bc.bvh, poses, meshes, geometry)
+
+    def valid(self, bc):
+        if self.key is None or bc.bvh is None:
+            return False
+        (bvh, poses, meshes, geometry) = self.currentKey(bc)
+        (kbvh, kposes, kmeshes, kgeometry) = self.key
+        return (bvh is kbvh and len(poses) == len(kposes) and all(a is b for a, b in zip(poses, kposes))
+                and len(meshes) == len(kmeshes) and all(a is b for a, b in zip(meshes, kmeshes))
+                and geometry == kgeometry)
+
+    def check(self, bc, start=0):
+        """
+        compare the key once (start of playback or baking), reinitialize the cache if invalid
+        """
+        if not self.valid(bc):
+            self.prepare(bc, start)
+        self.checked = True
+
+    def uncheck(self):
+        """
+        end of playback, the next playback compares the key again
+        """
+        self.checked = False
+
+    def missing(self):
+        return (self.count - len(self.frames))
+
+    def frameSize(self, bc):
+        itemsize = np.dtype(self.dtype).itemsize
+        ev = bc.pose_skeleton.evaluator
+        bones = ev.matPoseGlobal.nbytes + ev.matPoseVerts.nbytes + ev.poseheadPos.nbytes + ev.posetailPos.nbytes
+        return sum(len(mesh.gl_coord) for mesh in self.meshes(bc)) * itemsize + bones
+
+    def nBytes(self):
+        return sum(sum(c.nbytes for c in coords) + sum(b.nbytes for b in bones) for (coords, bones) in self.frames.values())
+
+    def prepare(self, bc, start=0):
+        """
+        (re)initialize cache for the current animation, calculate frame window from budget
+        """
+        self.clear()
+        self.key = self.currentKey(bc)
+        self.checked = True
+        self.start = start
+        self.count = min(bc.bvh.frameCount, max(1, self.budget // self.frameSize(bc)))
+        if self.count < bc.bvh.frameCount:
+            self.env.logLine(2, "FrameCache: budget allows " + str(self.count) + " of " + str(bc.bvh.frameCount) + " frames")
+
+    def inWindow(self, bc, frame):
+        return (frame - self.start) % bc.bvh.frameCount < self.count
+
+    def store(self, bc, frame):
+        """
+        store the current (posed) coordinates as frame, if frame is in window
+        """
+        if not self.checked:
+            self.check(bc, frame)
+        if not self.inWindow(bc, frame):
+            return
+        ev = bc.pose_skeleton.evaluator
+        coords = [mesh.gl_coord.astype(self.dtype) for mesh in self.meshes(bc)]
+        bones = (ev.matPoseGlobal.copy(), ev.matPoseVerts.copy(), ev.poseheadPos.copy(), ev.posetailPos.copy())
+        self.frames[frame] = (coords, bones)
+
+    def show(self, bc, frame):
+        """
+        copy a baked frame into the buffers
+
+        :return: False if frame is not available
+        """
+        if not self.checked or frame not in self.frames:
+            return False
+        (coords, bones) = self.frames[frame]
+        for mesh, c in zip(self.meshes(bc), coords):
+            mesh.gl_coord[:] = c
+        ev = bc.pose_skeleton.evaluator
+        for dest, src in zip((ev.matPoseGlobal, ev.matPoseVerts, ev.poseheadPos, ev.posetailPos), bones):
+            dest[:] = src
+        return True
+
+    def bake(self, bc, progress=None, cancel=None):
+        """
+        precalculate the missing frames of the window, pose of the current frame is restored afterwards.
+        Can run in a worker thread, the meshes must not be displayed meanwhile.
+
+        :param progress: function called with number of baked frames
+        :param cancel: function returning True to stop, missing frames are stored while playing
+        """
+        bvh = bc.bvh
+        skeleton = bc.pose_skeleton
+        self.check(bc, bvh.currentFrame)
+        t = time.time()
+        baked = 0
+        for i in range(self.count):
+            if cancel is not None and cancel():
+                break
+            frame = (self.start + i) % bvh.frameCount
+            if frame in self.frames:
+                continue
+            skeleton.pose(bvh.joints, frame)
+            self.store(bc, frame)
+            baked += 1
+            if progress is not None:
+                progress(baked)
+        skeleton.pose(bvh.joints, bvh.currentFrame)
+        self.env.logLine(8, str(self) + " baked in " + str(round(time.time() - t, 2)) + " seconds")
+
+
+class PlaybackPipeline():
+    """
+    background playback: a worker thread poses and skins frame N+1 into one of three buffers,
+    while the GUI shows frame N. The frame to calculate is determined by time (bvh.frameTime), so
+    slow machines skip frames but keep the speed of the animation.
+    The worker uses its own copy of the skeleton evaluator and own skinning engines, meshes are only
+    changed by the GUI thread in present().
+
+    statistics: produced frames, presented frames, dropped (animation frames never shown),
+    late (display ticks where a new frame was due but not ready)
+    """
+    def __init__(self, glob, numbuffers=3):
+        self.glob = glob
+        self.env = glob.env
+        self.bc = glob.baseClass
+        self.bvh = self.bc.bvh
+        self.skeleton = self.bc.pose_skeleton
+        self.evaluator = self.skeleton.evaluator.copy()
+        self.meshes = [self.bc.baseMesh] + [asset.obj for asset in self.bc.attachedAssets]
+        self.assets = list(self.bc.attachedAssets)
+
+        # skinning engines of the worker (own buffers)
+        #
+        n = self.bc.baseMesh.n_origverts
+        width = self.env.config.get("skin_influences", 8)
+        self.engines = [SkinningEngine(self.env, self.skeleton, self.skeleton.bWeights, n, width)]
+        for asset in self.assets:
+            if asset.bWeights is not None:
+                self.engines.append(SkinningEngine(self.env, self.skeleton, asset.bWeights, asset.obj.n_origverts, width))
+            else:
+                self.engines.append(None)
+
+        # buffers: frame number, coordinates per mesh, bone arrays
+        #
+        self.free = queue.Queue()
+        self.ready = queue.Queue()
+        for i in range(numbuffers):
+            coords = [np.zeros(len(mesh.gl_coord), dtype=np.float32) for mesh in self.meshes]
+            bones = [np.zeros_like(self.evaluator.matPoseGlobal), np.zeros_like(self.evaluator.matPoseVerts),
+                    np.zeros_like(self.evaluator.poseheadPos), np.zeros_like(self.evaluator.posetailPos)]
+            self.free.put([-1, coords, bones])
+
+        self.thread = None
+        self.running = False
+        self.interval = 1.0 / 24
+        self.starttime = 0.0
+        self.startframe = 0
+        self.lastframe = -1
+        self.shownframe = -1
+        self.produced = 0
+        self.presented = 0
+        self.dropped = 0
+        self.late = 0
+
+    def __str__(self):
+        return ("PlaybackPipeline: " + str(self.produced) + " produced, " + str(self.presented) + " presented, " +
+                str(self.dropped) + " dropped, " + str(self.late) + " late")
+
+    def frameAt(self, t):
+        """
+        frame number of the animation at time t (frames are looped)
+        """
+        frametime = self.bvh.frameTime if self.bvh.frameTime > 0 else self.interval
+        return (self.startframe + int((t - self.starttime) / frametime)) % self.bvh.frameCount
+
+    def start(self, fps):
+        self.interval = 1.0 / fps
+        self.startframe = self.bvh.currentFrame
+        self.starttime = time.perf_counter()
+        self.running = True
+        self.thread = threading.Thread(target=self.produce, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.env.logLine(2, str(self))
+
+    def produce(self):
+        """
+        worker: calculate the frame needed for the next display tick
+        """
+        while self.running:
+            try:
+                slot = self.free.get(timeout=0.1)
+            except queue.Empty:
+                continue
+
+            # wait until a new frame is needed
+            #
+            frame = self.frameAt(time.perf_counter() + self.interval)
+            while self.running and frame == self.lastframe:
+                time.sleep(self.interval / 4)
+                frame = self.frameAt(time.perf_counter() + self.interval)
+            if not self.running:
+                self.free.put(slot)
+                break
+
+            self.calculate(frame, slot)
+            self.lastframe = frame
+            self.produced += 1
+            self.ready.put(slot)
+
+    def calculate(self, frame, slot):
+        (dummy, coords, bones) = slot
+        ev = self.evaluator
+        self.skeleton.setJointPoses(self.bvh.joints, frame, ev)
+        ev.evaluate()
+
+        base = self.meshes[0]
+        self.engines[0].skin(base, ev.matPoseVerts, coords[0])
+        b = np.reshape(coords[0], (-1, 3))
+        for i, asset in enumerate(self.assets, start=1):
+            if self.engines[i] is not None:
+                self.engines[i].skin(asset.obj, ev.matPoseVerts, coords[i])
+            else:
+                c = np.reshape(coords[i], (-1, 3))
+                asset.fitToBase(b, c[:len(asset.ref_vIdxs)])
+                asset.obj.overflowCorrection(coords[i])
+
+        for dest, src in zip(bones, (ev.matPoseGlobal, ev.matPoseVerts, ev.poseheadPos, ev.posetailPos)):
+            dest[:] = src
+        slot[0] = frame
+
+    def present(self):
+        """
+        GUI thread: copy newest calculated frame into the buffers of the meshes, older ones are dropped
+
+        :return: False when no new frame is available
+        """
+        slot = None
+        while True:
+            try:
+                newer = self.ready.get_nowait()
+            except queue.Empty:
+                break
+            if slot is not None:
+                self.free.put(slot)
+            slot = newer
+
+        if slot is None:
+            if self.frameAt(time.perf_counter()) != self.shownframe:
+                self.late += 1
+            return False
+
+        (frame, coords, bones) = slot
+        for mesh, c in zip(self.meshes, coords):
+            mesh.gl_coord[:] = c
+        ev = self.skeleton.evaluator
+        for dest, src in zip((ev.matPoseGlobal, ev.matPoseVerts, ev.poseheadPos, ev.posetailPos), bones):
+            dest[:] = src
+        self.free.put(slot)
+
+        if self.shownframe >= 0:
+            self.dropped += (frame - self.shownframe - 1) % self.bvh.frameCount
+        self.shownframe = frame
+        self.bvh.currentFrame = frame
+        self.presented += 1
+        return True
@@ -3,23 +3,248 @@
     Author: black-punkduck
 
     Classes:
+    * SkeletonEvaluator
     * cBone
     * boneWeights
 """
 
+import os
 import numpy as np
 import core.math as mquat
 
+class SkeletonEvaluator:
+    """
+    structure of arrays for all bones of a skeleton. Each matrix type is kept in a stacked
+    (bones, 4, 4) array, the index of a bone is its position in skeleton.bones (parents are always in front
+    of their children). Global matrices are calculated level by level with batched matmuls.
+    The cBone attributes are views into these arrays.
+    """
+    def __init__(self, numbones):
+        self.numbones = numbones
+        self.parent = np.full(numbones, -1, dtype=np.intp)
+        self.levels = []        # per level: (bone indices, parent indices)
+
+        ident = np.tile(np.identity(4, dtype=np.float32), (numbones, 1, 1))
+        self.matRestGlobal = ident.copy()
+        self.invRestGlobal = ident.copy()
+        self.matRestLocal  = ident.copy()
+        self.matPoseLocal  = ident.copy()
+        self.matPoseGlobal = ident.copy()
+        self.matPoseVerts  = ident.copy()
+
+        self.headPos = np.zeros((numbones, 3), dtype=np.float32)
+        self.tailPos = np.zeros((numbones, 3), dtype=np.float32)
+        self.poseheadPos = np.zeros((numbones, 3), dtype=np.float32)
+        self.posetailPos = np.zeros((numbones, 3), dtype=np.float32)
+        self.length = np.zeros(numbones, dtype=np.float32)
+
+        self.jointverts = None  # flat vertex numbers of all head and tail joints
+        self.jointstart = None  # start of each joint in jointverts
+        self.jointcount = None  # number of vertices per joint
+
+    def __str__(self):
+        return ("SkeletonEvaluator: " + str(self.numbones) + " bones, " + str(len(self.levels)) + " levels")
+
+    def copy(self):
+        """
+        independent copy (e.g. to pose in another thread)
+        """
+        ev = SkeletonEvaluator(0)
+        for key, value in self.__dict__.items():
+            setattr(ev, key, value.copy() if isinstance(value, np.ndarray) else value)
+        return ev
+
+    def finish(self):
+        """
+        called when all bones are added, creates the level table
+        """
+        level = np.zeros(self.numbones, dtype=np.intp)
+        for i in range(self.numbones):
+            if self.parent[i] >= 0:
+                level[i] = level[self.parent[i]] + 1
+        self.levels = []
+        for l in range(int(level.max()) + 1 if self.numbones > 0 else 0):
+            indices = np.flatnonzero(level == l)
+            self.levels.append((indices, self.parent[indices]))
+
+    def setJoints(self, joints):
+        """
+        :param joints: list of vertex lists, for each bone head and tail (2 * bones)
+        """
+        self.jointcount = np.asarray([len(j) for j in joints], dtype=np.intp)
+        self.jointstart = np.cumsum(self.jointcount) - self.jointcount
+        self.jointverts = np.concatenate([np.asarray(j, dtype=np.intp) for j in joints])
+
+    def jointPositions(self, coords):
+        """
+        head and tail positions as mean position of the joint vertices
+
+        :param coords: flat coordinates like gl_coord
+        """
+        pos = np.reshape(coords, (-1, 3))[self.jointverts].astype(np.float64)
+        mean = np.add.reduceat(pos, self.jointstart, axis=0) / self.jointcount[:, None]
+        self.headPos[:] = mean[0::2]
+        self.tailPos[:] = mean[1::2]
+
+    def restMatrices(self, normals):
+        """
+        rest matrices of all bones: orthonormal base from bone direction and normal of the rotation plane,
+        head position as translation
+
+        :param normals: normal per bone, shape (bones, 3)
+        :return: None or index of the bone where no inverse can be calculated
+        """
+        diff = self.tailPos - self.headPos
+        self.length[:] = np.linalg.norm(diff, axis=1)
+        bone_direction = diff / self.length[:, None]
+
+        # orthonormal base, perpendicular vector to normal / bone_direction needed (cross-product)
+        #
+        cross = np.cross(normals, bone_direction)
+        nrm = np.linalg.norm(cross, axis=1)
+        z_axis = np.tile(np.array([0.0, 0.0, 1.0]), (self.numbones, 1))
+        valid = nrm != 0.0
+        z_axis[valid] = cross[valid] / nrm[valid, None]
+
+        # one axis missing, so same with z_axis / bone_direction
+        #
+        cross = np.cross(bone_direction, z_axis)
+        x_axis = cross / np.linalg.norm(cross, axis=1)[:, None]
+
+        mat = self.matRestGlobal
+        mat[:] = np.identity(4, dtype=np.float32)
+        mat[:,:3,0] = x_axis            # bone local X axis
+        mat[:,:3,1] = bone_direction    # bone local Y axis
+        mat[:,:3,2] = z_axis            # bone local Z axis
+        mat[:,:3,3] = self.headPos      # head position as translation
+
+        try:
+            self.invRestGlobal[:] = np.linalg.inv(mat)
+        except np.linalg.LinAlgError:
+            for i in range(self.numbones):
+                try:
+                    np.linalg.inv(mat[i])
+                except np.linalg.LinAlgError:
+                    return i
+
+        self.matRestLocal[:] = mat
+        for indices, parents in self.levels[1:]:
+            self.matRestLocal[indices] = np.matmul(self.invRestGlobal[parents], mat[indices])
+        return None
+
+    def restPose(self, indices=None):
+        if indices is None:
+            self.matPoseLocal[:] = np.identity(4, dtype=np.float32)
+        else:
+            self.matPoseLocal[indices] = np.identity(4, dtype=np.float32)
+
+    def setLocalPoses(self, indices, poses):
+        """
+        set local pose matrices, rotation is transformed to bone space, translation (if available)
+        is described in bone-local axis directions
+
+        :param indices: bone indices
+        :param poses: list or array of pose matrices (3x3, 3x4 or 4x4)
+        """
+        if len(indices) == 0:
+            return
+        indices = np.asarray(indices, dtype=np.intp)
+        if isinstance(poses, np.ndarray):
+            rot = poses[:,:3,:3]
+            trans = poses[:,:3,3] if poses.shape[2] == 4 else None
+        else:
+            rot = np.zeros((len(poses), 3, 3), dtype=np.float32)
+            trans = np.zeros((len(poses), 3), dtype=np.float32)
+            for i, m in enumerate(poses):
+                rot[i] = m[:3,:3]
+                if m.shape[1] == 4:
+                    trans[i] = m[:3,3]
+
+        # Calculate rotations
+        #
+        mat = np.tile(np.identity(4, dtype=np.float32), (len(indices), 1, 1))
+        mat[:,:3,:3] = rot
+        inv = self.invRestGlobal[indices]
+        mat = np.matmul(np.matmul(inv, mat), self.matRestGlobal[indices])
+
+        # Add translations from original
+        # Note: we generally only have translations on the root bone
+        #
+        if trans is None:
+            mat[:,:3,3] = 0.0
+        else:
+            mat[:,:3,3] = np.einsum("nij,nj->ni", inv[:,:3,:3], trans)
+        self.matPoseLocal[indices] = mat
+
+    def evaluate(self):
+        """
+        global pose matrices level by level, skinning matrices and posed head/tail positions
+        """
+        local = np.matmul(self.matRestLocal, self.matPoseLocal)
+        for l, (indices, parents) in enumerate(self.levels):
+            if l == 0:
+                self.matPoseGlobal[indices] = local[indices]
+            else:
+                self.matPoseGlobal[indices] = np.matmul(self.matPoseGlobal[parents], local[indices])
+        np.matmul(self.matPoseGlobal, self.invRestGlobal, out=self.matPoseVerts)
+        self.posePositions()
+
+    def evaluateBone(self, i):
+        """
+        global pose matrix of one bone, parent must be calculated
+        """
+        local = np.matmul(self.matRestLocal[i], self.matPoseLocal[i])
+        p = self.parent[i]
+        self.matPoseGlobal[i] = local if p < 0 else np.matmul(self.matPoseGlobal[p], local)
+        self.matPoseVerts[i] = np.matmul(self.matPoseGlobal[i], self.invRestGlobal[i])
+
+    def posePositions(self, indices=slice(None)):
+        m = self.matPoseVerts[indices]
+        self.poseheadPos[indices] = np.einsum("nij,nj->ni", m[:,:3,:3], self.headPos[indices]) + m[:,:3,3]
+        self.posetailPos[indices] = np.einsum("nij,nj->ni", m[:,:3,:3], self.tailPos[indices]) + m[:,:3,3]
+
+
+def boneArray(name):
+    """
+    property for cBone, view into the array of the evaluator
+    """
+    def getter(self):
+        return getattr(self.skeleton.evaluator, name)[self.index]
+
+    def setter(self, value):
+        getattr(self.skeleton.evaluator, name)[self.index] = value
+
+    return property(getter, setter)
+
+
 class cBone():
+    """
+    matrices and positions of a bone are views into the arrays of the skeleton evaluator
+    """
+    matRestGlobal = boneArray("matRestGlobal")  # rest Pose, global position 4x4 Matrix of bone object
+    invRestGlobal = boneArray("invRestGlobal")  # inverse global Matrix (to do less calculation)
+    matRestLocal  = boneArray("matRestLocal")   # rest Pose, relative (local)  position 4x4 Matrix of bone object
+    matPoseGlobal = boneArray("matPoseGlobal")  # global pose matrix
+    matPoseLocal  = boneArray("matPoseLocal")   # relative pose matrix
+    matPoseVerts  = boneArray("matPoseVerts")   # result of matRestLocal X matPoseLocal X inv(matRestGlobal)
+                                                # to calculate vertices for openGL
+    headPos     = boneArray("headPos")          # coordinates for head and tail
+    tailPos     = boneArray("tailPos")
+    poseheadPos = boneArray("poseheadPos")      # same for posing
+    posetailPos = boneArray("posetailPos")
+    length      = boneArray("length")           # length of bone
+
     def __init__(self, skel, name, parent, head, tail, localplane=0, reference=None, weights=None):
         """
         headPos and tailPos should be in world space coordinates (relative to root).
         parent should be None for a root bone.
+        bones must be created in skeleton order, the evaluator of the skeleton must exist
         """
         self.glob = skel.glob
         self.parentname = parent
         self.name = name
         self.skeleton = skel
+        self.index = len(skel.bones)
         self.children = []
         self.reference = []
         self.weightref = None
@@ -30,6 +255,7 @@ class cBone():
             self.parent = skel.bones[parent]
             self.parent.children.append(self)
             self.level = self.parent.level + 1
+            skel.evaluator.parent[self.index] = self.parent.index
         else:
             self.parent = None
             self.level = 0
@@ -38,17 +264,6 @@ class cBone():
         self.tail = tail
         self.localplane = localplane
 
-        # coordinates for head and tail
-        #
-        self.headPos = np.zeros(3,dtype=np.float32)
-        self.tailPos = np.zeros(3,dtype=np.float32)
-        self.setJointPos()
-
-        # same for posing
-        #
-        self.poseheadPos = np.zeros(3,dtype=np.float32)
-        self.posetailPos = np.zeros(3,dtype=np.float32)
-
         # reference bones (used for mapped skeletons)
         #
         if reference is not None:
@@ -57,18 +272,6 @@ class cBone():
         if weights is not None:
             self.weightref = weights
 
-        self.matRestGlobal = None       # rest Pose, global position 4x4 Matrix of bone object
-        self.invRestGlobal = None       # inverse global Matrix (to do less calculation)
-        self.matRestLocal = None        # rest Pose, relative (local)  position 4x4 Matrix of bone object
-
-        self.matPoseGlobal = None                       # global pose matrix
-        self.matPoseLocal = np.identity(4, np.float32)  # relative pose matrix
-
-        self.matPoseVerts = None        # result of matRestLocal X matPoseLocal X inv(matRestGlobal)
-                                        # to calculate vertices for openGL
-
-        self.length = 0                 # length of bone
-
     def __str__(self):
         return (self.name + " Level: " + str(self.level) + " Children " + str(len(self.children)))
 
@@ -152,94 +355,17 @@ class cBone():
         self.headPos[:] = self.skeleton.mesh.getMeanPosition(self.skeleton.jointVerts[self.head])
         self.tailPos[:] = self.skeleton.mesh.getMeanPosition(self.skeleton.jointVerts[self.tail])
 
-    def calcLocalRestMat(self, normal):
-
-        mat = np.identity(4, dtype=np.float32)
-
-        # create a normalized bone vector
-        #
-        diff = self.tailPos - self.headPos
-        self.length = np.linalg.norm(diff)
-        bone_direction = diff / self.length
-
-        # orthonormal base, perpendicular vector to normal / bone_direction needed (cross-product)
-        #
-        cross = np.cross(normal, bone_direction)
-        nrm = np.linalg.norm(cross)
-        if nrm != 0.0:
-            z_axis = cross / nrm 
-        else:
-            z_axis = np.array([0.0, 0.0, 1.0])
-
-        # one axis missing, so same with z_axis / bone_direction
-        #
-        cross = np.cross(bone_direction, z_axis)
-        x_axis = cross / np.linalg.norm(cross)
-
-        # Now we construct our orthonormal base
-        mat[:3,0] = x_axis[:3]          # bone local X axis
-        mat[:3,1] = bone_direction[:3]  # bone local Y axis
-        mat[:3,2] = z_axis[:3]          # bone local Z axis
-        mat[:3,3] = self.headPos[:3]            # head position as translation
-        return mat
-
-
-    def calcRestMatFromSkeleton(self):
-        normal = self.getNormal()
-        self.matRestGlobal = self.calcLocalRestMat(normal)
-
-        try:
-            self.invRestGlobal = np.linalg.inv(self.matRestGlobal)
-        except:
-            self.glob.env.logLine(1, "Cannot calculate pose verts matrix for bone " + self.name)
-            self.glob.env.logLine(1, "Non-singular rest matrix " + str(self.matRestGlobal))
-            return False
-
-        if self.parent:
-            self.matRestLocal = np.dot(np.linalg.inv(self.parent.matRestGlobal), self.matRestGlobal)
-        else:
-            self.matRestLocal = self.matRestGlobal
-        return True
-
-
     def restPose(self):
-        self.matPoseLocal = np.identity(4, dtype=np.float32)
+        self.skeleton.evaluator.restPose([self.index])
 
     def calcLocalPoseMat(self, poseMat):
-        self.matPoseLocal = np.identity(4, dtype=np.float32)
-
-        # Calculate rotations
-        self.matPoseLocal[:3,:3] = poseMat[:3,:3]
-        self.matPoseLocal = np.dot(np.dot(self.invRestGlobal, self.matPoseLocal), self.matRestGlobal)
-
-        # Add translations from original
-        if poseMat.shape[1] == 4:
-            # Note: we generally only have translations on the root bone
-            trans = poseMat[:3,3]
-            # print (self.name + " " + str(trans))
-            trans = np.dot(self.invRestGlobal[:3,:3], trans.T)  # Describe translation in bone-local axis directions
-            self.matPoseLocal[:3,3] = trans.T
-        else:
-            # No translation
-            self.matPoseLocal[:3,3] = [0, 0, 0]
+        self.skeleton.evaluator.setLocalPoses([self.index], [poseMat])
 
     def calcGlobalPoseMat(self):
-        if self.parent:
-            self.matPoseGlobal = np.dot(self.parent.matPoseGlobal, np.dot(self.matRestLocal, self.matPoseLocal))
-        else:
-            self.matPoseGlobal = np.dot(self.matRestLocal, self.matPoseLocal)
-
-        self.matPoseVerts = np.dot(self.matPoseGlobal, self.invRestGlobal)
+        self.skeleton.evaluator.evaluateBone(self.index)
 
     def poseBone(self):
-        m = np.ones(4)
-        m[:3] = self.headPos
-        vec = np.dot(self.matPoseVerts, m.transpose())
-        self.poseheadPos = vec.transpose()[:3]
-        m = np.ones(4)
-        m[:3] = self.tailPos
-        vec = np.dot(self.matPoseVerts, m.transpose())
-        self.posetailPos = vec.transpose()[:3]
+        self.skeleton.evaluator.posePositions([self.index])
 
 
 
@@ -251,69 +377,78 @@ class boneWeights():
         self.root = default_skeleton.root
         self.bWeights = {}
         self.mesh = mesh
+        self.skinning = None    # packed weights, see SkinningEngine
+        self.filename = None    # weight file, if loaded from file
 
     def debug(self, text):
         self.env.logLine(2, "boneWeights: " +  text)
 
     def createWeightsPerBone(self, wdict):
+        """
+        :param wdict: bone: [(vertex, weight), ...] as read from weight file
+        """
+        bones = []
+        arrays = []
+        for bone, g in wdict.items():
+            if len(g) == 0:
+                continue
+            bones.append(bone)
+            arrays.append(np.reshape(np.asarray(g, dtype=np.float64), (-1, 2)))
+
+        counts = [len(arr) for arr in arrays]
+        if len(arrays) > 0:
+            flat = np.concatenate(arrays)
+        else:
+            flat = np.zeros((0, 2))
+        self.createWeightsFromArrays(bones, counts, flat[:,0].astype(np.uint32), flat[:,1].astype(np.float32))
+
+    def createWeightsFromArrays(self, bones, counts, verts, weights):
+        """
+        bone weights from flat (bone, vertex, weight) arrays, the entries of one bone are consecutive
+
+        :param bones: list of bone names
+        :param counts: number of entries per bone
+        :param verts: vertex numbers
+        :param weights: weights
+        """
         cnt = self.mesh.n_origverts
+        self.skinning = None
 
         # calculate sums to normalize weights
         #
         wtot = np.zeros(cnt, np.float32)
+        np.add.at(wtot, verts, weights)
 
-        for bone, g in wdict.items():
-            for item in g:
-                vn,w = item
-                wtot[vn] += w
-
-        # calculate weights
+        # calculate weights, sort by bone and vertex index, filter out weights under the threshold
         #
-        for bone, g in wdict.items():
-            if len(g) == 0:
-                continue
-            verts = []
-            weights = []
-            for vn, w in g:
-                verts.append(vn)
-                weights.append(w / wtot[vn])
-            verts = np.asarray(verts, dtype=np.uint32)
-            weights = np.asarray(weights, np.float32)
-
-            # Sort by vertex index
-            #
-            i_s = np.argsort(verts)
-            verts = verts[i_s]
-            weights = weights[i_s]
-
-            # Filter out weights under the threshold
-            #
-            i_s = np.argwhere(weights > 1e-4)[:,0]
-            verts = verts[i_s]
-            weights = weights[i_s]
-            self.bWeights[bone] = (verts, weights)
+        boneindex = np.repeat(np.arange(len(bones)), counts)
+        weights = weights / wtot[verts]
+        order = np.lexsort((verts, boneindex))
+        order = order[weights[order] > 1e-4]
+        ends = np.searchsorted(boneindex[order], np.arange(len(bones)), side="right")
+        start = 0
+        for bone, end in zip(bones, ends):
+            sel = order[start:end]
+            self.bWeights[bone] = (verts[sel], weights[sel])
+            start = end
 
         # assign rest to root bone
         #
         if self.root not in self.bWeights:
-            vs = []
-            ws = []
+            vs = np.zeros(0, dtype=np.uint32)
+            ws = np.zeros(0, dtype=np.float32)
         else:
             vs,ws = self.bWeights[self.root]
-            vs = list(vs)
-            ws = list(ws)
 
         rw_i = np.argwhere(wtot == 0.0)[:,0]
-        vs.extend(rw_i)
-        ws.extend(np.ones(len(rw_i), dtype=np.float32))
 
         if len(rw_i) > 0:
             # get first 20 as an example if any
             text = ', '.join([str(s) for s in rw_i][:20])
             self.debug("Unweighted vertices assigned to:" + self.root + " " +  text)
 
-        if len(vs) > 0:
-            self.bWeights[self.root] = (np.asarray(vs, dtype=np.uint32), np.asarray(ws, dtype=np.float32))
+        if len(vs) + len(rw_i) > 0:
+            self.bWeights[self.root] = (np.concatenate((vs, rw_i)).astype(np.uint32), np.concatenate((ws, np.ones(len(rw_i), dtype=np.float32))))
 
     def sortWeights(self, weights):
         """
@@ -333,63 +468,66 @@ class boneWeights():
         weight arrays must be sorted
         for assets weights are calculated using 3 values from the base mesh, this means that values are used multiple times
         the skinning algorithm expects them once. This procedure is doing that by using np.unique to get occurences
+        and adds the weights of each group
         """
 
         for bone in weights:
             v, w = weights[bone]
+            if len(v) == 0:
+                continue
             m, ind = np.unique(v, return_index=True)
-            m, cnt = np.unique(v, return_counts=True)
-
-            # in m values, in ind positions to get initial weights from, in cnt count how many others to add
-            # we now can organize the new weights array and then set or add the values
-            #
-            sumweights = np.zeros(len(m), dtype=np.float32)
-            i = 0
-            for x in m:
-                pos = ind[i]
-                sumw = w[pos]
-                for l in range(1,cnt[i]):
-                    sumw +=  w[pos+l]
-                sumweights[i] = sumw
-                i+=1
-            weights[bone] = (m, sumweights)
+            weights[bone] = (m, np.add.reduceat(w, ind).astype(np.float32))
 
         return weights
 
 
     def approxWeights(self, asset, base):
+        """
+        create bone weights from base, each asset vertex gets the weights of its reference vertices
+        multiplied with the reference weight
+        """
+        # table base vertex -> (asset vertex, reference weight), sorted by base vertex
         #
-        # create bone weights from base
-
-        # recalculate the input in case of mesh loaded in binary form for easier calculation (tested)
-        # form is:
-        # vertex_num: baseskeleton: [(vertexnum_asset, weight), (...) ]
-
-        self.vertWeights = {}
-        for idx in range(asset.ref_vIdxs.shape[0]):
-            for l in range(0,3):
-                base_vert, w = asset.ref_vIdxs[idx, l], asset.weights[idx, l]
-                if base_vert in self.vertWeights:
-                    self.vertWeights[base_vert].append((idx, w))
-                else:
-                    self.vertWeights[base_vert] = [(idx, w)]
-
-        # now generate the weights to be calculated by createWeightsPerBone
+        refbase = asset.ref_vIdxs.ravel()
+        order = np.argsort(refbase, kind="stable")
+        refasset = (np.arange(len(refbase)) // 3)[order]
+        refweight = asset.weights.ravel()[order]
+        refcount = np.bincount(refbase, minlength=1)
+        refstart = np.cumsum(refcount) - refcount
+
+        # now generate the weights for all bones: each base vertex of the bone is expanded
+        # to the asset vertices referencing it
         #
-        weights = {}
+        bones = []
+        counts = []
+        verts = []
+        weights = []
         for bname, (indxs, wghts) in list(base.bWeights.items()):
-            vgroup = []
-            for (base_vert,wt) in zip(indxs, wghts):
-                if base_vert in self.vertWeights:
-                    vlist = self.vertWeights[base_vert]
-                    for (pv, w) in vlist:
-                        pw = w*wt
-                        if (pw > 1e-4):
-                            vgroup.append((pv, pw))
-
-            if len(vgroup) > 0:
-                weights[bname] = vgroup
-        self.createWeightsPerBone (weights)
+            indxs = np.asarray(indxs, dtype=np.intp)
+            inside = indxs < len(refcount)
+            indxs = indxs[inside]
+            wghts = np.asarray(wghts, dtype=np.float32)[inside]
+            n = refcount[indxs]
+            total = int(n.sum())
+            if total == 0:
+                continue
+            pos = np.repeat(refstart[indxs] - np.cumsum(n) + n, n) + np.arange(total)
+            pw = refweight[pos] * np.repeat(wghts, n)
+            keep = pw > 1e-4
+            if not keep.any():
+                continue
+            bones.append(bname)
+            counts.append(int(keep.sum()))
+            verts.append(refasset[pos][keep])
+            weights.append(pw[keep])
+
+        if len(bones) > 0:
+            verts = np.concatenate(verts).astype(np.uint32)
+            weights = np.concatenate(weights)
+        else:
+            verts = np.zeros(0, dtype=np.uint32)
+            weights = np.zeros(0, dtype=np.float32)
+        self.createWeightsFromArrays(bones, counts, verts, weights)
 
         # since the algorithm above also creates multiple values for one index it must be changed to unique
         #
@@ -498,5 +636,59 @@ class boneWeights():
             return False
 
         self.createWeightsPerBone (json["weights"])
+        self.filename = path
+        return True
+
+    def saveBinary(self, filename, key):
+        """
+        save weights in compact form: bone names, number of entries per bone, all vertices and weights
+
+        :param key: string to identify the source of the weights, checked by loadBinary
+        """
+        bones = list(self.bWeights)
+        counts = np.asarray([len(self.bWeights[bone][0]) for bone in bones], dtype=np.uint32)
+        if len(bones) > 0:
+            verts = np.concatenate([self.bWeights[bone][0] for bone in bones]).astype(np.uint32)
+            weights = np.concatenate([self.bWeights[bone][1] for bone in bones]).astype(np.float32)
+        else:
+            verts = np.zeros(0, dtype=np.uint32)
+            weights = np.zeros(0, dtype=np.float32)
+
+        tmpname = filename + ".tmp"
+        try:
+            with open(tmpname, "wb") as fp:
+                np.savez(fp, key=np.array(key), bones=np.array(bones, dtype=str), counts=counts, verts=verts, weights=weights)
+            os.replace(tmpname, filename)
+        except OSError as err:
+            self.env.logLine(1, "Cannot write weights " + filename + ": " + str(err))
+            return False
+        return True
+
+    def loadBinary(self, filename, key):
+        """
+        load weights saved by saveBinary, only when key is identical
+
+        :return: False when file is not usable
+        """
+        try:
+            with np.load(filename) as npzfile:
+                if str(npzfile["key"]) != key:
+                    return False
+                bones = [str(bone) for bone in npzfile["bones"]]
+                counts = npzfile["counts"]
+                verts = npzfile["verts"]
+                weights = npzfile["weights"]
+        except (OSError, ValueError, KeyError) as err:
+            self.env.logLine(1, "Cannot read weights " + filename + ": " + str(err))
+            return False
+
+        if len(verts) > 0 and int(verts.max()) >= self.mesh.n_origverts:
+            return False
+        self.skinning = None
+        self.bWeights = {}
+        start = 0
+        for bone, cnt in zip(bones, counts):
+            self.bWeights[bone] = (verts[start:start+cnt], weights[start:start+cnt])
+            start += int(cnt)
         return True
 
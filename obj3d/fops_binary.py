@@ -4,7 +4,13 @@
 
     binary file operations on object3d
 
+    Classes:
+    * BinaryContainer
+
     Functions:
+    * dataStart
+    * writeBinaryContainer
+    * loadBinary
     * exportObj3dBinary
     * importObjValues
     * importObj3dBinary
@@ -12,9 +18,103 @@
 """
 
 import numpy as np
+import json
 import os
 from obj3d.fops_wavefront import importWaveFront
 
+# mhbin version 2: magic, length of table of contents (little endian uint64), table of contents as JSON,
+# then the uncompressed arrays, each one aligned to BINARY_ALIGN bytes
+# version 1 files are compressed npz files (zip, starting with "PK")
+#
+BINARY_MAGIC = b"MHBIN\x002\x00"
+BINARY_ALIGN = 64
+
+def dataStart(toclen):
+    return ((16 + toclen + BINARY_ALIGN - 1) // BINARY_ALIGN * BINARY_ALIGN)
+
+class BinaryContainer():
+    """
+    mhbin version 2 container. The file is opened memory mapped, the arrays are read without
+    decompression or parsing. Supports the part of the npz-interface used for mhbin files ([name] and in).
+    Arrays are copied from the mapping when accessed, so the file can be replaced while objects are in use.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.toc = {}
+        self.mapped = np.memmap(filename, dtype=np.uint8, mode='r')
+        if len(self.mapped) < 16 or bytes(self.mapped[:8]) != BINARY_MAGIC:
+            raise ValueError("Not a binary container: " + filename)
+        toclen = int(self.mapped[8:16].view('<u8')[0])
+        toc = json.loads(bytes(self.mapped[16:16+toclen]).decode("utf-8"))
+        start = dataStart(toclen)
+        for name, elem in toc["arrays"].items():
+            dtype = np.lib.format.descr_to_dtype(elem["dtype"])
+            self.toc[name] = (dtype, tuple(elem["shape"]), start + elem["offset"])
+
+    def __str__(self):
+        return ("BinaryContainer: " + self.filename + ", " + str(len(self.toc)) + " arrays")
+
+    @staticmethod
+    def isContainer(filename):
+        with open(filename, "rb") as f:
+            return (f.read(len(BINARY_MAGIC)) == BINARY_MAGIC)
+
+    def __contains__(self, name):
+        return name in self.toc
+
+    def __getitem__(self, name):
+        (dtype, shape, offset) = self.toc[name]
+        size = dtype.itemsize * int(np.prod(shape, dtype=np.int64))
+        return (self.mapped[offset:offset+size].view(dtype).reshape(shape).copy())
+
+    def close(self):
+        self.mapped = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def writeBinaryContainer(filename, content):
+    """
+    write arrays of content to a mhbin version 2 container, file is replaced atomically
+    """
+    arrays = {}
+    toc = {}
+    offset = 0
+    for name, arr in content.items():
+        arr = np.ascontiguousarray(arr)
+        offset = (offset + BINARY_ALIGN - 1) // BINARY_ALIGN * BINARY_ALIGN
+        toc[name] = {"dtype": np.lib.format.dtype_to_descr(arr.dtype), "shape": list(arr.shape), "offset": offset}
+        arrays[name] = arr
+        offset += arr.nbytes
+
+    # offsets are relative to the data part, which starts aligned after the table of contents
+    #
+    header = json.dumps({"version": 2, "arrays": toc}).encode("utf-8")
+    start = dataStart(len(header))
+
+    tmpname = filename + ".tmp"
+    with open(tmpname, "wb") as f:
+        f.write(BINARY_MAGIC)
+        f.write(np.array([len(header)], dtype='<u8').tobytes())
+        f.write(header)
+        for name, arr in arrays.items():
+            f.write(b"\0" * (start + toc[name]["offset"] - f.tell()))
+            f.write(arr.tobytes())
+    os.replace(tmpname, filename)
+
+def loadBinary(path):
+    """
+    open a mhbin file, version 2 container or version 1 (compressed npz)
+    """
+    if BinaryContainer.isContainer(path):
+        return (BinaryContainer(path))
+    return (np.load(path))
+
 def exportObj3dBinary(filename, obj, content = {}):
 
     # binary structure
@@ -37,61 +137,33 @@ def exportObj3dBinary(filename, obj, content = {}):
     # now the overflowbuffer to help OpenGL
     #
     content["overflow"] = obj.overflow 
-    ngroups = len(obj.npGrpNames)
 
-    # now the more complex calculation of the faces as
-    # index-buffer groups (i4) Element-Start, (i4) NumFaces, and a bool)
-    #
-    groupinfo = np.zeros(ngroups, dtype=np.dtype('i4,i4,?'))
-    allvertnums = 0
-    allfaces = 0
-    for num, npelem in enumerate (obj.npGrpNames):
-        cnt = 0
-        elem = npelem.decode("utf-8")
-        group = obj.loadedgroups[elem]
-        faces = group["v"]
-        lfaces = len(faces)
-        for face in faces:
-            cnt += len(face)
-        groupinfo[num] = tuple([allvertnums, lfaces, group["uv"]])
-        allvertnums += cnt
-        allfaces += lfaces
-    
-    # two flat arrays for number of verts and position
+    # faces in CSR form: offsets per face into faceverts, offsets per group into faces, uv-flag per group
+    # and the triangles of all groups with offsets per group, so no triangulation is needed when loading
     #
-    vertsperface = np.zeros(allfaces, dtype=np.dtype('i4'))
-    faceverts = np.zeros(allvertnums, dtype=np.dtype('i4'))
-    finfocnt = 0
-    fvertcnt = 0
-    for npelem in obj.npGrpNames:
-        elem = npelem.decode("utf-8")
-        group = obj.loadedgroups[elem]
-        faces = group["v"]
-        for face in faces:
-            for vert in face:
-                faceverts[fvertcnt] = vert
-                fvertcnt += 1
-            vertsperface[finfocnt] = len(face)
-            finfocnt += 1
-
-    content["groupinfo"] = groupinfo
-    content["vertsperface"] = vertsperface
-    content["faceverts"] = faceverts
-
-    obj.env.logLine(8, "Save compressed: " + filename)
+    (triangles, grouptris) = obj.triangulate(obj.faceoffsets, obj.faceverts, obj.groupfaces)
+    content["faceoffsets"] = obj.faceoffsets
+    content["faceverts"] = obj.faceverts
+    content["groupfaces"] = obj.groupfaces
+    content["groupuv"] = obj.groupuv
+    content["triangles"] = triangles
+    content["grouptris"] = grouptris
+
+    obj.env.logLine(8, "Save binary: " + filename)
     try:
-        f = open(filename, "wb")
-        np.savez_compressed(f, **content)
+        writeBinaryContainer(filename, content)
     except OSError as error:
         return (False, str(error))
-    finally:
-        f.close()
 
     return(True, None)
 
 
 def importObjValues(npzfile, obj):
-    for elem in ['header', 'grpNames', 'coord', 'uvs', 'overflow', 'groupinfo', 'vertsperface', 'faceverts']:
+    if 'faceoffsets' in npzfile:
+        needed = ['header', 'grpNames', 'coord', 'uvs', 'overflow', 'faceoffsets', 'faceverts', 'groupfaces', 'groupuv', 'triangles', 'grouptris']
+    else:
+        needed = ['header', 'grpNames', 'coord', 'uvs', 'overflow', 'groupinfo', 'vertsperface', 'faceverts']
+    for elem in needed:
         if elem not in npzfile:
             error =  "Malformed file, missing component " + elem
             return (0, error)
@@ -115,30 +187,26 @@ def importObjValues(npzfile, obj):
     obj.n_uvs   = len(obj.uvs)
     obj.overflow = npzfile["overflow"]
 
-    # regenerate groups from groupinfo, vertsperface, faceverts
-    # index-buffer groups (Start, NumFaces, bool)
+    # faces, version 1 contains number of vertices per face and groupinfo (start vertex, number of faces, uv),
+    # convert them to the offsets used in version 2, triangles are calculated
     #
-    verts = npzfile["faceverts"]
-    fsize = npzfile["vertsperface"]
-    groups = {}
-    j = 0
-    for num, elem in enumerate(npzfile["groupinfo"]):
-        start = elem[0]
-        faces = elem[1]
-        f = []
-        fs = start
-        for i in range(faces):
-            v = []
-            for k in range(0, fsize[j]):
-                v.append(verts[fs+k])
-            f.append(v)
-            fs += fsize[j]
-            j += 1
-
-        group =  obj.npGrpNames[num].decode("utf-8")
-        groups[group] = { "v": f, "uv": elem[2] }
-
-    validGeom = obj.createGLFaces(fcnt, ucnt, prim, groups)
+    if 'faceoffsets' in npzfile:
+        faceoffsets = npzfile["faceoffsets"]
+        groupfaces = npzfile["groupfaces"]
+        groupuv = npzfile["groupuv"]
+        triangles = npzfile["triangles"]
+        grouptris = npzfile["grouptris"]
+    else:
+        groupinfo = npzfile["groupinfo"]
+        faceoffsets = np.zeros(len(npzfile["vertsperface"]) + 1, dtype=np.int32)
+        np.cumsum(npzfile["vertsperface"], out=faceoffsets[1:])
+        groupfaces = np.zeros(len(groupinfo) + 1, dtype=np.int32)
+        np.cumsum(groupinfo['f1'], out=groupfaces[1:])
+        groupuv = groupinfo['f2'].astype(bool)
+        triangles = None
+        grouptris = None
+
+    validGeom = obj.createGLFacesFromArrays(fcnt, ucnt, prim, faceoffsets, npzfile["faceverts"], groupfaces, groupuv, triangles, grouptris)
     if validGeom:
         res = 2
         msg = None
@@ -150,7 +218,7 @@ def importObjValues(npzfile, obj):
 
 def importObj3dBinary(path, obj):
     obj.env.logLine(8, "Read binary: " + path)
-    npzfile = np.load(path)
+    npzfile = loadBinary(path)
     return(importObjValues(npzfile, obj))
 
 def importObjFromFile(path, obj, use_obj=False):
@@ -166,5 +234,3 @@ def importObjFromFile(path, obj, use_obj=False):
     #
     obj.env.logLine(8, "Load: " + path)
     return(importWaveFront(path, obj))
-
-
@@ -4,14 +4,270 @@
 
     file operations, wavefront OBJ
 
+    Classes:
+    * WaveFrontSyntax
+
     Functions:
+    * splitRecords
+    * readWaveFrontChunks
+    * splitFaces
+    * overflowFromUVs
+    * importWaveFrontArrays
     * importWaveFront
+    * importWaveFrontLines
 """
 
 import numpy as np
 import math
+from itertools import compress
+
+# size of a chunk of lines read at once (in characters)
+#
+CHUNKSIZE = 1 << 22
+
+class WaveFrontSyntax(Exception):
+    """
+    unusual syntax, the file must be read line by line
+    """
+    pass
+
+def splitRecords(lines, keyword, columns):
+    """
+    split lines of one record type in bulk
+
+    :param columns: number of values used, additional values are ignored
+    :return: array of float64, one row per line
+    """
+    tokens = "".join(lines).split()
+    n = len(lines)
+    k = len(tokens) // n
+    if len(tokens) != k * n or k <= columns or tokens[::k].count(keyword) != n:
+        raise WaveFrontSyntax("malformed " + keyword)
+    del tokens[::k]
+    return (np.array(tokens, dtype=np.float64).reshape(n, k - 1)[:,:columns])
+
+def readWaveFrontChunks(f, groups, groupnames, current):
+    """
+    reads an OBJ file in chunks of lines, the records are separated by their first two characters
+    and each record type is split in bulk
+
+    :param groups: dictionary to fill group name -> group number, numbers are in order of appearance
+    :param groupnames: list to fill with group names in order of appearance
+    :param current: number of the group the faces are added to before the first "g"
+    :return: objname, verts, uvs, face tokens, number of tokens per face, group per face (lists of arrays per chunk)
+    """
+    objname = None
+    verts = []
+    uvs = []
+    ftokens = []
+    fsizes = []
+    fgroups = []
+    while True:
+        lines = f.readlines(CHUNKSIZE)
+        if len(lines) == 0:
+            break
+        keys = np.array([l[:2] for l in lines])
+
+        # lines starting with whitespace are not handled
+        #
+        for i in np.flatnonzero(np.isin(keys.astype('<U1'), [" ", "\t"])):
+            if lines[i].strip() != "":
+                raise WaveFrontSyntax("line starting with whitespace")
+
+        # v, x y z (additional values like colors are ignored)
+        #
+        vlines = list(compress(lines, np.isin(keys, ["v ", "v\t"])))
+        if len(vlines) > 0:
+            verts.append(splitRecords(vlines, "v", 3))
+
+        # vt, u v (w is ignored)
+        #
+        vtlines = list(compress(lines, np.isin(keys, ["vt"])))
+        if len(vtlines) > 0:
+            uvs.append(splitRecords(vtlines, "vt", 2))
+
+        # o and g, not many of them, so they are handled line by line
+        # g changes the group only for new names (identical to line by line version)
+        #
+        gpos = np.flatnonzero(np.isin(keys, ["g ", "g\t", "o ", "o\t"]))
+        gcurrent = np.zeros(len(gpos) + 1, dtype=np.int32)
+        gcurrent[-1] = current
+        for i, n in enumerate(gpos):
+            words = lines[n].split()
+            if len(words) > 1:
+                if words[0] == "o":
+                    objname = words[1]
+                elif words[0] == "g" and words[1] not in groups:
+                    groups[words[1]] = current = len(groupnames)
+                    groupnames.append(words[1])
+            gcurrent[i] = current
+
+        # f, faces, tokens are split in bulk, "f" marks the start of a face
+        #
+        fpos = np.flatnonzero(np.isin(keys, ["f ", "f\t"]))
+        if len(fpos) > 0:
+            tokens = np.array("".join([lines[n] for n in fpos]).split())
+            start = np.flatnonzero(tokens == "f")
+            if len(start) != len(fpos):
+                raise WaveFrontSyntax("malformed face")
+            sizes = np.diff(np.append(start, len(tokens))) - 1
+            if sizes.min() < 3:
+                raise WaveFrontSyntax("face with less than 3 vertices")
+            ftokens.append(np.delete(tokens, start))
+            fsizes.append(sizes)
+
+            # group of the face is the current group after the last g or o before,
+            # faces before the first one (index -1) use the group valid at the start of the chunk
+            #
+            fgroups.append(gcurrent[np.searchsorted(gpos, fpos) - 1])
+
+    return (objname, verts, uvs, ftokens, fsizes, fgroups)
+
+def splitFaces(tokens):
+    """
+    split the vertex tokens of all faces, all tokens must have the same form: v, v/vt, v/vt/vn or v//vn
+
+    :return: vertex indices, uv indices (None if there are no uvs), both counting from 0
+    """
+    n = len(tokens)
+    slashes = np.char.count(tokens, "/")
+    k = int(slashes[0]) if n > 0 else 0
+    if not np.all(slashes == k) or k > 2:
+        raise WaveFrontSyntax("different face formats")
+
+    values = np.fromstring(" ".join(tokens.tolist()).replace("/", " "), dtype=np.int64, sep=" ")
+    if len(values) == n * (k + 1):
+        values = values.reshape(n, k + 1)
+        uvs = values[:,1] - 1 if k > 0 else None
+    elif k == 2 and len(values) == n * 2:
+        values = values.reshape(n, 2)
+        uvs = None
+    else:
+        raise WaveFrontSyntax("different face formats")
+
+    # relative (negative) indices are not supported
+    #
+    if n > 0 and values.min() < 1:
+        raise WaveFrontSyntax("relative indices")
+    return (values[:,0] - 1, uvs)
+
+def overflowFromUVs(faceverts, faceuvs, uvs, numverts):
+    """
+    vertices used with different uv coordinates are duplicated, the duplicates are appended and the indices
+    in faceverts are replaced (same result as the loop in importWaveFrontLines)
+
+    :param faceverts: vertex indices of all faces (changed in place)
+    :param faceuvs: uv indices of all faces
+    :return: uv values per vertex, overflow table [source, dest], source vertex for each appended vertex
+    """
+    uvs = uvs.astype(np.float32)
+
+    # the first uv of a vertex is used for the vertex itself
+    #
+    (verts, first) = np.unique(faceverts, return_index=True)
+    firstuv = np.zeros(numverts, dtype=np.int64)
+    firstuv[verts] = faceuvs[first]
+    uv_values = np.zeros((numverts, 2), dtype=np.float32)
+    uv_values[verts] = uvs[firstuv[verts]]
+
+    # another uv index with different values needs a new vertex, one per combination of vertex and uv
+    # new vertices are numbered in order of appearance
+    #
+    diff = np.abs(uv_values[faceverts] - uvs[faceuvs]).astype(np.float64) > 0.001
+    need = np.flatnonzero((faceuvs != firstuv[faceverts]) & (diff[:,0] | diff[:,1]))
+    (keys, first, inverse) = np.unique(faceverts[need] * len(uvs) + faceuvs[need], return_index=True, return_inverse=True)
+    order = np.argsort(first)
+    rank = np.empty(len(keys), dtype=np.int64)
+    rank[order] = np.arange(len(keys))
+    sources = faceverts[need[first[order]]]
+    newuvs = faceuvs[need[first[order]]]
+    faceverts[need] = numverts + rank[inverse]
+
+    dest = np.arange(numverts, numverts + len(keys))
+    overflowtable = np.empty((len(keys), 2), dtype=np.uint32)
+    sort = np.lexsort((dest, sources))
+    overflowtable[:,0] = sources[sort]
+    overflowtable[:,1] = dest[sort]
+    return (np.concatenate((uv_values, uvs[newuvs])), overflowtable, sources)
+
+def importWaveFrontArrays(path, obj):
+    """
+    vectorized version of importWaveFrontLines, raises WaveFrontSyntax for unusual syntax
+
+    returns: 2 okay, 1 warn, 0 error
+    """
+    try:
+        f = open(path, 'r', encoding="utf-8")
+    except IOError:
+        return (0, "Cannot open file " + path)
+
+    groups = {"mh_default": 0}
+    groupnames = ["mh_default"]
+    with f:
+        (objname, verts, uvs, ftokens, fsizes, fgroups) = readWaveFrontChunks(f, groups, groupnames, 0)
+
+    if len(fsizes) == 0:
+        raise WaveFrontSyntax("no faces")
+    verts = np.concatenate(verts) if len(verts) > 0 else np.zeros((0, 3), dtype=np.float64)
+    uvs = np.concatenate(uvs) if len(uvs) > 0 else np.zeros((0, 2), dtype=np.float64)
+    uvs[:,1] = 1 - uvs[:,1]
+    sizes = np.concatenate(fsizes)
+    fgroup = np.concatenate(fgroups)
+    (faceverts, faceuvs) = splitFaces(np.concatenate(ftokens))
+
+    # sort faces by group (order of appearance), empty groups are deleted
+    #
+    order = np.argsort(fgroup, kind="stable")
+    starts = np.cumsum(sizes) - sizes
+    sizes = sizes[order]
+    faceoffsets = np.zeros(len(sizes) + 1, dtype=np.int32)
+    np.cumsum(sizes, out=faceoffsets[1:])
+    index = np.repeat(starts[order] - faceoffsets[:-1], sizes) + np.arange(faceoffsets[-1])
+    faceverts = faceverts[index]
+
+    counts = np.bincount(fgroup, minlength=len(groupnames))
+    used = counts > 0
+    groupnames = list(compress(groupnames, used))
+    groupfaces = np.zeros(len(groupnames) + 1, dtype=np.int32)
+    np.cumsum(counts[used], out=groupfaces[1:])
+    groupuv = np.full(len(groupnames), faceuvs is not None)
+
+    # one index for UV-Buffer, Normals and coordinates, see importWaveFrontLines
+    #
+    n_origverts = len(verts)
+    if faceuvs is not None:
+        (uv_values, overflowtable, sources) = overflowFromUVs(faceverts, faceuvs[index], uvs, n_origverts)
+        verts = np.concatenate((verts, verts[sources]))
+        ucnt = len(sizes)
+    else:
+        uv_values = np.zeros((n_origverts, 2), dtype=np.float32)
+        overflowtable = np.empty((0, 2), dtype=np.uint32)
+        ucnt = 0
+
+    obj.setName(objname)
+    obj.setGroupNames(groupnames)
+    obj.createGLVertPos(verts, uv_values, overflowtable, n_origverts)
+    validGeom = obj.createGLFacesFromArrays(len(sizes), ucnt, int(np.sum(sizes - 2)), faceoffsets, faceverts.astype(np.int32), groupfaces, groupuv)
+    if validGeom:
+        res = 2
+        msg = None
+    else:
+        res = 1
+        msg = "Bad geometry, at least one normal vector of face with size 0 cannot be calculated."
+
+    return (res, msg)
 
 def importWaveFront(path, obj):
+    """
+    read OBJ file with the vectorized importer, files with unusual syntax are read line by line
+    """
+    try:
+        return (importWaveFrontArrays(path, obj))
+    except (WaveFrontSyntax, ValueError, IndexError) as error:
+        obj.env.logLine(8, "Read line by line (" + str(error) + "): " + path)
+    return (importWaveFrontLines(path, obj))
+
+def importWaveFrontLines(path, obj):
     """
     f  = face
     g  = groups are used to add faces to
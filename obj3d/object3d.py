@@ -3,14 +3,95 @@
     Author: black-punkduck
 
     Classes:
+    * DragSession
     * object3d
 """
 
 import numpy as np 
+from itertools import chain
 from obj3d.fops_binary import exportObj3dBinary, importObjFromFile
 from opengl.material import Material
 import os
 
+class DragSession:
+    """
+    precalculated data for dragging one slider (pair of targets) on a mesh:
+    flat scatter indices, contiguous deltas and scratch buffers, so each event is done without allocation
+    """
+    def __init__(self, obj, targetlower, targetupper):
+        self.obj = obj
+        self.sides = [self.createSide(obj, targetlower), self.createSide(obj, targetupper)]
+        self.last = None
+
+    def createSide(self, obj, target):
+        """
+        :return: [flat indices, deltas, scratch1, scratch2, overflow source, overflow dest, normal region] or None
+        """
+        if target is None or target.verts is None or len(target.verts) == 0:
+            return None
+        verts = np.asarray(target.verts, dtype=np.intp)
+        rows = (verts[:,None] * 3 + np.arange(3)).ravel()
+        delta = np.ascontiguousarray(target.data, dtype=np.float32).ravel()
+
+        # overflow vertices depending on this target only
+        #
+        (osrc, odst) = obj.overflowIndices()
+        mask = np.isin(osrc // 3, verts)
+        region = obj.normalRegion(verts) if obj.fverts is not None and len(obj.gl_norm) > 0 else None
+        return [rows, delta, np.empty_like(delta), np.empty_like(delta), osrc[mask], odst[mask], region]
+
+    def side(self, factor):
+        return self.sides[0] if factor < 0.0 else self.sides[1]
+
+    def initialize(self, gl_coord, gl_coord_w, factor):
+        """
+        working copy without the value of this slider: w = coord - factor * delta
+        """
+        s = self.side(factor)
+        if s is None:
+            return False
+        (rows, delta, s1, s2, osrc, odst, region) = s
+        np.multiply(delta, -abs(factor), out=s1)
+        np.take(gl_coord, rows, out=s2)
+        np.add(s1, s2, out=s1)
+        np.put(gl_coord_w, rows, s1)
+        return True
+
+    def apply(self, gl_coord, gl_coord_w, factor):
+        """
+        coord = w + factor * delta (in place), when changing the side, the other side is reset first
+        """
+        s = self.side(factor)
+        if self.last is not None and self.last is not s:
+            (rows, delta, s1, s2, osrc, odst, region) = self.last
+            np.take(gl_coord_w, rows, out=s1)
+            np.put(gl_coord, rows, s1)
+            np.put(gl_coord, odst, np.take(gl_coord, osrc))
+            self.updateNormals(self.last)
+        self.last = s
+        if s is None:
+            return
+        (rows, delta, s1, s2, osrc, odst, region) = s
+        np.multiply(delta, abs(factor), out=s1)
+        np.take(gl_coord_w, rows, out=s2)
+        np.add(s1, s2, out=s1)
+        np.put(gl_coord, rows, s1)
+        np.put(gl_coord, odst, np.take(gl_coord, osrc))
+        self.updateNormals(s)
+
+    def reset(self):
+        """
+        after the mesh is set back to working copy, normals of the last side must be recalculated
+        """
+        if self.last is not None:
+            self.updateNormals(self.last)
+        self.last = None
+
+    def updateNormals(self, s):
+        if s[6] is not None:
+            self.obj.calcNormalsRegion(s[6])
+
+
 class object3d:
     def __init__(self, glob, baseinfo, eqtype ):
  
@@ -34,10 +115,16 @@ class object3d:
         self.uvs   = []     # will contain coordinates for uvs
         self.fverts  = []   # will contain vertices per face, [verts, 3] array of uint32 for openGL > 2
         self.n_fverts = 0    # number of vertices for open gl
-        self.loadedgroups = None # will contain the group after loading from file (also for hidden geometry)
+        self.faceoffsets = None # will contain faces after loading (also for hidden geometry), offsets per face into faceverts
+        self.faceverts = None   # will contain vertex numbers of all faces
+        self.groupfaces = None  # will contain offsets per group into faces (in order of npGrpNames)
+        self.groupuv = None     # will contain a bool per group if uvs are available
         self.group = []     # will contain pointer to group per face
 
         self.overflow = None # will contain a table for double used vertices [source, dest]
+        self.overflow_index = None # will contain cached flat indices (overflow, source, dest) for overflow correction
+        self.dragsessions = {}  # will contain drag sessions per pair of targets
+        self.vface = None       # will contain cached vertex to face incidence (faces, offsets, face numbers)
 
         self.gl_coord = []    # will contain flattened gl-Buffer (these are coordinates to be changed)
         self.gl_coord_o = []  # will contain a copy of unchanged positions (TODO base mesh only ?)
@@ -173,94 +260,233 @@ class object3d:
         #    d = dest * 3
         #    arr[d:d+3]   = arr[s:s+3]  (np.tile for d:d+3)
 
-        index = np.tile(np.array([0,1,2]), len(self.overflow))
-        src = np.repeat(self.overflow[:,0], 3)*3 + index
-        dst = np.repeat(self.overflow[:,1], 3)*3 + index
+        (src, dst) = self.overflowIndices()
         arr[dst]   = arr[src]
 
-    def calcNormals(self):
+    def overflowIndices(self):
         """
-        calculates face-normals and then vertex normals
-        returns if geometry is valid (invalid: normal vector cannot be calculated)
+        flat source and destination indices for overflow correction, calculated once per overflow table
+        """
+        if self.overflow_index is None or self.overflow_index[0] is not self.overflow:
+            index = np.tile(np.array([0,1,2]), len(self.overflow))
+            src = np.repeat(self.overflow[:,0], 3)*3 + index
+            dst = np.repeat(self.overflow[:,1], 3)*3 + index
+            self.overflow_index = (self.overflow, src.astype(np.intp), dst.astype(np.intp))
+        return (self.overflow_index[1], self.overflow_index[2])
+
+    def cornerNormals(self, faces, weighting):
+        """
+        face normals per corner of the faces (3 rows per face), weighted by
+        area (cross product), angle (unit normal * angle at corner) or uniform (unit normal)
         """
-        validGeom = True
-        self.gi_norm = np.zeros((self.n_verts, 3), dtype=np.float32)
+        fvert = self.currentCoord()[self.fverts[faces]]
+        v1 = fvert[:,0,:]
+        v2 = fvert[:,1,:]
+        v3 = fvert[:,2,:]
+        fnorm = np.cross(v1 - v2, v2 - v3)
+        if weighting == "area":
+            return (np.repeat(fnorm, 3, axis=0))
+
+        length = np.linalg.norm(fnorm, axis=1)
+        length[length == 0.0] = 1.0
+        fnorm = fnorm / length[:,None]
+        if weighting != "angle":
+            return (np.repeat(fnorm, 3, axis=0))
 
-        # set the face normals for each vertex to zero, set the counter to zero
+        # angle at each corner between the two adjacent edges
         #
-        fa_norm = np.zeros((self.n_verts, 3), dtype=np.float32)
-        fa_cnt  = np.zeros(self.n_verts, dtype=np.uint32)
+        e1 = np.stack((v2 - v1, v3 - v2, v1 - v3), axis=1)
+        e2 = np.stack((v3 - v1, v1 - v2, v2 - v3), axis=1)
+        angle = np.arctan2(np.linalg.norm(np.cross(e1, e2), axis=2), np.einsum('ijk,ijk->ij', e1, e2))
+        return ((fnorm[:,None,:] * angle[:,:,None]).reshape(-1, 3))
+
+    def normalWeighting(self):
+        return (self.env.config.get("normal_weighting", "area"))
+
+    def calcNormals(self, weighting=None):
+        """
+        calculates face-normals and then vertex normals
+        returns if geometry is valid (invalid: normal vector cannot be calculated)
 
-        lfv = len(self.fverts)
-        fnorm = np.zeros((lfv,3), dtype=np.float32)
+        :param weighting: area, angle or uniform, default from configuration "normal_weighting"
+        """
+        if weighting is None:
+            weighting = self.normalWeighting()
+        n = self.n_verts
 
-        # numpy: create index to iterate and 3 vectors and put result to fnorm
-        # for elem in self.fverts:
-        #    v = self.coord[elem]
-        #    norm = np.cross(v[0] - v[1], v[1] - v[2])
+        # sum up the face normals for each of the 3 verts per triangle, count faces per vertex
         #
-        ix = np.s_[:lfv]
-        fvert = self.coord[self.fverts[ix]]
-        v1 = fvert[:,0,:]
-        v2 = fvert[:,1,:]
-        v3 = fvert[:,2,:]
-        va = v1 - v2
-        vb = v2 - v3
-        fnorm[ix] = np.cross(va, vb)
-
-        # calculate face normal and summarize them with other (for each 3 verts per triangle)
-        for ix, elem in enumerate(self.fverts):
-            fa_norm[elem[0]] += fnorm[ix]
-            fa_norm[elem[1]] += fnorm[ix]
-            fa_norm[elem[2]] += fnorm[ix]
-            fa_cnt[elem[0]] += 1
-            fa_cnt[elem[1]] += 1
-            fa_cnt[elem[2]] += 1
+        corners = np.ravel(self.fverts)
+        cnorm = self.cornerNormals(np.s_[:], weighting)
+        fa_norm = np.empty((n, 3), dtype=np.float64)
+        for k in range(0,3):
+            fa_norm[:,k] = np.bincount(corners, weights=cnorm[:,k], minlength=n)[:n]
+        fa_cnt = np.bincount(corners, minlength=n)[:n]
 
         # because part of the faces belong to the overflow buffer add them as well
+        # a source can have more than one destination, so use unbuffered add
         #
-        #for (source, dest) in self.overflow:
-        #    fa_norm[source] += fa_norm[dest]
-        #    fa_cnt[source]  += fa_cnt[dest]
-
         src = self.overflow[:,0]
         dst = self.overflow[:,1]
+        np.add.at(fa_cnt, src, fa_cnt[dst])
+        np.add.at(fa_norm, src, fa_norm[dst])
 
-        fa_cnt[src] += fa_cnt[dst]
-        fa_norm[src] += fa_norm[dst]
-
-        # now divide by the number of edges and normalize length with np.linalg.norm
-        # ignore zero weights ( fa_norm = fa_norm / fa_cnt), set these to 1.0
+        # normalize length, vertices without faces get (1,1,1),
+        # zero length means invalid geometry, these get (1,0,0)
         #
-        with np.errstate(divide='ignore', invalid='ignore'):
-            normsum = np.divide(fa_norm, np.expand_dims(fa_cnt, axis=1))
-        normsum = np.nan_to_num(normsum, nan=1.0)
-
-        # calculate norm
-        #
-        for i in range(0, len(normsum)):
-            areanorm = np.linalg.norm(normsum[i])
-            if areanorm != 0.0:
-                self.gi_norm[i] = normsum[i] / areanorm
-            else:
-                validGeom = False
-                self.gi_norm[i][0] = 1.0
-                self.gi_norm[i][1] = 0.0
-                self.gi_norm[i][2] = 0.0
+        fa_norm[fa_cnt == 0] = 1.0
+        length = np.linalg.norm(fa_norm, axis=1)
+        zero = length == 0.0
+        validGeom = not np.any(zero)
+        fa_norm[zero] = (1.0, 0.0, 0.0)
+        length[zero] = 1.0
+        self.gi_norm = (fa_norm / length[:,None]).astype(np.float32)
 
         # simply copy for the doubles in the end using overflow
         #
-        # for (source, dest) in self.overflow:
-        #    self.gi_norm[dest] =  self.gi_norm[source]
-
         self.gi_norm[dst] = self.gi_norm[src]
 
-        # flatten vector
+        # flatten vector, keep the buffer when size is identical (used by OpenGL)
         #
-        self.gl_norm = self.gi_norm.flatten()
+        if len(self.gl_norm) == self.n_verts * 3:
+            self.gl_norm[:] = self.gi_norm.ravel()
+        else:
+            self.gl_norm = self.gi_norm.flatten()
+
+        return validGeom
+
+    def currentCoord(self):
+        """
+        current positions as (n, 3) view of gl_coord, original coordinates if not yet available
+        """
+        if len(self.gl_coord) == self.n_verts * 3:
+            return (np.reshape(self.gl_coord, (-1, 3)))
+        return (self.coord)
+
+    def vertexFaces(self):
+        """
+        vertex to face incidence (CSR: offsets per vertex, face numbers), calculated once per face table
+        """
+        if self.vface is None or self.vface[0] is not self.fverts:
+            corners = np.ravel(self.fverts)
+            order = np.argsort(corners, kind='stable')
+            counts = np.bincount(corners, minlength=self.n_verts)
+            offsets = np.zeros(len(counts) + 1, dtype=np.intp)
+            np.cumsum(counts, out=offsets[1:])
+            faces = (order // self.fverts.shape[1]).astype(np.intp)
+            self.vface = (self.fverts, offsets, faces)
+        return (self.vface[1], self.vface[2])
+
+    def incidentFaces(self, verts):
+        """
+        all faces using one of the vertices
+        """
+        (offsets, faces) = self.vertexFaces()
+        starts = offsets[verts]
+        counts = offsets[verts+1] - starts
+        index = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        return (np.unique(faces[index]))
+
+    def overflowClosure(self, verts):
+        """
+        add the overflow partners (source and destination) of the vertices
+        """
+        if self.overflow is None or len(self.overflow) == 0:
+            return (verts)
+        src = self.overflow[:,0]
+        dst = self.overflow[:,1]
+        mask = np.isin(src, verts) | np.isin(dst, verts)
+        return (np.union1d(verts, np.concatenate((src[mask], dst[mask])).astype(np.intp)))
+
+    def normalRegion(self, verts):
+        """
+        precalculate what is needed to update the normals influenced by moving vertices:
+        the vertices of all faces around the moved vertices (one-ring) and all faces of the one-ring
+
+        :param verts: moved vertices
+        :return: [ring, faces, corners (local index or -1), overflow source, overflow dest (local)]
+        """
+        verts = self.overflowClosure(np.unique(np.asarray(verts, dtype=np.intp)))
+        ring = self.overflowClosure(np.unique(self.fverts[self.incidentFaces(verts)]).astype(np.intp))
+        faces = self.incidentFaces(ring)
+        lut = np.full(self.n_verts, -1, dtype=np.intp)
+        lut[ring] = np.arange(len(ring))
+        corners = lut[self.fverts[faces]].ravel()
+        ovsrc = np.zeros(0, dtype=np.intp)
+        ovdst = np.zeros(0, dtype=np.intp)
+        if self.overflow is not None and len(self.overflow) > 0:
+            mask = lut[self.overflow[:,0]] >= 0
+            ovsrc = lut[self.overflow[mask,0]]
+            ovdst = lut[self.overflow[mask,1]]
+        return ([ring, faces, corners, ovsrc, ovdst])
+
+    def calcNormalsRegion(self, region):
+        """
+        recalculate normals of a region only (see normalRegion), same result as calcNormals,
+        gl_norm is changed in place
+        """
+        (ring, faces, corners, ovsrc, ovdst) = region
+        if len(ring) == 0:
+            return True
+        fnorm = self.cornerNormals(faces, self.normalWeighting())
 
+        # sum up face normals of the ring vertices, add overflow
+        #
+        n = len(ring)
+        mask = corners >= 0
+        c = corners[mask]
+        fnorm = fnorm[mask]
+        fa_norm = np.empty((n, 3), dtype=np.float64)
+        for k in range(0,3):
+            fa_norm[:,k] = np.bincount(c, weights=fnorm[:,k], minlength=n)
+        fa_cnt = np.bincount(c, minlength=n)
+        np.add.at(fa_cnt, ovsrc, fa_cnt[ovdst])
+        np.add.at(fa_norm, ovsrc, fa_norm[ovdst])
+
+        # normalize, vertices without face get (1,1,1), zero normals (1,0,0)
+        #
+        fa_norm[fa_cnt == 0] = 1.0
+        length = np.linalg.norm(fa_norm, axis=1)
+        zero = length == 0.0
+        validGeom = not np.any(zero)
+        fa_norm[zero] = (1.0, 0.0, 0.0)
+        length[zero] = 1.0
+        fa_norm /= length[:,None]
+
+        norm = np.reshape(self.gl_norm, (-1, 3))
+        norm[ring] = fa_norm
+        norm[ring[ovdst]] = norm[ring[ovsrc]]
         return validGeom
 
+    def visibleGroups(self, overrideignore=False):
+        """
+        bool per group (in order of npGrpNames) if group is visible
+        """
+        if self.visible is None or overrideignore:
+            return np.ones(self.n_groups, dtype=bool)
+        return np.array([elem.decode("utf-8") in self.visible for elem in self.npGrpNames], dtype=bool)
+
+    def usedFaceVerts(self, mask, overrideignore=False):
+        """
+        used vertices per face of the visible groups and a bool per entry of faceverts if it is used
+
+        :param mask: calculates if faces are used
+        :param overrideignore: normaly used when the helper as invisible group should also be considered
+        """
+        nverts = np.diff(self.faceoffsets)
+        faces = np.repeat(self.visibleGroups(overrideignore), np.diff(self.groupfaces))
+        used = np.repeat(faces, nverts)
+        if mask is None:
+            return (nverts * faces, used)
+
+        # otherwise we need 3 indices minimum to create a face
+        #
+        used &= (mask[self.faceverts] == 1)
+        counts = np.bincount(np.repeat(np.arange(len(nverts)), nverts), weights=used, minlength=len(nverts)).astype(np.int32)
+        counts[counts < 3] = 0
+        used &= np.repeat(counts > 0, nverts)
+        return (counts, used)
+
     def calcFaceBufSize(self, mask, overrideignore=False):
         """
         create buffersizes for vertsperface, faceverts buffer
@@ -268,32 +494,8 @@ class object3d:
         :param mask: calculates if faces are used
         :param overrideignore: normaly used when the helper as invisible group should also be considered
         """
-        numfaces = 0
-        numind = 0
-        for npelem in self.npGrpNames:
-            elem = npelem.decode("utf-8")
-            if self.visible is not None and elem not in self.visible and not overrideignore:
-                continue
-            faces = self.loadedgroups[elem]["v"]
-            if mask is None:
-                # simple case, just count indices and faces
-                #
-                for face in faces:
-                    numind += len(face)
-                numfaces += len(faces)
-            else:
-                # otherwise we need 3 indices minimum to create a face
-                #
-                for face in faces:
-                    nind = 0
-                    for vert in face:
-                        if mask[vert] == 1:
-                            nind +=1
-                    if nind > 2:
-                        numind += nind
-                        numfaces += 1
-
-        return numind, numfaces
+        (counts, used) = self.usedFaceVerts(mask, overrideignore)
+        return int(np.count_nonzero(used)), int(np.count_nonzero(counts))
 
     def fillFaceBuffers(self, vertsperface, faceverts, mask, overrideignore=False):
         """
@@ -304,43 +506,14 @@ class object3d:
         :param mask: calculates if faces are used
         :param overrideignore: normaly used when the helper as invisible group should also be considered
         """
-        finfocnt = 0
-        fvertcnt = 0
-        highest = 0
-        for npelem in self.npGrpNames:
-            elem = npelem.decode("utf-8")
-            if self.visible is not None and elem not in self.visible and not overrideignore:
-                continue
-            group = self.loadedgroups[elem]
-            faces = group["v"]
-            if mask is None:
-                for face in faces:
-                    for vert in face:
-                        if vert < self.n_origverts:
-                            if vert > highest:
-                                highest = vert
-                        faceverts[fvertcnt] = vert
-                        fvertcnt += 1
-                    vertsperface[finfocnt] = len(face)
-                    finfocnt += 1
-            else:
-                for face in faces:
-                    nind = 0
-                    for vert in face:
-                        if mask[vert] == 1:
-                            nind +=1
-                    if nind > 2:
-                        for vert in face:
-                            if mask[vert] == 1:
-                                if vert < self.n_origverts:
-                                    if vert > highest:
-                                        highest = vert
-                                faceverts[fvertcnt] = vert
-                                fvertcnt += 1
-                        vertsperface[finfocnt] = nind
-                        finfocnt += 1
-
-        return (highest + 1)
+        (counts, used) = self.usedFaceVerts(mask, overrideignore)
+        verts = self.faceverts[used]
+        counts = counts[counts > 0]
+        faceverts[:len(verts)] = verts
+        vertsperface[:len(counts)] = counts
+
+        orig = verts[verts < self.n_origverts]
+        return (int(orig.max()) + 1 if len(orig) > 0 else 1)
 
     def unUsedVerts(self, faceind):
         indlen = len(faceind)
@@ -424,38 +597,79 @@ class object3d:
 
         return (coord, norm, gl_uvcoord, vertsperface, faceverts, overflow, mapping)
 
+    def facesFromGroups(self, groups):
+        """
+        convert the faces of loaded groups (lists of vertex numbers per face) to arrays in order of npGrpNames
+
+        :return: faceoffsets, faceverts, groupfaces, groupuv
+        """
+        counts = []
+        verts = []
+        groupfaces = np.zeros(self.n_groups + 1, dtype=np.int32)
+        groupuv = np.zeros(self.n_groups, dtype=bool)
+        for num, npelem in enumerate (self.npGrpNames):
+            group = groups[npelem.decode("utf-8")]
+            faces = group["v"]
+            counts.extend(map(len, faces))
+            verts.extend(chain.from_iterable(faces))
+            groupfaces[num+1] = groupfaces[num] + len(faces)
+            groupuv[num] = group["uv"]
+
+        faceoffsets = np.zeros(len(counts) + 1, dtype=np.int32)
+        np.cumsum(counts, out=faceoffsets[1:])
+        return (faceoffsets, np.array(verts, dtype=np.int32), groupfaces, groupuv)
+
+    @staticmethod
+    def triangulate(faceoffsets, faceverts, groupfaces):
+        """
+        triangles of all faces, quads and n-gons are split as a fan [0, i, i+1] starting with vertex 0
+
+        :return: triangles (uint32, [n, 3]), offsets per group into triangles
+        """
+        ntris = np.maximum(np.diff(faceoffsets) - 2, 0)
+        face = np.repeat(np.arange(len(ntris)), ntris)
+        first = faceoffsets[:-1][face]
+        trioffsets = np.zeros(len(ntris) + 1, dtype=np.int32)
+        np.cumsum(ntris, out=trioffsets[1:])
+        i = np.arange(len(face)) - trioffsets[:-1][face]
+
+        triangles = np.empty((len(face), 3), dtype=np.uint32)
+        triangles[:,0] = faceverts[first]
+        triangles[:,1] = faceverts[first + i + 1]
+        triangles[:,2] = faceverts[first + i + 2]
+        return (triangles, trioffsets[groupfaces])
+
     def createGLFaces(self, nfaces, ufaces, prim, groups):
-        self.loadedgroups = groups
+        (faceoffsets, faceverts, groupfaces, groupuv) = self.facesFromGroups(groups)
+        return self.createGLFacesFromArrays(nfaces, ufaces, prim, faceoffsets, faceverts, groupfaces, groupuv)
+
+    def createGLFacesFromArrays(self, nfaces, ufaces, prim, faceoffsets, faceverts, groupfaces, groupuv, triangles=None, grouptris=None):
+        """
+        create OpenGL buffers from faces in CSR form (see facesFromGroups)
+
+        :param triangles: precalculated triangles of all groups and offsets per group (grouptris), calculated if None
+        """
+        self.faceoffsets = faceoffsets
+        self.faceverts = faceverts
+        self.groupfaces = groupfaces
+        self.groupuv = groupuv
         self.prim = prim
         self.n_faces = nfaces
         self.n_fuvs =  ufaces
         self.group = np.zeros(nfaces, dtype=np.uint16)
 
-        self.fverts = np.zeros((self.prim, 3), dtype=np.uint32)
-        # fill faces and group buffer
-        # ( array of numbers per face determining the group-number )
+        if triangles is None:
+            (triangles, grouptris) = self.triangulate(faceoffsets, faceverts, groupfaces)
 
-        cnt = 0
-        for num, npelem in enumerate (self.npGrpNames):
-            elem = npelem.decode("utf-8")
-            if self.visible is not None and elem not in self.visible:
-                continue
-            faces = groups[elem]["v"]
-            for face in faces:
-                l = len(face)
-                self.fverts[cnt] = face[:3]
-                cnt += 1
-                # rest for quad and n-gons 
-                if l > 3:
-                    i=2
-                    while i < l-1:
-                        self.fverts[cnt] = [face[0], face[i], face[i+1]]
-                        cnt += 1
-                        i += 1
-
-        # resize to visible groups only TODO not sure if it should stay like this
+        # faces of visible groups only TODO not sure if it should stay like this
         #
-        self.fverts.resize((cnt, 3), refcheck=False)
+        visible = self.visibleGroups()
+        if np.all(visible):
+            self.fverts = np.array(triangles, dtype=np.uint32)
+        else:
+            tris = [triangles[grouptris[i]:grouptris[i+1]] for i in np.flatnonzero(visible)]
+            self.fverts = np.concatenate(tris).astype(np.uint32) if len(tris) > 0 else np.zeros((0, 3), dtype=np.uint32)
+        cnt = len(self.fverts)
         self.n_fverts = cnt * 3
 
         # the indices (icoord) are simply the flattened fverts of the triangles
@@ -499,6 +713,7 @@ class object3d:
 
     def resetMesh(self):
         self.gl_coord[:] = self.gl_coord_o[:] # get back the copy
+        self.dragsessions = {}
 
     def createWCopy(self):
         self.gl_coord_w[:] = self.gl_coord[:]
@@ -683,6 +898,19 @@ class object3d:
 
         return gl_index, gl_coord, gl_uvcoord, gl_norm, nweights, overflow
 
+    def dragSession(self, targetlower, targetupper):
+        """
+        get drag session for a pair of targets, only a few recent sessions are kept
+        """
+        key = (targetlower, targetupper)
+        session = self.dragsessions.pop(key, None)
+        if session is None:
+            session = DragSession(self, targetlower, targetupper)
+            while len(self.dragsessions) > 7:
+                del self.dragsessions[next(iter(self.dragsessions))]
+        self.dragsessions[key] = session
+        return (session)
+
     def getInitialCopyForSlider(self, factor, targetlower, targetupper):
         """
         called when starting work with one slider, a copy without the value
@@ -690,23 +918,12 @@ class object3d:
         """
         print ("getInitialCopyForSlider")
         self.createWCopy()
+        session = self.dragSession(targetlower, targetupper)
+        session.last = None
         if factor == 0.0:
             return
-        else:
-            if factor < 0.0:
-                if targetlower is None:
-                    return
-                verts = targetlower.verts
-                data  = targetlower.data
-                factor = -factor
-            elif factor > 0.0:
-                verts = targetupper.verts
-                data  = targetupper.data
-            for i in range(0, len(verts)):
-                x = verts[i] * 3
-                self.gl_coord_w[x]   = self.gl_coord[x]   - factor * data[i][0]
-                self.gl_coord_w[x+1] = self.gl_coord[x+1] - factor * data[i][1]
-                self.gl_coord_w[x+2] = self.gl_coord[x+2] - factor * data[i][2]
+        if session.initialize(self.gl_coord, self.gl_coord_w, factor) is False:
+            return
 
         self.overflowCorrection(self.gl_coord_w)
         # self.calcNormals()
@@ -715,28 +932,13 @@ class object3d:
         """
         updates the mesh when slider is moved
         """
+        session = self.dragSession(targetlower, targetupper)
         if factor == 0.0:
             self.gl_coord[:] = self.gl_coord_w[:]
+            session.reset()
             return
 
-        if factor < 0.0:
-            if targetlower is None:
-                return
-            verts = targetlower.verts * 3
-            data  = targetlower.data.ravel()
-            factor = -factor
-        elif factor > 0.0:
-            verts = targetupper.verts * 3
-            data  = targetupper.data.ravel()
-
-        srcVerts = np.s_[...]
-        self.gl_coord[verts] = self.gl_coord_w[verts] + data[srcVerts][::3] * factor
-        self.gl_coord[verts+1] = self.gl_coord_w[verts+1] + data[srcVerts][1::3] * factor
-        self.gl_coord[verts+2] = self.gl_coord_w[verts+2] + data[srcVerts][2::3] * factor
-
-        # overflow vertices
-        #
-        self.overflowCorrection(self.gl_coord)
+        session.apply(self.gl_coord, self.gl_coord_w, factor)
 
     def setTarget(self, factor, targetlower, targetupper):
         """
@@ -766,11 +968,8 @@ class object3d:
         """
         print ("+++ reset mesh and add non macro targets")
         self.resetMesh()
-        targets = self.glob.Targets.modelling_targets
-        for target in targets:
-            if target.value != 0.0 and target.macro is None:
-                # print ("Set " + target.name)
-                self.setTarget(target.value / 100, target.decr, target.incr)
+        targets = self.glob.Targets
+        targets.getMorphEngine().apply(self.gl_coord, targets.nonMacroWeights())
 
         # overflow vertices and copy to non-macrobuffer
         #
@@ -799,49 +998,48 @@ class object3d:
         self.gl_coord_mm[verts+2] += m[srcVerts][2::3] * factor
 
 
+    def changeMacroContribution(self, cache, key, engine, weights):
+        """
+        replaces the contribution of one macro in the macro buffer,
+        the deltas are only calculated again when the weights differ from the cached ones
+
+        :param cache: dictionary key -> (weights, deltas)
+        :param key: macro used as key
+        """
+        old = cache.get(key)
+        if old is not None and np.array_equal(old[0], weights):
+            return
+        delta = np.zeros_like(self.gl_coord_mm)
+        engine.apply(delta, weights)
+        cache[key] = (weights, delta)
+
+        # sum up all cached macros instead of adding differences (avoids accumulated rounding errors)
+        #
+        self.gl_coord_mm[:] = 0.0
+        for (w, d) in cache.values():
+            self.gl_coord_mm += d
+
     def addMacroBuffer(self):
         """
         after changing a macro it will be added
         make sure to write in same buffer (out will avoid to get a new one)
+        the macro buffer is kept, it contains the sum of all macros
         """
         print ("+++ Add macro to character")
         np.add(self.gl_coord_mm, self.gl_coord_mn, out=self.gl_coord)  
         self.overflowCorrection(self.gl_coord)
-        self.gl_coord_mm = np.zeros_like(self.gl_coord)
 
     def approxToBasemesh(self, asset, base):
         """
         updates the mesh, barycentric approximation (assets)
-        """
-
-        b = base.gl_coord
-        w = asset.weights
-        o = asset.offsets
-
-        verts = asset.ref_vIdxs * 3 # index (v0, v1, v2)
-
-        """
-        i = 0
-        j = 0
-        for v in verts:
-            self.gl_coord[i]   = w[j,0]*b[v[0]]   + w[j,1]*b[v[1]]  +  w[j,2]*b[v[2]]   + o[j,0]
-            self.gl_coord[i+1] = w[j,0]*b[v[0]+1] + w[j,1]*b[v[1]+1] + w[j,2]*b[v[2]+1] + o[j,1]
-            self.gl_coord[i+2] = w[j,0]*b[v[0]+2] + w[j,1]*b[v[1]+2] + w[j,2]*b[v[2]+2] + o[j,2]
-            i += 3
-            j += 1
+        uses the precalculated fitting matrix of the asset, simulates this:
 
+        for j, v in enumerate(asset.ref_vIdxs):
+            coord[j] = w[j,0]*b[v[0]] + w[j,1]*b[v[1]] + w[j,2]*b[v[2]] + o[j] * scale
         """
-        vlen = len(verts) * 3
-
-        if asset.scaleMat is not None:
-            (x, y, z)  = (asset.scaleMat[0,0], asset.scaleMat[1,1], asset.scaleMat[2,2])
-            self.gl_coord[:vlen:3]  = w[:,0]*b[verts[:,0]] + w[:,1]*b[verts[:,1]] +  w[:,2]*b[verts[:,2]] + o[:,0] * x
-            self.gl_coord[1:vlen:3] = w[:,0]*b[verts[:,0]+1] + w[:,1]*b[verts[:,1]+1] +  w[:,2]*b[verts[:,2]+1] + o[:,1] * y
-            self.gl_coord[2:vlen:3] = w[:,0]*b[verts[:,0]+2] + w[:,1]*b[verts[:,1]+2] +  w[:,2]*b[verts[:,2]+2] + o[:,2] * z
-        else:
-            self.gl_coord[:vlen:3]  = w[:,0]*b[verts[:,0]] + w[:,1]*b[verts[:,1]] +  w[:,2]*b[verts[:,2]] + o[:,0]
-            self.gl_coord[1:vlen:3] = w[:,0]*b[verts[:,0]+1] + w[:,1]*b[verts[:,1]+1] +  w[:,2]*b[verts[:,2]+1] + o[:,1]
-            self.gl_coord[2:vlen:3] = w[:,0]*b[verts[:,0]+2] + w[:,1]*b[verts[:,1]+2] +  w[:,2]*b[verts[:,2]+2] + o[:,2]
+        b = np.reshape(base.gl_coord, (-1, 3))
+        c = np.reshape(self.gl_coord, (-1, 3))
+        asset.fitToBase(b, c[:len(asset.ref_vIdxs)])
 
         # do not forget the overflow vertices
         #
@@ -926,55 +1124,5 @@ class object3d:
 
         return measure, mcoords
 
-    def calculateAttachedGeom(self, faces):
-        """
-        get a dictionary of attached facenumbers and edgenumbers per vertex
-        for borders, get the next border neighbours (used in loop subdivision)
-        """
-        attachedFaces = {}
-        attachedEdges = {}
-
-        # the neighbours on a border of a single vertex will be two vertices, set them all to -1 before
-        # if both entries are not -1 we found the border vertices
-        #
-        borderneighbour = np.full((self.n_origverts,2), 0xffffffff, dtype=np.uint32)
-        for fn, verts in enumerate(faces):
-            for i in range(0,3):
-                j = (i+1) % 3               # to generate 0, 1, 2, 0
-                v = verts[i]
-
-                if v not in attachedFaces:      # create face dictionary
-                    attachedFaces[v] = [fn]
-                else:
-                    attachedFaces[v].append(fn)
-
-                if v > verts[j]:
-                    v1, v2 = verts[j], v
-                else:
-                    v1, v2 = v, verts[j]
-
-                if v1 not in attachedEdges:     # create edge dictionary
-                    attachedEdges[v1] = {}
-                if v2 not in attachedEdges[v1]:
-                    attachedEdges[v1][v2] = [fn, -1, None] # None will hold the future index for gl
-                else:
-                    attachedEdges[v1][v2][1] = fn
-
-        for v1 in attachedEdges:
-            for v2 in attachedEdges[v1]:
-                if attachedEdges[v1][v2][1] == -1:
-                    if borderneighbour[v1][0] == 0xffffffff:
-                        borderneighbour[v1][0] = v2
-                    else:
-                        borderneighbour[v1][1] = v2
-
-                    if borderneighbour[v2][0] == 0xffffffff:
-                        borderneighbour[v2][0] = v1
-                    else:
-                        borderneighbour[v2][1] = v1
-
-        return attachedFaces, attachedEdges, borderneighbour
-
-
     def __del__(self):
         self.env.logLine (4, " -- delete object3d: " + str(self.name))
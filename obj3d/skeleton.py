@@ -8,7 +8,8 @@
 
 import numpy as np
 from PySide6.QtGui import QVector3D
-from obj3d.bone import cBone, boneWeights
+from obj3d.bone import cBone, boneWeights, SkeletonEvaluator
+from obj3d.skinning import SkinningEngine
 import core.math as mquat
 
 class skeleton:
@@ -24,6 +25,7 @@ class skeleton:
         self.planes = {}
         self.bones = {}      # list of cBones
         self.bWeights = None
+        self.evaluator = None   # arrays of all bones, see SkeletonEvaluator
         self.root = None     # our skeleton accepts one root bone, not more, name of the root
         self.offset = QVector3D(0, 0, 0) # offset is used for pose skeleton to move root bone
         self.use_offset = False
@@ -127,6 +129,7 @@ class skeleton:
                             orderedbones.append(bone)
             pindex += 1
 
+        self.evaluator = SkeletonEvaluator(len(orderedbones))
         for bone in orderedbones:
             val = j[bone]
             rotplane = val["rotation_plane"] if "rotation_plane" in val else 0
@@ -134,6 +137,8 @@ class skeleton:
             weights = val["weights_reference"] if "weights_reference" in val else None
             cbone = cBone(self, bone, val["parent"], val["head"], val["tail"], rotplane, reference, weights)
             self.bones[bone] = cbone
+        self.finishBones()
+        self.evaluator.jointPositions(self.mesh.gl_coord)
 
         """
         for bone in  self.bones:
@@ -167,6 +172,7 @@ class skeleton:
         self.jointVerts = source.jointVerts
         self.bWeights = source.bWeights
 
+        self.evaluator = SkeletonEvaluator(len(source.bones))
         for bone in source.bones:
             b = source.bones[bone]
 
@@ -176,9 +182,10 @@ class skeleton:
             tail = np.asarray(tail, dtype=np.float32)
             head[1] -= offset
             tail[1] -= offset
-            cbone.assignJointPos(head * scale , tail * scale)
             self.bones[bone] = cbone
+            cbone.assignJointPos(head * scale , tail * scale)
 
+        self.finishBones()
         self.calcRestMat()
 
         # use the rotations from original skeleton
@@ -208,58 +215,71 @@ class skeleton:
         else:
             return np.asarray([0,1,0], dtype=np.float32)
 
+    def finishBones(self):
+        """
+        all bones are created, fill level table and joint table of the evaluator
+        """
+        self.evaluator.finish()
+        joints = []
+        for bone in self.bones.values():
+            joints.append(self.jointVerts[bone.head])
+            joints.append(self.jointVerts[bone.tail])
+        self.evaluator.setJoints(joints)
+
     def calcRestMat(self):
-        for bone in self.bones:
-            if self.bones[bone].calcRestMatFromSkeleton() is False:
-                return False
+        normals = {}
+        for bone in self.bones.values():
+            if isinstance(bone.localplane, str) and bone.localplane not in normals:
+                normals[bone.localplane] = bone.getNormal()
+        default = np.asarray([0.0, 1.0, 0.0], dtype=np.float32)
+        normals = np.asarray([normals.get(bone.localplane, default) if isinstance(bone.localplane, str) else bone.getNormal()
+                              for bone in self.bones.values()])
+
+        bad = self.evaluator.restMatrices(normals)
+        if bad is not None:
+            b = list(self.bones.values())[bad]
+            self.env.logLine(1, "Cannot calculate pose verts matrix for bone " + b.name)
+            self.env.logLine(1, "Non-singular rest matrix " + str(b.matRestGlobal))
+            return False
         return True
 
     def newGeometry(self):
         """
         geometry changes, recalculate joint positions + rest matrix
         """
-        for bone in  self.bones:
-            self.bones[bone].setJointPos()
+        self.evaluator.jointPositions(self.mesh.gl_coord)
         self.calcRestMat()
 
     def calcLocalPoseMat(self, poses):
-        for i, bone in  enumerate(self.bones):
-            self.bones[bone].calcLocalPoseMat(poses[i])
+        self.evaluator.setLocalPoses(np.arange(len(self.bones)), poses)
 
     def calcGlobalPoseMat(self):
-        for bone in  self.bones:
-            self.bones[bone].calcGlobalPoseMat()
+        self.evaluator.evaluate()
 
     def skinBasemesh(self):
         self.skinMesh(self.mesh, self.bWeights)
 
-    def skinMesh(self, mesh, bWeights):
-        vmapping = bWeights.bWeights
-
-        coords = np.zeros((mesh.n_origverts,3), float)        # own vector
-        l = len(mesh.gl_coord) // 3
-
-        meshCoords = np.ones((l, 4), dtype=np.float32)
-        meshCoords[:,:3] = np.reshape(mesh.gl_coord_w, (l,3))
-
-        for bname in vmapping:
-            bone = self.bones[bname]
-
-            verts, weights = vmapping[bname]
-            vec = np.dot(bone.matPoseVerts, meshCoords[verts].transpose())
-            vec *= weights
-            coords[verts] += vec.transpose()[:,:3]
+    def poseMatrices(self):
+        """
+        stacked matPoseVerts of all bones (order of self.bones)
+        """
+        return self.evaluator.matPoseVerts
 
-        m = coords.flatten()
-        mesh.gl_coord[:mesh.n_origverts*3] = m[:]
-        mesh.overflowCorrection(mesh.gl_coord)
+    def skinMesh(self, mesh, bWeights):
+        """
+        linear blend skinning, weights are packed once per mesh and skeleton
+        """
+        engine = bWeights.skinning
+        if engine is None or not engine.matches(self, bWeights, mesh.n_origverts):
+            engine = SkinningEngine(self.env, self, bWeights, mesh.n_origverts, self.env.config.get("skin_influences", 8))
+            bWeights.skinning = engine
+            self.env.logLine(8, str(engine))
+        engine.skin(mesh, self.poseMatrices())
 
 
     def restPose(self, bones_only=False):
-        for bone in self.bones:
-            self.bones[bone].restPose()
-            self.bones[bone].calcGlobalPoseMat()
-            self.bones[bone].poseBone()
+        self.evaluator.restPose()
+        self.evaluator.evaluate()
 
         # in case of restpose, pose with update function and not with pose function
         #
@@ -267,6 +287,20 @@ class skeleton:
             self.skinBasemesh()
             self.glob.baseClass.updateAttachedAssets()
 
+    def setJointPoses(self, joints: dict, frame, evaluator=None):
+        """
+        set local pose matrices of all bones mentioned in joints
+        """
+        if evaluator is None:
+            evaluator = self.evaluator
+        indices = []
+        poses = []
+        for elem, bone in self.bones.items():
+            if elem in joints:
+                indices.append(bone.index)
+                poses.append(joints[elem].finalPoses[frame])
+        evaluator.setLocalPoses(indices, poses)
+
     def pose(self, joints: dict, frame=0, bones_only=False):
         """
         pose the skeleton
@@ -275,15 +309,10 @@ class skeleton:
         :param frame: frame number
         :param bones_only: if True, no skinning
         """
-        for elem, bone in self.bones.items():
-
-            # pose each cBone which is mentioned in joints
-            #
-            if elem in joints:
-                bone.calcLocalPoseMat(joints[elem].finalPoses[frame])
-
-            bone.calcGlobalPoseMat()
-            bone.poseBone()
+        # pose each cBone which is mentioned in joints
+        #
+        self.setJointPoses(joints, frame)
+        self.evaluator.evaluate()
 
         if not bones_only:
             self.skinBasemesh()
@@ -298,6 +327,8 @@ class skeleton:
         :param joints: BVHJoint dictionary
         :param frame: frame number
         """
+        indices = []
+        poses = []
         for elem, bone in self.bones.items():
 
             # pose each cBone reference which is mentioned in joints, multiply pose matrices
@@ -318,15 +349,17 @@ class skeleton:
                             m1[:3,:3] = m2
 
                 if m1 is not None:
-                   bone.calcLocalPoseMat(m1)
+                    indices.append(bone.index)
+                    poses.append(m1)
             else:
                 # in case of no reference, try it directly (skeletons like default-notoes)
                 #
                 if elem in joints:
-                    bone.calcLocalPoseMat(joints[elem].finalPoses[frame])
-            
-            bone.calcGlobalPoseMat()
-            bone.poseBone()
+                    indices.append(bone.index)
+                    poses.append(joints[elem].finalPoses[frame])
+
+        self.evaluator.setLocalPoses(indices, poses)
+        self.evaluator.evaluate()
 
 
     def rootLowestDistance(self, joints, fromframe=0, toframe=-1):
@@ -338,20 +371,13 @@ class skeleton:
             toframe = fromframe+1
         mdiff = 0.0
 
+        ev = self.evaluator
+        children = ev.parent >= 0
         for frame in range(fromframe, toframe):
-            yroot = 0.0
-            ylow  = 1000.0
-            for elem, bone in self.bones.items():
-                if elem in joints:
-                    bone.calcLocalPoseMat(joints[elem].finalPoses[frame])
-
-                bone.calcGlobalPoseMat()
-                bone.poseBone()
-                if bone.parent is None:
-                    yroot = bone.poseheadPos[1]
-                else:
-                    if bone.poseheadPos[1] < ylow:
-                        ylow = bone.poseheadPos[1]
+            self.setJointPoses(joints, frame)
+            ev.evaluate()
+            yroot = ev.poseheadPos[ev.parent < 0][0, 1]
+            ylow  = min(1000.0, ev.poseheadPos[children, 1].min()) if children.any() else 1000.0
             diff = yroot - ylow
             if diff > mdiff:
                 mdiff = diff
@@ -370,6 +396,8 @@ class skeleton:
         # in case the bone is posed by more than one posemat, multiply quaternion matrices
         #
         found = {}
+        indices = []
+        poses = []
         for bone, elem in self.bones.items():
             modbone = False
             for blend in blends:
@@ -385,23 +413,19 @@ class skeleton:
                     modbone = True
 
             if modbone is True:
-                mat = mquat.quaternionToRotMatrix(q1)
-                elem.calcLocalPoseMat(mat)
+                indices.append(elem.index)
+                poses.append(mquat.quaternionToRotMatrix(q1))
                 changed.append(bone)
 
-            elem.calcGlobalPoseMat()
-            elem.poseBone()
+        self.evaluator.setLocalPoses(indices, poses)
 
         if mask is not None:
-            for bone in mask:
-                if bone not in found:
-                    self.bones[bone].restPose()
-                    self.bones[bone].calcGlobalPoseMat()
-                    self.bones[bone].poseBone()
+            self.evaluator.restPose([self.bones[bone].index for bone in mask if bone not in found])
+
+        self.evaluator.evaluate()
 
         if not bones_only:
             self.skinBasemesh()
             self.glob.baseClass.poseAttachedAssets()
 
         return changed
-
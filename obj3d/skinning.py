@@ -0,0 +1,128 @@
+"""
+    License information: data/licenses/makehuman_license.txt
+    Author: black-punkduck
+
+    Classes:
+    * SkinningEngine
+"""
+
+import numpy as np
+
+class SkinningEngine:
+    """
+    linear blend skinning with packed weights. The weights per bone are converted once into
+    fixed-width arrays per vertex: joint indices (index in skeleton.bones) and weights, unused
+    slots have weight 0. Skinning a frame blends the gathered pose matrices per vertex and applies
+    them with one batched product, all buffers are allocated once.
+    The strongest influences are packed, when a vertex is influenced by more bones than the width allows,
+    the remaining ones are kept as a short list and added separately (result is not changed).
+    """
+    def __init__(self, env, skeleton, bWeights, numverts, maxinfluences=8):
+        self.env = env
+        self.skeleton = skeleton
+        self.bWeights = bWeights
+        self.vmapping = bWeights.bWeights
+        self.numverts = numverts
+        self.bonenames = list(skeleton.bones)
+        self.pack(maxinfluences)
+
+        # preallocated buffers: homogeneous rest coordinates, pose matrices, gathered and blended matrices
+        #
+        self.restCoords = np.ones((numverts, 4), dtype=np.float32)
+        self.poseMats = np.zeros((len(self.bonenames), 3, 4), dtype=np.float32)
+        self.matrices = np.zeros((numverts, self.width, 3, 4), dtype=np.float32)
+        self.blended = np.zeros((numverts, 3, 4), dtype=np.float32)
+
+    def __str__(self):
+        return ("SkinningEngine: " + str(self.numverts) + " vertices, " + str(self.width) + " influences, " +
+                str(len(self.restVerts)) + " additional")
+
+    def pack(self, maxinfluences):
+        """
+        convert weights per bone to packed top-K joint index/weight arrays per vertex
+        """
+        index = {name: i for i, name in enumerate(self.bonenames)}
+        verts = []
+        bones = []
+        weights = []
+        for bname, (v, w) in self.vmapping.items():
+            verts.append(np.asarray(v, dtype=np.int64))
+            bones.append(np.full(len(v), index[bname], dtype=np.int64))
+            weights.append(np.asarray(w, dtype=np.float32))
+
+        nbones = max(len(self.bonenames), 1)
+        if len(verts) > 0:
+            verts = np.concatenate(verts)
+            bones = np.concatenate(bones)
+            weights = np.concatenate(weights)
+        else:
+            verts = np.zeros(0, dtype=np.int64)
+            bones = np.zeros(0, dtype=np.int64)
+            weights = np.zeros(0, dtype=np.float32)
+
+        # same vertex may appear more than once for one bone (bone groups), sum them up
+        #
+        keys, inverse = np.unique(verts * nbones + bones, return_inverse=True)
+        weights = np.bincount(inverse, weights=weights, minlength=len(keys)).astype(np.float32)
+        verts = keys // nbones
+        bones = keys % nbones
+
+        # sort by vertex, strongest weight first, then rank inside the vertex
+        #
+        order = np.lexsort((-weights, verts))
+        verts = verts[order]
+        bones = bones[order]
+        weights = weights[order]
+        counts = np.bincount(verts, minlength=self.numverts)[:self.numverts]
+        starts = np.cumsum(counts) - counts
+        rank = np.arange(len(verts)) - np.repeat(starts, counts)
+
+        maxcount = int(counts.max()) if len(counts) > 0 else 0
+        self.width = max(1, min(maxcount, maxinfluences))
+        self.joints = np.zeros((self.numverts, self.width), dtype=np.intp)
+        self.weights = np.zeros((self.numverts, self.width), dtype=np.float32)
+
+        use = rank < self.width
+        self.joints[verts[use], rank[use]] = bones[use]
+        self.weights[verts[use], rank[use]] = weights[use]
+
+        # influences which do not fit
+        #
+        rest = ~use
+        self.restVerts = verts[rest].astype(np.intp)
+        self.restJoints = bones[rest].astype(np.intp)
+        self.restWeights = weights[rest, None]
+
+    def matches(self, skeleton, bWeights, numverts):
+        """
+        check if packed arrays are still valid
+        """
+        return (self.skeleton is skeleton and self.bWeights is bWeights and self.vmapping is bWeights.bWeights
+                and self.numverts == numverts and self.bonenames == list(skeleton.bones))
+
+    def skin(self, mesh, matrices, coords=None):
+        """
+        skin rest coordinates of mesh (gl_coord_w) into gl_coord
+
+        :param mesh: object3d
+        :param matrices: stacked pose matrices (matPoseVerts) in order of skeleton.bones, shape (bones, 4, 4)
+        :param coords: optional flat result buffer instead of gl_coord
+        """
+        if coords is None:
+            coords = mesh.gl_coord
+        n = self.numverts
+        self.restCoords[:,:3] = np.reshape(mesh.gl_coord_w[:n*3], (n, 3))
+        self.poseMats[:] = matrices[:,:3,:]
+
+        # blend matrices per vertex: sum over k: weight[k] * matrix[joint[k]], then apply to rest coordinates
+        #
+        np.take(self.poseMats, self.joints, axis=0, out=self.matrices)
+        np.matmul(self.weights[:,None,:], np.reshape(self.matrices, (n, self.width, 12)), out=np.reshape(self.blended, (n, 1, 12)))
+        out = np.reshape(coords[:n*3], (n, 3))
+        np.einsum("nij,nj->ni", self.blended, self.restCoords, out=out)
+
+        if len(self.restVerts) > 0:
+            vec = np.einsum("rij,rj->ri", self.poseMats[self.restJoints], self.restCoords[self.restVerts])
+            np.add.at(out, self.restVerts, vec * self.restWeights)
+
+        mesh.overflowCorrection(coords)
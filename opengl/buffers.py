@@ -28,6 +28,7 @@ class OpenGlBuffers():
         self.tex_coord_buffer = None
         self.memory_pos = None
         self.len_memory = 0
+        self.memory_norm = None
 
     def VertexBuffer(self, pos):
         vbuffer = QOpenGLBuffer(QOpenGLBuffer.VertexBuffer)
@@ -44,6 +45,7 @@ class OpenGlBuffers():
         vbuffer.create()
         vbuffer.bind()
         vbuffer.allocate(pos, len(pos) * 4)
+        self.memory_norm = pos
         self.normal_buffer = vbuffer
 
     def TexCoordBuffer(self, pos):
@@ -81,6 +83,9 @@ class OpenGlBuffers():
     def Tweak(self):
         self.vert_pos_buffer.bind()
         self.vert_pos_buffer.write(0,self.memory_pos, self.len_memory )
+        if self.memory_norm is not None:
+            self.normal_buffer.bind()
+            self.normal_buffer.write(0,self.memory_norm, len(self.memory_norm) * 4)
 
     def Delete(self):
         if self.vert_pos_buffer is not None:
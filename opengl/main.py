@@ -23,6 +23,7 @@ from opengl.camera import Camera, Light
 from opengl.skybox import OpenGLSkyBox
 from opengl.prims import VisMarker
 from opengl.scene import Scene
+from obj3d.animation import PlaybackPipeline
 
 class OpenGLView(QOpenGLWidget):
     def __init__(self, glob):
@@ -53,12 +54,15 @@ class OpenGLView(QOpenGLWidget):
         self.glfunc = None
         self.marker = None
         self.scene = None
+        self.pipeline = None        # background playback
 
     def setFPS(self, value, callback=None):
         self.fps = value
         if callback is not None:
             self.resetbuttons = callback
         self.timer1.stop()
+        if self.pipeline is not None:
+            self.pipeline.interval = 1.0 / self.fps
         self.timer1.start(1000 / self.fps)
 
     def setYRotAngle(self, value, callback=None):
@@ -71,24 +75,36 @@ class OpenGLView(QOpenGLWidget):
 
     def startTimer(self, framefeedback):
         self.framefeedback = framefeedback
+        if self.env.config.get("anim_pipeline", False) and self.glob.baseClass.bvh is not None:
+            self.pipeline = PlaybackPipeline(self.glob)
+            self.pipeline.start(self.fps)
         self.timer1.start(1000 / self.fps)
 
     def stopTimer(self):
+        self.timer1.stop()
+        if self.pipeline is not None:
+            self.pipeline.stop()
+            self.pipeline = None
+        self.glob.baseClass.stopAnimation()
         if self.framefeedback is not None:
             self.framefeedback()
-        self.timer1.stop()
         self.blocked = False
 
     def nextFrame(self):
         if self.blocked:
             return
         self.blocked = True
-        skeleton = self.glob.baseClass.pose_skeleton
+        if self.pipeline is not None:
+            if self.pipeline.present():
+                self.Tweak()
+            self.blocked = False
+            return
+
         bvh = self.glob.baseClass.bvh
         # this slows animation down, better way?
         #if self.framefeedback is not None:
         #    self.framefeedback()
-        skeleton.pose(bvh.joints, bvh.currentFrame)
+        self.glob.baseClass.showFrame(bvh.currentFrame)
         if bvh.currentFrame < (bvh.frameCount-1):
             bvh.currentFrame += 1
         else:
@@ -0,0 +1,211 @@
+"""
+    License information: data/licenses/makehuman_license.txt
+
+    bone weights created from flat arrays (obj3d/bone.py) compared to the results of the
+    previous implementation (per vertex loops), stored in data/bone_weights_reference.npz
+
+    * createWeightsPerBone for the weight files of all rigs
+    * approxWeights and deDuplicateWeights for the .mhclo assets of all base meshes
+    * transferWeights to two custom skeletons (created from the default skeleton)
+
+    vertex numbers must be identical, weights may differ by summation order (measured: 1.8e-7)
+"""
+
+import os
+import sys
+import json
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.append(ROOT)
+
+from obj3d.bone import boneWeights
+from core.attached_asset import attachedAsset
+
+REFERENCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "bone_weights_reference.npz")
+TOLERANCE = 1e-6
+
+# base meshes: number of vertices and assets
+#
+MESHES = {
+    "hm08": (19158, ["eyes/hm08/low-poly/low-poly.mhclo"]),
+    "mh2bot": (7259, ["clothes/mh2bot/siren/siren.mhclo", "clothes/mh2bot/cyclehorn/cyclehorn.mhclo",
+        "clothes/mh2bot/3dtext/3dtext.mhclo", "clothes/mh2bot/oilcan/oilcan.mhclo", "clothes/mh2bot/jetpack/jetpack.mhclo"])
+}
+
+class testEnv():
+    def __init__(self, basename):
+        self.basename = basename
+        self.verbose = 0
+
+    def logLine(self, level, line):
+        pass
+
+class testGlob():
+    def __init__(self, basename):
+        self.env = testEnv(basename)
+
+class testMesh():
+    def __init__(self, numverts):
+        self.n_origverts = numverts
+
+class testBone():
+    def __init__(self, name, parent, reference=None, weightref=None):
+        self.name = name
+        self.parent = parent
+        self.reference = reference if reference is not None else []
+        self.weightref = weightref
+
+class testSkeleton():
+    """
+    the parts of a skeleton used by boneWeights
+    """
+    def __init__(self, name):
+        self.name = name
+        self.root = None
+        self.bones = {}
+
+    def addBone(self, name, parent, reference=None, weightref=None):
+        self.bones[name] = testBone(name, parent, reference, weightref)
+        if parent is None:
+            self.root = name
+
+    def level(self, name):
+        bone = self.bones[name].parent
+        level = 0
+        while bone is not None:
+            bone = bone.parent
+            level += 1
+        return level
+
+    def descendants(self, name):
+        return [bone for bone, b in self.bones.items() if bone != name and self.isAncestor(name, b)]
+
+    def isAncestor(self, name, bone):
+        while bone.parent is not None:
+            bone = bone.parent
+            if bone.name == name:
+                return True
+        return False
+
+
+def dataPath(*names):
+    return os.path.join(ROOT, "data", *names)
+
+def loadSkeleton(basename):
+    with open(dataPath("rigs", basename, "default.mhskel"), "r", encoding="utf-8") as f:
+        bones = json.load(f)["bones"]
+    skeleton = testSkeleton(basename)
+    while len(skeleton.bones) < len(bones):
+        for name, val in bones.items():
+            parent = val.get("parent")
+            if name not in skeleton.bones and (parent is None or parent in skeleton.bones):
+                skeleton.addBone(name, skeleton.bones.get(parent))
+    return skeleton
+
+def customSkeletons(default):
+    """
+    two custom skeletons like the ones in asset packs:
+    * renamed: upper bones with a new name and reference, the lower ones are collected by the parent chain
+    * merged: upper bones with the same name, the last level collects its descendants by weights_reference
+    """
+    renamed = testSkeleton("renamed")
+    merged = testSkeleton("merged")
+    for name in default.bones:
+        level = default.level(name)
+        if level <= 6:
+            parent = default.bones[name].parent
+            renamed.addBone("mapped_" + name, None if parent is None else renamed.bones["mapped_" + parent.name], reference=[name])
+        if level < 9:
+            merged.addBone(name, None if default.bones[name].parent is None else merged.bones[default.bones[name].parent.name])
+        elif level == 9:
+            merged.addBone(name, merged.bones[default.bones[name].parent.name], weightref=[name] + default.descendants(name))
+    return [renamed, merged]
+
+def baseWeights(basename):
+    (numverts, assets) = MESHES[basename]
+    skeleton = loadSkeleton(basename)
+    with open(dataPath("rigs", basename, "default_weights.mhw"), "r", encoding="utf-8") as f:
+        wdict = json.load(f)["weights"]
+    weights = boneWeights(testGlob(basename), skeleton, testMesh(numverts))
+    weights.createWeightsPerBone(wdict)
+    return weights
+
+def assetWeights(basename, path, base):
+    (numverts, assets) = MESHES[basename]
+    asset = attachedAsset(testGlob(basename), "clothes", numverts)
+    (res, err) = asset.textLoad(dataPath(path))
+    assert res, err
+    weights = boneWeights(asset.glob, base.default_skeleton, testMesh(len(asset.ref_vIdxs)))
+    weights.approxWeights(asset, base)
+    return weights
+
+def allWeights():
+    """
+    all tested weights as case: {bone: (verts, weights)}, also used to create the reference file
+    """
+    cases = {}
+    for basename, (numverts, assets) in MESHES.items():
+        base = baseWeights(basename)
+        cases[basename] = base.bWeights
+        for path in assets:
+            cases[path] = assetWeights(basename, path, base).bWeights
+        if basename == "hm08":
+            for skeleton in customSkeletons(base.default_skeleton):
+                cases[basename + "@" + skeleton.name] = base.transferWeights(skeleton)
+                cases[assets[0] + "@" + skeleton.name] = assetWeights(basename, assets[0], base).transferWeights(skeleton)
+    return cases
+
+def saveReference(filename):
+    content = {}
+    for case, weights in allWeights().items():
+        content[case + ":bones"] = np.array(list(weights), dtype=str)
+        for bone, (v, w) in weights.items():
+            content[case + ":" + bone + ":v"] = np.asarray(v, dtype=np.uint32)
+            content[case + ":" + bone + ":w"] = np.asarray(w, dtype=np.float32)
+    np.savez_compressed(filename, **content)
+
+
+@pytest.fixture(scope="module")
+def reference():
+    with np.load(REFERENCE) as npzfile:
+        yield {key: npzfile[key] for key in npzfile.files}
+
+@pytest.fixture(scope="module")
+def current():
+    return allWeights()
+
+def cases():
+    names = []
+    for basename, (numverts, assets) in MESHES.items():
+        names.append(basename)
+        names.extend(assets)
+    for skeleton in ["renamed", "merged"]:
+        names.extend([MESHES["hm08"][1][0] + "@" + skeleton, "hm08@" + skeleton])
+    return names
+
+@pytest.mark.parametrize("case", cases())
+def test_weights(case, reference, current):
+    weights = current[case]
+    assert list(weights) == [str(bone) for bone in reference[case + ":bones"]]
+    for bone, (v, w) in weights.items():
+        np.testing.assert_array_equal(v, reference[case + ":" + bone + ":v"], err_msg=case + ": " + bone)
+        np.testing.assert_allclose(w, reference[case + ":" + bone + ":w"], rtol=0, atol=TOLERANCE, err_msg=case + ": " + bone)
+        assert len(np.unique(v)) == len(v)
+
+def test_deduplicate():
+    base = baseWeights("hm08")
+    v = np.array([1, 1, 2, 5, 5, 5], dtype=np.uint32)
+    w = np.array([0.1, 0.2, 0.3, 0.1, 0.1, 0.2], dtype=np.float32)
+    result = base.deDuplicateWeights({"a": (v, w), "b": (v[:0], w[:0])})
+    np.testing.assert_array_equal(result["a"][0], [1, 2, 5])
+    np.testing.assert_allclose(result["a"][1], [0.3, 0.3, 0.4], rtol=0, atol=TOLERANCE)
+    assert len(result["b"][0]) == 0
+
+
+if __name__ == '__main__':
+    # create the reference file (with the implementation found first in the path)
+    #
+    saveReference(sys.argv[1] if len(sys.argv) > 1 else REFERENCE)